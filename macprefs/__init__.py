@@ -1,6 +1,25 @@
 """macprefs package."""
 from __future__ import annotations
 
-from .plist2defaults import plist_to_defaults_commands
+from importlib import import_module
+from typing import TYPE_CHECKING, Any
 
-__all__ = ('plist_to_defaults_commands',)
+if TYPE_CHECKING:
+    from .config import make_configured_domain_filter, make_configured_key_filter
+    from .plist2defaults import plist_to_defaults_commands
+    from .stream import DomainResult, stream_domains
+
+__all__ = ('DomainResult', 'make_configured_domain_filter', 'make_configured_key_filter',
+           'plist_to_defaults_commands', 'stream_domains')
+__version__ = '0.4.3'
+
+
+def __getattr__(name: str) -> Any:
+    if name in {'make_configured_domain_filter', 'make_configured_key_filter'}:
+        return getattr(import_module('.config', __name__), name)
+    if name == 'plist_to_defaults_commands':
+        return getattr(import_module('.plist2defaults', __name__), name)
+    if name in {'DomainResult', 'stream_domains'}:
+        return getattr(import_module('.stream', __name__), name)
+    msg = f'module {__name__!r} has no attribute {name!r}'
+    raise AttributeError(msg)
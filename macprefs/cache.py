@@ -0,0 +1,309 @@
+"""Caches kept in the state directory."""
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, cast
+import hashlib
+import json
+import logging
+import pickle  # ruff:ignore[suspicious-pickle-import]
+
+from . import __version__
+from .constants import SNAPSHOT_CACHE_MAX_BYTES
+from .journal import atomic_write
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Mapping
+    from pathlib import Path
+    import os
+
+    from .typing import PlistRoot
+
+__all__ = ('NegativeCache', 'SnapshotCache', 'config_fingerprint')
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b'MPSNAP01'
+"""Magic bytes at the start of a snapshot file."""
+
+
+class NegativeCache:
+    """
+    Property lists that could not be read or parsed.
+
+    Entries are keyed by path and store the size and modification time of the file when it failed.
+    A file is skipped until either changes.
+    """
+    def __init__(self,
+                 path: Path | None = None,
+                 entries: dict[str, list[int]] | None = None) -> None:
+        self.path = path
+        """File the cache is saved to."""
+        self.entries = entries or {}
+        """Mapping of path to ``[size, mtime_ns]``."""
+        self._dirty = False
+
+    @classmethod
+    def load(cls, path: Path) -> NegativeCache:
+        """
+        Load the cache from a file.
+
+        Returns
+        -------
+        NegativeCache
+            The cache. It is empty if the file does not exist or is invalid.
+        """
+        try:
+            entries = json.loads(path.read_text(encoding='utf-8'))
+        except (FileNotFoundError, ValueError):
+            entries = {}
+        return cls(path, entries if isinstance(entries, dict) else {})
+
+    def save(self) -> None:
+        """Save the cache if it changed."""
+        if self.path and self._dirty:
+            atomic_write(self.path, json.dumps(self.entries, sort_keys=True))
+            self._dirty = False
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        self._dirty = self._dirty or bool(self.entries)
+        self.entries = {}
+
+    def contains(self, path: str, stat: os.stat_result) -> bool:
+        """
+        Check if a file failed before and has not changed since.
+
+        Returns
+        -------
+        bool
+            ``True`` if the file should be skipped.
+        """
+        entry = self.entries.get(path)
+        if entry is None:
+            return False
+        if entry == [stat.st_size, stat.st_mtime_ns]:
+            return True
+        log.debug('`%s` changed since it failed. Retrying.', path)
+        del self.entries[path]
+        self._dirty = True
+        return False
+
+    def add(self, path: str, stat: os.stat_result) -> None:
+        """Record a file that failed."""
+        log.debug('Adding `%s` to the negative cache.', path)
+        self.entries[path] = [stat.st_size, stat.st_mtime_ns]
+        self._dirty = True
+
+
+def config_fingerprint(config: Mapping[str, Any], **options: Any) -> str:
+    """
+    Hash the macprefs version, the filter configuration and output options.
+
+    Returns
+    -------
+    str
+        Hexadecimal digest.
+    """
+    filters = {k: v for k, v in config.items() if k.startswith(('extend-ignore-', 'ignore-'))}
+    return hashlib.blake2b(json.dumps([__version__, filters, options], sort_keys=True).encode(),
+                           digest_size=16).hexdigest()
+
+
+class SnapshotCache:
+    """
+    Cleaned property list roots of the previous export, packed into a single file.
+
+    The file starts with :py:data:`SNAPSHOT_MAGIC`, the length of the header as an 8-byte little
+    endian integer and the pickled header, followed by one pickled root per domain. The header
+    holds the fingerprint the snapshot was written with and an index of domain to offset, length,
+    source file size and modification time, and the generation in which the entry was last used.
+
+    Loading reads the file once. Roots are only unpickled when requested.
+    """
+    def __init__(self,
+                 path: Path | None = None,
+                 fingerprint: str = '',
+                 *,
+                 max_bytes: int = SNAPSHOT_CACHE_MAX_BYTES) -> None:
+        self.path = path
+        """File the snapshot is saved to."""
+        self.fingerprint = fingerprint
+        """Fingerprint of the options that affect the stored roots."""
+        self.max_bytes = max_bytes
+        """Maximum size of the stored roots. Least recently used entries are evicted first."""
+        self.generation = 0
+        """Incremented on every save."""
+        self.hits: set[str] = set()
+        """Domains whose entry was reused during this run."""
+        self._data = memoryview(b'')
+        self._index: dict[str, tuple[int, int, int, int, int]] = {}
+        self._new: dict[str, tuple[bytes, int, int]] = {}
+
+    @classmethod
+    def load(cls,
+             path: Path,
+             fingerprint: str,
+             *,
+             max_bytes: int = SNAPSHOT_CACHE_MAX_BYTES) -> SnapshotCache:
+        """
+        Load a snapshot.
+
+        Returns
+        -------
+        SnapshotCache
+            The snapshot. It is empty if the file does not exist, is invalid or was written with a
+            different fingerprint.
+        """
+        ret = cls(path, fingerprint, max_bytes=max_bytes)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return ret
+        header_start = len(SNAPSHOT_MAGIC) + 8
+        header_end = header_start + int.from_bytes(data[len(SNAPSHOT_MAGIC):header_start], 'little')
+        if not data.startswith(SNAPSHOT_MAGIC):
+            log.debug('Ignoring invalid snapshot `%s`.', path)
+            return ret
+        header_data = data[header_start:header_end]
+        try:
+            header = pickle.loads(header_data)  # ruff:ignore[suspicious-pickle-usage]
+            written_fingerprint = header['fingerprint']
+            generation = int(header['generation'])
+            index = {
+                str(domain): (int(offset), int(length), int(size), int(mtime_ns), int(entry_gen))
+                for domain, (offset, length, size, mtime_ns, entry_gen) in header['index'].items()
+            }
+        except Exception:
+            # A truncated or foreign file can fail in many ways. Any of them is a miss.
+            log.debug('Ignoring invalid snapshot `%s`.', path, exc_info=True)
+            return ret
+        if written_fingerprint != fingerprint:
+            log.debug('Ignoring snapshot `%s` written with different options.', path)
+            return ret
+        ret.generation = generation
+        ret._data = memoryview(data)[header_end:]
+        ret._index = index
+        return ret
+
+    def domains(self) -> list[str]:
+        """
+        List the domains in the snapshot.
+
+        Returns
+        -------
+        list[str]
+            Sorted domain names.
+        """
+        return sorted(self._index.keys() | self._new.keys())
+
+    def get(self, domain: str) -> PlistRoot | None:
+        """
+        Get the root of a domain.
+
+        Returns
+        -------
+        PlistRoot | None
+            The root, or ``None`` if the domain is not in the snapshot.
+        """
+        blob: bytes | memoryview
+        if domain in self._new:
+            blob = self._new[domain][0]
+        elif domain in self._index:
+            offset, length, *_ = self._index[domain]
+            blob = self._data[offset:offset + length]
+        else:
+            return None
+        return cast('PlistRoot', pickle.loads(blob))  # ruff:ignore[suspicious-pickle-usage]
+
+    def get_fresh(self, domain: str, stat: os.stat_result) -> PlistRoot | None:
+        """
+        Get the root of a domain if its source file has not changed since it was stored.
+
+        Returns
+        -------
+        PlistRoot | None
+            The root, or ``None`` if the domain is not in the snapshot or its source changed.
+        """
+        if domain in self._new:
+            _, size, mtime_ns = self._new[domain]
+        elif domain in self._index:
+            _, _, size, mtime_ns, _ = self._index[domain]
+        else:
+            return None
+        if (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            return None
+        self.hits.add(domain)
+        return self.get(domain)
+
+    def load_all(self) -> dict[str, PlistRoot]:
+        """
+        Get all roots.
+
+        Returns
+        -------
+        dict[str, PlistRoot]
+            Mapping of domain to root, sorted by domain.
+        """
+        return {domain: cast('PlistRoot', self.get(domain)) for domain in self.domains()}
+
+    def put(self, domain: str, root: PlistRoot, stat: os.stat_result | None = None) -> None:
+        """Store the root of a domain and the size and modification time of its source file."""
+        self.hits.discard(domain)
+        self._index.pop(domain, None)
+        self._new[domain] = (pickle.dumps(root, protocol=pickle.HIGHEST_PROTOCOL),
+                             stat.st_size if stat else -1, stat.st_mtime_ns if stat else -1)
+
+    def remove(self, domain: str) -> None:
+        """Remove a domain."""
+        self.hits.discard(domain)
+        self._index.pop(domain, None)
+        self._new.pop(domain, None)
+
+    def retain(self, domains: Iterable[str]) -> None:
+        """Remove all domains not in ``domains``."""
+        keep = set(domains)
+        for domain in self.domains():
+            if domain not in keep:
+                self.remove(domain)
+
+    def save(self) -> None:
+        """Write the snapshot, evicting the least recently used entries above the size limit."""
+        if not self.path:
+            return
+        self.generation += 1
+        entries: list[tuple[int, str, bytes | memoryview, int,
+                            int]] = [(self.generation, domain, blob, size, mtime_ns)
+                                     for domain, (blob, size, mtime_ns) in self._new.items()]
+        for domain, (offset, length, size, mtime_ns, generation) in self._index.items():
+            entries.append((self.generation if domain in self.hits else generation, domain,
+                            self._data[offset:offset + length], size, mtime_ns))
+        entries.sort(key=lambda x: (-x[0], x[1]))
+        index: dict[str, tuple[int, int, int, int, int]] = {}
+        blobs: list[bytes | memoryview] = []
+        offset = 0
+        for generation, domain, blob, size, mtime_ns in entries:
+            if offset + len(blob) > self.max_bytes:
+                log.debug('Evicting `%s` from the snapshot.', domain)
+                continue
+            index[domain] = (offset, len(blob), size, mtime_ns, generation)
+            blobs.append(blob)
+            offset += len(blob)
+        header = pickle.dumps(
+            {
+                'fingerprint': self.fingerprint,
+                'generation': self.generation,
+                'index': index
+            },
+            protocol=pickle.HIGHEST_PROTOCOL)
+        tmp = self.path.with_name(f'{self.path.name}.tmp')
+        with tmp.open('wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(len(header).to_bytes(8, 'little'))
+            f.write(header)
+            for blob in blobs:
+                f.write(blob)
+        tmp.replace(self.path)
+        self._data = memoryview(b''.join(blobs))
+        self._index = index
+        self._new = {}
+        self.hits = set()
@@ -0,0 +1,223 @@
+"""Concurrency, read rate and priority limits for export and conversion tasks."""
+from __future__ import annotations
+
+from time import monotonic, perf_counter
+from typing import TYPE_CHECKING, ParamSpec, TypeVar
+import asyncio
+import ctypes
+import errno
+import logging
+import os
+import resource
+import sys
+
+from .constants import (
+    BACKGROUND_NICENESS,
+    EXPORT_TASK_FDS,
+    FD_RETRY_ATTEMPTS,
+    FD_RETRY_DELAY_SECONDS,
+    JOBS_PER_CPU,
+    LATENCY_EWMA_ALPHA,
+    LATENCY_SLOWDOWN_FACTOR,
+    MAX_CONCURRENT_EXPORT_TASKS,
+    RESERVED_FDS,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+
+    from .typing import Jobs
+
+__all__ = ('AdaptiveLimiter', 'RateLimiter', 'auto_jobs', 'fd_limit', 'lower_priority')
+
+log = logging.getLogger(__name__)
+
+P = ParamSpec('P')
+T = TypeVar('T')
+
+RETRY_ERRNOS = frozenset({errno.EAGAIN, errno.EMFILE, errno.ENFILE})
+"""Error numbers of :py:class:`OSError` that are retried with backoff."""
+IOPOL_TYPE_DISK = 0
+IOPOL_SCOPE_PROCESS = 0
+IOPOL_THROTTLE = 3
+
+
+def fd_limit() -> int:
+    """
+    Get the soft limit of open file descriptors.
+
+    Returns
+    -------
+    int
+        The limit. ``RLIM_INFINITY`` is reported as 65536.
+    """
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    return 65536 if soft == resource.RLIM_INFINITY else soft
+
+
+def auto_jobs() -> int:
+    """
+    Get the maximum number of concurrent tasks from the CPU count and the file descriptor limit.
+
+    Returns
+    -------
+    int
+        At most :py:data:`macprefs.constants.JOBS_PER_CPU` tasks per CPU, and no more than fit in
+        the file descriptor limit minus :py:data:`macprefs.constants.RESERVED_FDS`.
+    """
+    by_fds = (fd_limit() - RESERVED_FDS) // EXPORT_TASK_FDS
+    return max(1, min((os.cpu_count() or 1) * JOBS_PER_CPU, by_fds))
+
+
+def lower_priority() -> None:
+    """
+    Lower the CPU and disk I/O priority of the process.
+
+    The niceness is raised to :py:data:`macprefs.constants.BACKGROUND_NICENESS`. On macOS, disk I/O
+    is also throttled with ``setiopolicy_np``, like ``taskpolicy -d throttle``. Subprocesses inherit
+    both. Failures are logged and otherwise ignored.
+    """
+    try:
+        if os.getpriority(os.PRIO_PROCESS, 0) < BACKGROUND_NICENESS:
+            os.setpriority(os.PRIO_PROCESS, 0, BACKGROUND_NICENESS)
+    except OSError as e:
+        log.warning('Cannot lower the CPU priority: %s', e.strerror)
+    if sys.platform != 'darwin':
+        return
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.setiopolicy_np(IOPOL_TYPE_DISK, IOPOL_SCOPE_PROCESS, IOPOL_THROTTLE) != 0:
+        log.warning('Cannot lower the disk I/O priority: %s', os.strerror(ctypes.get_errno()))
+
+
+class RateLimiter:
+    """
+    Limit the rate of reads to ``rate`` bytes per second.
+
+    Up to one second worth of reads can be made at once. A read larger than that is let through
+    and the following reads wait until the average is back to ``rate``.
+    """
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        """Bytes allowed per second."""
+        self._available = rate
+        self._updated = monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, size: int) -> None:
+        """Wait until ``size`` bytes can be read."""
+        async with self._lock:
+            now = monotonic()
+            self._available = min(self.rate, self._available +
+                                  (now - self._updated) * self.rate) - size
+            self._updated = now
+            if self._available < 0:
+                await asyncio.sleep(-self._available / self.rate)
+
+
+class AdaptiveLimiter:
+    """
+    Limit the number of tasks running at once.
+
+    If ``adaptive`` is ``True``, the limit is adjusted after every window of ``limit`` completed
+    tasks. It grows towards ``max_limit`` while the moving average of task durations stays close to
+    the best average seen, and shrinks when it rises above
+    :py:data:`macprefs.constants.LATENCY_SLOWDOWN_FACTOR` times that.
+
+    Tasks that fail with ``EMFILE``, ``ENFILE`` or ``EAGAIN`` are retried with exponential backoff
+    and halve the limit, whether adaptive or not.
+    """
+    def __init__(self, limit: int, max_limit: int | None = None, *, adaptive: bool = False) -> None:
+        self.limit = max(1, limit)
+        """Current number of tasks allowed to run at once."""
+        self.max_limit = max(self.limit, max_limit or 0)
+        """Upper bound of :py:attr:`limit`."""
+        self.adaptive = adaptive
+        """Whether :py:attr:`limit` is adjusted from task durations."""
+        self.active = 0
+        """Number of running tasks."""
+        self._condition = asyncio.Condition()
+        self._average: float | None = None
+        self._best: float | None = None
+        self._completed = 0
+
+    @classmethod
+    def from_jobs(cls, jobs: Jobs) -> AdaptiveLimiter:
+        """
+        Create a limiter from a ``--jobs`` value.
+
+        Returns
+        -------
+        AdaptiveLimiter
+            An adaptive limiter bounded by :py:func:`auto_jobs` for ``'auto'``, a fixed one
+            otherwise.
+        """
+        if jobs == 'auto':
+            max_limit = auto_jobs()
+            log.debug('Using up to %d concurrent tasks.', max_limit)
+            return cls(min(MAX_CONCURRENT_EXPORT_TASKS, max_limit), max_limit, adaptive=True)
+        return cls(jobs)
+
+    async def run(self, func: Callable[P, Awaitable[T]], *args: P.args, **kwargs: P.kwargs) -> T:
+        """
+        Run a task when the limit allows.
+
+        Returns
+        -------
+        T
+            The result of the task.
+
+        Raises
+        ------
+        OSError
+            If the task fails with an error that is not retried, or still runs out of file
+            descriptors after :py:data:`macprefs.constants.FD_RETRY_ATTEMPTS` retries.
+        """
+        attempt = 0
+        while True:
+            async with self._condition:
+                await self._condition.wait_for(lambda: self.active < self.limit)
+                self.active += 1
+            start = perf_counter()
+            duration = None
+            try:
+                ret = await func(*args, **kwargs)
+                duration = perf_counter() - start
+            except OSError as e:
+                if e.errno not in RETRY_ERRNOS or attempt >= FD_RETRY_ATTEMPTS:
+                    raise
+                self.shrink()
+                delay = FD_RETRY_DELAY_SECONDS * 2 ** attempt
+                log.debug('%s. Retrying in %.2f s.', e.strerror, delay)
+            finally:
+                async with self._condition:
+                    self.active -= 1
+                    if duration is not None:
+                        self.record(duration)
+                    self._condition.notify_all()
+            if duration is not None:
+                return ret
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def shrink(self) -> None:
+        """Halve the limit and keep it there after running out of file descriptors or processes."""
+        self.limit = self.max_limit = max(1, min(self.limit, self.active) // 2)
+        log.debug('Reduced concurrency to %d.', self.limit)
+
+    def record(self, duration: float) -> None:
+        """Record the duration of a completed task and adjust the limit if adaptive."""
+        if not self.adaptive:
+            return
+        self._average = (duration if self._average is None else self._average + LATENCY_EWMA_ALPHA *
+                         (duration - self._average))
+        self._completed += 1
+        if self._completed < self.limit:
+            return
+        self._completed = 0
+        self._best = self._average if self._best is None else min(self._best, self._average)
+        if self._average > self._best * LATENCY_SLOWDOWN_FACTOR:
+            self.limit = max(1, self.limit * 3 // 4)
+        else:
+            self.limit = min(self.max_limit, self.limit + max(1, self.limit // 8))
+        log.debug('Concurrency is now %d (average task duration %.1f ms).', self.limit,
+                  self._average * 1000)
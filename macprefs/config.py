@@ -2,36 +2,337 @@
 from __future__ import annotations
 
 from collections.abc import Mapping, Sequence
+from dataclasses import dataclass, field
+from functools import cache
 from pathlib import Path
-from typing import Any
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, cast
 import logging
+import pickle  # ruff:ignore[suspicious-pickle-import]
+import re
+import sys
 
-import tomlkit
+from . import __version__
+from .constants import REGEX_STRESS_BUDGET_SECONDS
+from .exceptions import ConfigRegexError, ConfigTypeError
+from .processing import KeyFilter, make_domain_filter, make_key_filter
+from .tools import TOOL_NAMES
 
-from .exceptions import ConfigTypeError
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable
+
+    from .processing import DomainFilter, FilterStats
+    from .typing import Jobs, LockMode
+
+__all__ = ('load_config', 'make_configured_domain_filter', 'make_configured_key_filter',
+           'read_config')
 
 log = logging.getLogger(__name__)
 
+_GROUP_PREFIX_RE = re.compile(r'\?(?:[:=!]|<[=!]|P?<\w+>|P=\w+\)|[-aiLmsux]+[:)])')
+_LOOKAROUND_PREFIXES = ('?=', '?!', '?<=', '?<!')
+_REPEAT_RE = re.compile(r'\{(?=\d|,\d)(\d*)(,?)(\d*)\}')
+_SAMPLE_CHARACTERS = ''.join(map(chr, range(32, 127))) + '\t\n\xe9\u20ac'
+_STRESS_CHARACTERS = ('a', 'A', '0', '_', '-', '.', ' ')
+_ZERO_WIDTH_ESCAPES = frozenset('AbBZ')
 
-def read_config(config_file: Path | None = None) -> dict[str, Any]:
-    """
-    Read and validate the configuration file.
+
+@dataclass
+class _Atom:
+    """Character matcher or group of a regular expression, with its quantifier."""
+    token: str = ''
+    """Pattern of a single character matcher. Empty for a group."""
+    branches: list[list[_Atom]] = field(default_factory=list)
+    """Alternatives of a group."""
+    optional: bool = False
+    """Whether the quantifier allows zero repetitions."""
+    unbounded: bool = False
+    """Whether the quantifier has no upper bound."""
+
+
+def _parse_branches(pattern: str, i: int = 0) -> tuple[list[list[_Atom]], int]:
+    branches: list[list[_Atom]] = [[]]
+    while i < len(pattern) and pattern[i] != ')':
+        c = pattern[i]
+        atom = None
+        if c == '\\':
+            escaped = pattern[i + 1:i + 2]
+            if escaped not in _ZERO_WIDTH_ESCAPES:
+                # A backreference can match anything.
+                atom = _Atom('.' if escaped.isdigit() else pattern[i:i + 2])
+            i += 2
+        elif c == '[':
+            start = i
+            i += 1
+            if pattern[i:i + 1] == '^':
+                i += 1
+            if pattern[i:i + 1] == ']':
+                i += 1
+            while i < len(pattern) and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+            i += 1
+            atom = _Atom(pattern[start:i])
+        elif c == '(':
+            prefix = m.group() if (m := _GROUP_PREFIX_RE.match(pattern, i + 1)) else ''
+            i += 1 + len(prefix)
+            if prefix.endswith(')'):
+                atom = _Atom('.') if prefix.startswith('?P=') else None
+            else:
+                inner, i = _parse_branches(pattern, i)
+                i += 1
+                if not prefix.startswith(_LOOKAROUND_PREFIXES):
+                    atom = _Atom(branches=inner)
+        elif c == '|':
+            branches.append([])
+            i += 1
+        elif c in '*+?' or (c == '{' and _REPEAT_RE.match(pattern, i)):
+            i = _apply_quantifier(branches[-1], pattern, i)
+        elif c in '^$':
+            i += 1
+        else:
+            atom = _Atom(c)
+            i += 1
+        if atom:
+            branches[-1].append(atom)
+    return branches, i
+
+
+def _apply_quantifier(branch: list[_Atom], pattern: str, i: int) -> int:
+    if (m := _REPEAT_RE.match(pattern, i)):
+        optional = m.group(1) in {'', '0'}
+        unbounded = bool(m.group(2)) and not m.group(3)
+        i = m.end()
+    else:
+        optional = pattern[i] != '+'
+        unbounded = pattern[i] != '?'
+        i += 1
+    if branch:
+        branch[-1].optional = branch[-1].optional or optional
+        branch[-1].unbounded = branch[-1].unbounded or unbounded
+    # Lazy and possessive quantifiers
+    return i + 1 if pattern[i:i + 1] in {'?', '+'} else i
+
+
+def _is_nullable(atom: _Atom) -> bool:
+    return atom.optional or (not atom.token
+                             and any(all(_is_nullable(x) for x in b) for b in atom.branches))
+
+
+def _first_tokens(atoms: Sequence[_Atom]) -> list[str]:
+    ret: list[str] = []
+    for atom in atoms:
+        ret += [atom.token] if atom.token else [y for b in atom.branches for y in _first_tokens(b)]
+        if not _is_nullable(atom):
+            break
+    return ret
+
+
+def _all_tokens(atom: _Atom) -> list[str]:
+    return [atom.token
+            ] if atom.token else [y for b in atom.branches for x in b for y in _all_tokens(x)]
+
+
+def _repeats(atom: _Atom) -> bool:
+    return atom.unbounded or any(_repeats(x) for b in atom.branches for x in b)
+
+
+@cache
+def _token_characters(token: str) -> frozenset[str]:
+    try:
+        compiled = re.compile(token)
+    except re.error:
+        return frozenset(_SAMPLE_CHARACTERS)
+    return frozenset(c for c in _SAMPLE_CHARACTERS if compiled.fullmatch(c))
+
+
+def _overlap(a: Iterable[str], b: Iterable[str]) -> bool:
+    return not {c
+                for x in a
+                for c in _token_characters(x)}.isdisjoint(c for x in b
+                                                          for c in _token_characters(x))
+
+
+def _is_ambiguous_repetition(atom: _Atom) -> bool:
+    if atom.token or not atom.unbounded:
+        return False
+    firsts = [_first_tokens(b) for b in atom.branches]
+    if any(_overlap(x, y) for i, x in enumerate(firsts) for y in firsts[i + 1:]):
+        return True
+    for branch in atom.branches:
+        for i, inner in enumerate(branch):
+            if not _repeats(inner):
+                continue
+            rest = branch[i + 1:]
+            # Without a mandatory delimiter, the next repetition of the group follows.
+            follow = _first_tokens(rest) + ([] if any(not _is_nullable(x)
+                                                      for x in rest) else _first_tokens([atom]))
+            if _overlap(_all_tokens(inner), follow):
+                return True
+    return False
+
+
+def _has_ambiguous_repetition(pattern: str) -> bool:
+    r"""
+    Check for an unbounded repetition of a group that can match the same text in several ways.
+
+    This is the case if the group contains an unbounded repetition that can also match what
+    follows it, either in the group or at the start of the next repetition of the group, as in
+    ``(a+)+`` or ``(?:\w*_)*``. A mandatory delimiter that the inner repetition cannot match, as in
+    ``(?:\w+\.)+`` or ``(?:[A-Z][a-z]+)+``, makes the repetition unambiguous. It is also the case
+    if two alternatives of the group can start with the same character, as in ``(a|aa)*``. Such
+    patterns can backtrack exponentially on input that almost matches.
+
+    Character classes are compared on printable ASCII and a few other characters.
 
     Returns
     -------
-    dict[str, Any]
-        Parsed configuration, or an empty dict if no file was found.
+    bool
+        ``True`` if the pattern has an ambiguous unbounded repetition.
+    """
+    def walk(atoms: Iterable[_Atom]) -> bool:
+        return any(_is_ambiguous_repetition(x) or any(walk(b) for b in x.branches) for x in atoms)
+
+    return any(walk(b) for b in _parse_branches(pattern)[0])
+
+
+def _stress_corpus(length: int) -> list[str]:
+    return [
+        *(c * length + '\0' for c in _STRESS_CHARACTERS),
+        (''.join(_STRESS_CHARACTERS) * length)[:length] + '\0'
+    ]
+
+
+def _check_key_regex(key: str, pattern: str) -> None:
+    """
+    Compile a user key regular expression and check it for catastrophic backtracking.
+
+    A pattern with an ambiguous unbounded repetition is reported with a warning. Otherwise, the
+    pattern is timed against a stress corpus of increasingly long runs of common key characters
+    followed by a character that makes the match fail, which is the worst case for backtracking. A
+    pattern that takes longer than :py:data:`macprefs.constants.REGEX_STRESS_BUDGET_SECONDS` to
+    match a string of the corpus is also reported with a warning.
 
     Raises
     ------
-    ConfigTypeError
-        If the configuration structure is invalid.
+    ConfigRegexError
+        If the pattern does not compile.
     """
-    if not config_file or not config_file.exists():
-        log.debug('No configuration file found. Using defaults.')
-        return {}
-    log.debug('Parsing configuration file `%s`.', config_file)
-    config = tomlkit.loads(config_file.read_text()).get('tool', {}).get('macprefs', {})
+    try:
+        compiled = re.compile(pattern)
+    except re.error as e:
+        raise ConfigRegexError(key, pattern, str(e)) from e
+    if _has_ambiguous_repetition(pattern):
+        log.warning(
+            'Config key %s: regular expression `%s` repeats a group that can match the same text '
+            'in several ways. This can be very slow.', key, pattern)
+        return
+    for length in range(8, 34, 2):
+        for text in _stress_corpus(length):
+            start = perf_counter()
+            compiled.match(text)
+            if (elapsed := perf_counter() - start) > REGEX_STRESS_BUDGET_SECONDS:
+                log.warning(
+                    'Config key %s: regular expression `%s` took %.0f ms to match %d characters. '
+                    'This can slow down exports.', key, pattern, elapsed * 1000, len(text))
+                return
+
+
+def _check_key_regexes(config: Mapping[str, Any], prefix: str = '') -> None:
+    for key in ('extend-ignore-key-regexes', 'ignore-key-regexes'):
+        for pattern in config.get(key, ()):
+            _check_key_regex(f'{prefix}{key}', pattern)
+    for key in ('extend-ignore-keys', 'ignore-keys'):
+        for domain, values in config.get(key, {}).items():
+            for value in values:
+                if value.startswith('re:'):
+                    _check_key_regex(f'{prefix}{key}.{domain}', value[3:])
+
+
+def _check_bool(key: str, value: Any) -> bool:
+    if not isinstance(value, bool):
+        raise ConfigTypeError(key, 'boolean')
+    return value
+
+
+def _check_bytes_per_second(key: str, rate: Any) -> int:
+    if not isinstance(rate, int) or isinstance(rate, bool) or rate < 1:
+        raise ConfigTypeError(key, 'positive number of bytes per second')
+    return rate
+
+
+def _check_jobs(key: str, jobs: Any) -> Jobs:
+    if jobs != 'auto' and (not isinstance(jobs, int) or isinstance(jobs, bool) or jobs < 1):
+        raise ConfigTypeError(key, 'positive integer or "auto"')
+    return cast('Jobs', jobs)
+
+
+def _check_lock_mode(key: str, mode: Any) -> LockMode:
+    if mode not in {'coalesce', 'exit', 'wait'}:
+        raise ConfigTypeError(key, '"wait", "exit" or "coalesce"')
+    return cast('LockMode', mode)
+
+
+def _check_path(key: str, path: Any) -> str:
+    if not isinstance(path, str) or not path:
+        raise ConfigTypeError(key, 'path')
+    return str(Path(path).expanduser())
+
+
+def _check_seconds(key: str, seconds: Any) -> float:
+    if not isinstance(seconds, (int, float)) or isinstance(seconds, bool) or seconds <= 0:
+        raise ConfigTypeError(key, 'positive number of seconds')
+    return float(seconds)
+
+
+def _check_tools(key: str, tools: Any) -> dict[str, str]:
+    if not isinstance(tools, Mapping) or any(name not in TOOL_NAMES or not isinstance(path, str)
+                                             for name, path in tools.items()):
+        raise ConfigTypeError(key, f'table of paths with keys {", ".join(TOOL_NAMES)}')
+    return dict(tools)
+
+
+def _check_sinks(key: str, sinks: Any) -> list[dict[str, Any]]:
+    if not isinstance(sinks, Sequence) or isinstance(sinks, str) or any(
+            not isinstance(table, Mapping) or 'output-directory' not in table for table in sinks):
+        raise ConfigTypeError(key, 'array of tables with an output-directory')
+    return [
+        _check_table(table, _SINK_OPTION_CHECKS, f'{key}[{i}].') for i, table in enumerate(sinks)
+    ]
+
+
+_SINK_OPTION_CHECKS: dict[str, Callable[[str, Any], Any]] = {
+    'binary': _check_bool,
+    'canonical': _check_bool,
+    'commit': _check_bool,
+    'deploy-key': _check_path,
+    'output-directory': _check_path,
+    'skip-rejected': _check_bool
+}
+_OPTION_CHECKS: dict[str, Callable[[str, Any], Any]] = {
+    'background': _check_bool,
+    'binary': _check_bool,
+    'canonical': _check_bool,
+    'domain-timeout': _check_seconds,
+    'jobs': _check_jobs,
+    'lock': _check_lock_mode,
+    'metrics-file': _check_path,
+    'read-rate': _check_bytes_per_second,
+    'record-key-stats': _check_bool,
+    'sinks': _check_sinks,
+    'skip-rejected': _check_bool,
+    'timeout': _check_seconds,
+    'tools': _check_tools
+}
+
+
+def _check_table(config: Mapping[str, Any],
+                 checks: Mapping[str, Callable[[str, Any], Any]],
+                 prefix: str = '') -> dict[str, Any]:
     ret: dict[str, Any] = {
         'extend-ignore-keys': {},
         'extend-ignore-key-regexes': [],
@@ -39,29 +340,157 @@ def read_config(config_file: Path | None = None) -> dict[str, Any]:
         'extend-ignore-domains': []
     }
     for key in ('extend-ignore-keys', 'ignore-keys'):
+        name = f'{prefix}{key}'
         if key in config:
             if not isinstance(config[key], Mapping):
-                raise ConfigTypeError(key, 'dict of keys to lists of strings')
+                raise ConfigTypeError(name, 'dict of keys to lists of strings')
             for val in config[key].values():
                 if not isinstance(val, Sequence):
-                    raise ConfigTypeError(key, 'dict of keys to lists of strings')
+                    raise ConfigTypeError(name, 'dict of keys to lists of strings')
                 for v in val:
                     if not isinstance(v, str):
-                        raise ConfigTypeError(key, 'dict of keys to lists of strings')
+                        raise ConfigTypeError(name, 'dict of keys to lists of strings')
             ret[key] = config[key]
     for key in ('extend-ignore-key-regexes', 'extend-ignore-domain-prefixes',
                 'extend-ignore-domains', 'ignore-key-regexes', 'ignore-domain-prefixes',
                 'ignore-domains'):
+        name = f'{prefix}{key}'
         if key in config:
             if not isinstance(config[key], Sequence):
-                raise ConfigTypeError(key, 'list of strings')
+                raise ConfigTypeError(name, 'list of strings')
             for item in config[key]:
                 if not isinstance(item, str):
-                    raise ConfigTypeError(key, 'list of strings')
+                    raise ConfigTypeError(name, 'list of strings')
             ret[key] = config[key]
+    for key, check in checks.items():
+        if key in config:
+            ret[key] = check(f'{prefix}{key}', config[key])
+    _check_key_regexes(ret, prefix)
+    return ret
+
+
+def read_config(config_file: Path | None = None) -> dict[str, Any]:
+    """
+    Read and validate the configuration file.
+
+    Key regular expressions are compiled and checked for catastrophic backtracking. One that repeats
+    a group that can match the same text in several ways, or that is slow to match a stress corpus,
+    is reported with a warning.
+
+    Returns
+    -------
+    dict[str, Any]
+        Parsed configuration, or an empty dict if no file was found.
+
+    Raises
+    ------
+    ConfigRegexError
+        If a key regular expression does not compile.
+    ConfigTypeError
+        If the configuration structure is invalid.
+    """  # ruff:ignore[docstring-extraneous-exception]
+    if not config_file or not config_file.exists():
+        log.debug('No configuration file found. Using defaults.')
+        return {}
+    log.debug('Parsing configuration file `%s`.', config_file)
+    section = 'tool.macprefs'
+    config = tomllib.loads(config_file.read_text(encoding='utf-8')).get('tool', {}).get(
+        'macprefs', {})
+    if not isinstance(config, Mapping):
+        raise ConfigTypeError(section, 'table')
+    ret = _check_table(config, _OPTION_CHECKS)
     if 'deploy-key' in config:
         if not Path(config['deploy-key']).exists():
             log.warning('Deploy key `%s` does not exist.', config['deploy-key'])
         else:
             ret['deploy-key'] = config['deploy-key']
     return ret
+
+
+def make_configured_domain_filter(config: Mapping[str, Any]) -> DomainFilter:
+    """
+    Create the domain filter described by a configuration.
+
+    Returns
+    -------
+    DomainFilter
+        Predicate that returns ``True`` when a domain should be ignored.
+    """
+    return make_domain_filter(
+        {*config.get('extend-ignore-domains', []), *config.get('ignore-domains', [])}, {
+            *config.get('extend-ignore-domain-prefixes', []),
+            *config.get('ignore-domain-prefixes', [])
+        },
+        reset_domains='ignore-domains' in config,
+        reset_prefixes='ignore-domain-prefixes' in config)
+
+
+def make_configured_key_filter(config: Mapping[str, Any],
+                               stats: FilterStats | None = None) -> KeyFilter:
+    """
+    Create the key filter described by a configuration.
+
+    Returns
+    -------
+    KeyFilter
+        Predicate that returns ``True`` when a key should be ignored.
+    """
+    return make_key_filter(
+        {*config.get('extend-ignore-key-regexes', []), *config.get('ignore-key-regexes', [])}, {
+            **config.get('extend-ignore-keys', {}),
+            **config.get('ignore-keys', {})
+        },
+        reset_re='ignore-key-regexes' in config,
+        reset_bad_keys='ignore-keys' in config,
+        stats=stats)
+
+
+def load_config(config_file: Path | None = None,
+                cache_file: Path | None = None) -> tuple[dict[str, Any], KeyFilter]:
+    """
+    Read the configuration and create its key filter.
+
+    If ``cache_file`` is given, the validated configuration and the compiled key filter are stored
+    in it, keyed by the path, modification time and size of the configuration file and the macprefs
+    version. Later calls with an unchanged file skip parsing, validation and compilation. The cache
+    is optional: if it cannot be read or written, the configuration is read as usual.
+
+    Returns
+    -------
+    tuple[dict[str, Any], KeyFilter]
+        The configuration as returned by :py:func:`read_config` and the key filter as returned by
+        :py:func:`make_configured_key_filter`.
+    """
+    cache_key = None
+    if cache_file and config_file and config_file.exists():
+        stat = config_file.stat()
+        cache_key = (str(config_file.resolve()), stat.st_mtime_ns, stat.st_size, __version__)
+        try:
+            cached = pickle.loads(cache_file.read_bytes())  # ruff:ignore[suspicious-pickle-usage]
+        except Exception:
+            # A truncated or foreign file can fail in many ways. Any of them is a cache miss.
+            log.debug('Ignoring unreadable configuration cache `%s`.', cache_file, exc_info=True)
+            cached = None
+        if (isinstance(cached, dict) and cached.get('key') == cache_key
+                and isinstance(cached.get('config'), dict)
+                and isinstance(cached.get('key_filter'), KeyFilter)):
+            log.debug('Using cached configuration `%s`.', cache_file)
+            return cached['config'], cached['key_filter']
+    config = read_config(config_file)
+    key_filter = make_configured_key_filter(config)
+    if cache_file and cache_key:
+        log.debug('Caching configuration in `%s`.', cache_file)
+        tmp = cache_file.with_name(f'{cache_file.name}.tmp')
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp.write_bytes(
+                pickle.dumps({
+                    'key': cache_key,
+                    'config': config,
+                    'key_filter': key_filter
+                },
+                             protocol=pickle.HIGHEST_PROTOCOL))
+            tmp.replace(cache_file)
+        except OSError:
+            log.debug('Cannot write the configuration cache `%s`.', cache_file, exc_info=True)
+    return config, key_filter
@@ -1,11 +1,90 @@
 """Constants."""
 from __future__ import annotations
 
-__all__ = ('GLOBAL_DOMAIN_ARG', 'MAX_CONCURRENT_EXPORT_TASKS')
+__all__ = ('BACKGROUND_JOBS', 'BACKGROUND_NICENESS', 'BACKGROUND_READ_BYTES_PER_SECOND',
+           'CONFIG_CACHE_FILENAME', 'EXPORT_TASK_FDS', 'FD_RETRY_ATTEMPTS',
+           'FD_RETRY_DELAY_SECONDS', 'GIT_ATTRIBUTES_PLIST_LINE', 'GIT_TIMEOUT_SECONDS',
+           'GLOBAL_DOMAIN_ARG', 'JOBS_PER_CPU', 'JOURNAL_FILENAME', 'KEY_STATS_FILENAME',
+           'LATENCY_EWMA_ALPHA', 'LATENCY_SLOWDOWN_FACTOR', 'LAUNCHCTL_TIMEOUT_SECONDS',
+           'LOCK_FILENAME', 'LOCK_POLL_INTERVAL_SECONDS', 'MAX_CONCURRENT_EXPORT_TASKS',
+           'MAX_CONCURRENT_SUBPROCESSES', 'NEGATIVE_CACHE_FILENAME', 'PLIST_TEXTCONV_COMMAND',
+           'PLUTIL_TIMEOUT_SECONDS', 'REGEX_STRESS_BUDGET_SECONDS',
+           'REJECTED_SCRIPTS_DIRECTORY_NAME', 'RERUN_REQUEST_FILENAME', 'RESERVED_FDS',
+           'SCRIPTS_DIRECTORY_NAME', 'SNAPSHOT_CACHE_MAX_BYTES', 'SNAPSHOT_FILENAME',
+           'STATE_DIRECTORY_NAME', 'WATCH_DEBOUNCE_SECONDS', 'WATCH_MAX_DELAY_SECONDS',
+           'WATCH_POLL_INTERVAL_SECONDS')
 
+BACKGROUND_JOBS = 2
+"""Number of domains exported at once in background mode unless set otherwise."""
+BACKGROUND_NICENESS = 10
+"""Niceness of the process and its subprocesses in background mode."""
+BACKGROUND_READ_BYTES_PER_SECOND = 8 * 1024 * 1024
+"""Rate at which property lists are read in background mode unless set otherwise."""
+CONFIG_CACHE_FILENAME = 'config-cache.pickle'
+"""Name of the compiled configuration cache in the user cache directory."""
+EXPORT_TASK_FDS = 4
+"""Estimated number of file descriptors used by one export or conversion task."""
+FD_RETRY_ATTEMPTS = 6
+"""Number of times a task is retried when it runs out of file descriptors or processes."""
+FD_RETRY_DELAY_SECONDS = 0.05
+"""Delay before the first retry of a task that ran out of file descriptors. Doubles each retry."""
+GIT_ATTRIBUTES_PLIST_LINE = 'Preferences/*.plist diff=plist'
+"""Line added to ``.gitattributes`` so Git uses the ``plist`` diff driver for exported files."""
+GIT_TIMEOUT_SECONDS = 300
+"""Time after which a Git command is killed. Pushing over a slow connection may take a while."""
 GLOBAL_DOMAIN_ARG = '-globalDomain'
 """Global domain argument for the defaults command."""
+JOBS_PER_CPU = 8
+"""Maximum number of concurrent export tasks per CPU in ``auto`` mode."""
+JOURNAL_FILENAME = 'journal.jsonl'
+"""Name of the file in the state directory recording the domains finished by a running export."""
+KEY_STATS_FILENAME = 'key-stats.json'
+"""Name of the key statistics file in the state directory."""
+LATENCY_EWMA_ALPHA = 0.2
+"""Weight of the latest task duration in the moving average used in ``auto`` mode."""
+LATENCY_SLOWDOWN_FACTOR = 2.0
+"""In ``auto`` mode, concurrency is reduced when tasks take this many times longer than the best
+average seen."""
+LAUNCHCTL_TIMEOUT_SECONDS = 30
+"""Time after which a ``launchctl`` command is killed."""
+LOCK_FILENAME = 'run.lock'
+"""Name of the run lock file in the state directory."""
+LOCK_POLL_INTERVAL_SECONDS = 1.0
+"""Time between attempts to take the run lock while waiting for another export."""
 MAX_CONCURRENT_EXPORT_TASKS = 40
-"""Maximum number of concurrent export tasks."""
+"""Initial number of concurrent export tasks in ``auto`` mode."""
+MAX_CONCURRENT_SUBPROCESSES = 16
+"""Number of subprocesses (``git``, ``plutil``, ``launchctl``) allowed to run at once."""
+NEGATIVE_CACHE_FILENAME = 'negative-cache.json'
+"""Name of the file in the state directory listing property lists that could not be read."""
 OUTPUT_FILE_MAXIMUM_LINE_LENGTH = 120
 """Maximum line length for output files."""
+PLIST_TEXTCONV_COMMAND = 'macprefs-plist-textconv'
+"""Command configured as the ``textconv`` program of the ``plist`` Git diff driver."""
+PLUTIL_TIMEOUT_SECONDS = 60
+"""Time after which a ``plutil`` conversion is killed."""
+REGEX_STRESS_BUDGET_SECONDS = 0.05
+"""Time a user key regular expression may take to match one string of the stress corpus before a
+warning is logged."""
+REJECTED_SCRIPTS_DIRECTORY_NAME = 'rejected'
+"""Name of the directory in the scripts directory that holds the fragments of
+``rejected-defaults.sh``."""
+RERUN_REQUEST_FILENAME = 'rerun-requested'
+"""Name of the file in the state directory that asks the running export to export again."""
+RESERVED_FDS = 32
+"""File descriptors kept free for other uses when sizing concurrency from ``RLIMIT_NOFILE``."""
+SCRIPTS_DIRECTORY_NAME = 'scripts'
+"""Name of the directory in the output directory that holds the per-domain fragments of
+``exec-defaults.sh``."""
+SNAPSHOT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+"""Maximum size of the roots stored in the snapshot cache."""
+SNAPSHOT_FILENAME = 'snapshot.bin'
+"""Name of the snapshot cache file in the state directory."""
+STATE_DIRECTORY_NAME = '.macprefs'
+"""Name of the directory in the output directory that holds local state. It is ignored by Git."""
+WATCH_DEBOUNCE_SECONDS = 2.0
+"""In watch mode, time without further changes before exporting."""
+WATCH_MAX_DELAY_SECONDS = 30.0
+"""In watch mode, maximum time to wait for changes to settle before exporting anyway."""
+WATCH_POLL_INTERVAL_SECONDS = 5.0
+"""In watch mode, time between scans of the preferences directory if no change is signalled."""
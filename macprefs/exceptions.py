@@ -13,3 +13,10 @@ class ConfigTypeError(RuntimeError):
     """Configuration error."""
     def __init__(self, key: str, expected_type: str) -> None:
         super().__init__(f'Config key {key} must be of type {expected_type}.')
+
+
+class ConfigRegexError(RuntimeError):
+    """Configuration error for a regular expression that is invalid or too slow."""
+    def __init__(self, key: str, pattern: str, reason: str) -> None:
+        super().__init__(f'Config key {key} has an unusable regular expression `{pattern}`: '
+                         f'{reason}.')
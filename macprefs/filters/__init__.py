@@ -1,8 +1,29 @@
-"""Filters."""
+"""
+Filters.
+
+The tables are loaded from their modules on first access.
+"""
 from __future__ import annotations
 
-from .bad_domains import BAD_DOMAINS, BAD_DOMAIN_PREFIXES
-from .bad_keys import BAD_KEYS
-from .bad_keys_re import BAD_KEYS_RE
+from importlib import import_module
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from .bad_domains import BAD_DOMAINS, BAD_DOMAIN_PREFIXES
+    from .bad_keys import BAD_KEYS
+    from .bad_keys_re import BAD_KEYS_RE, BAD_KEYS_RE_PATTERNS
+
+__all__ = ('BAD_DOMAINS', 'BAD_DOMAIN_PREFIXES', 'BAD_KEYS', 'BAD_KEYS_RE', 'BAD_KEYS_RE_PATTERNS')
+
 
-__all__ = ('BAD_DOMAINS', 'BAD_DOMAIN_PREFIXES', 'BAD_KEYS', 'BAD_KEYS_RE')
+def __getattr__(name: str) -> Any:
+    if name in {'BAD_DOMAINS', 'BAD_DOMAIN_PREFIXES'}:
+        module = 'bad_domains'
+    elif name == 'BAD_KEYS':
+        module = 'bad_keys'
+    elif name in {'BAD_KEYS_RE', 'BAD_KEYS_RE_PATTERNS'}:
+        module = 'bad_keys_re'
+    else:
+        msg = f'module {__name__!r} has no attribute {name!r}'
+        raise AttributeError(msg)
+    return getattr(import_module(f'.{module}', __name__), name)
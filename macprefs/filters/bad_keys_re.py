@@ -1,10 +1,10 @@
 """Keys to ignore based on a regular expression."""
 from __future__ import annotations
 
-__all__ = ('BAD_KEYS_RE',)
+__all__ = ('BAD_KEYS_RE', 'BAD_KEYS_RE_PATTERNS')
 
 # spell-checker: disable
-BAD_KEYS_RE = '^(' + '|'.join({
+BAD_KEYS_RE_PATTERNS = frozenset({
     '(?:Favorites|Recents|SkinTones):com.apple.CharacterPicker.DefaultDataStorage',
     '(?:NSWindow|MASPreferences) Frame', 'CKPerBootTasks', 'CKStartupTime', 'DidShowFDEWarning',
     'GEOUsageSessionIDGenerationTime', 'last-messagetrace-stamp', 'LastRunAppBundlePath',
@@ -17,4 +17,7 @@ BAD_KEYS_RE = '^(' + '|'.join({
     'QtUi.MainWin(?:Geometry|State|Pos|Size)', 'recentFilesList', 'SPSelfBeaconUUIDKey',
     'SUEnableAutomaticChecks', 'SULastCheckTime', 'TSAICloudAuthorNameKey',
     'TSKRemote(?:Defaults|Strings)ETag', r'QuickLookPreview_[A-Z0-9-\.]+'
-}) + r')\b'
+})
+"""Patterns matched at the start of a key, up to a word boundary."""
+BAD_KEYS_RE = '^(' + '|'.join(BAD_KEYS_RE_PATTERNS) + r')\b'
+"""All of :py:data:`BAD_KEYS_RE_PATTERNS` as one regular expression."""
@@ -0,0 +1,122 @@
+"""Crash-safe run state and atomic file writes."""
+from __future__ import annotations
+
+from pathlib import Path
+from typing import IO, TYPE_CHECKING
+import json
+import logging
+
+if TYPE_CHECKING:
+    import os
+
+__all__ = ('RunJournal', 'atomic_write')
+
+log = logging.getLogger(__name__)
+
+
+def atomic_write(path: os.PathLike[str] | str, data: bytes | str, mode: int | None = None) -> None:
+    """
+    Replace a file with new content in one step.
+
+    The content is written to a hidden temporary file in the same directory, which is then renamed
+    over ``path``. Readers and later runs see either the old or the new content, never a partial
+    file, even if the process is killed. If ``mode`` is given, it is applied before the rename.
+    """
+    path = Path(path)
+    tmp = path.with_name(f'.{path.name}.tmp')
+    if isinstance(data, str):
+        tmp.write_text(data, encoding='utf-8')
+    else:
+        tmp.write_bytes(data)
+    if mode is not None:
+        tmp.chmod(mode)
+    tmp.replace(path)
+
+
+class RunJournal:
+    """
+    Domains finished by an export that has not completed yet.
+
+    The journal is a JSON lines file. The first line holds the fingerprint of the options of the
+    run, each following line a domain whose property list and script fragments were written, with
+    the size and modification time of its source. Lines are flushed as they are written so that
+    they survive the process being killed. An incomplete last line is ignored.
+    """
+    def __init__(self, path: Path | None = None, fingerprint: str = '') -> None:
+        self.path = path
+        """File the journal is written to."""
+        self.fingerprint = fingerprint
+        """Fingerprint of the options that affect the exported files."""
+        self.entries: dict[str, tuple[int, int, bool]] = {}
+        """Mapping of domain to source size, modification time and whether it had content."""
+        self._file: IO[str] | None = None
+
+    @classmethod
+    def load(cls, path: Path, fingerprint: str) -> RunJournal:
+        """
+        Load the journal of an interrupted run.
+
+        Returns
+        -------
+        RunJournal
+            The journal. It has no entries if the file does not exist, is invalid or was written
+            with a different fingerprint.
+        """
+        ret = cls(path, fingerprint)
+        try:
+            lines = path.read_text(encoding='utf-8').splitlines()
+        except FileNotFoundError:
+            return ret
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            header = {}
+        if not isinstance(header, dict) or header.get('fingerprint') != fingerprint:
+            log.debug('Ignoring journal `%s` written with different options.', path)
+            return ret
+        for line in lines[1:]:
+            try:
+                domain, size, mtime_ns, exported = json.loads(line)
+            except (TypeError, ValueError):
+                log.debug('Ignoring incomplete journal line `%s`.', line)
+                continue
+            ret.entries[domain] = (size, mtime_ns, exported)
+        return ret
+
+    def open(self, *, resume: bool = False) -> None:
+        """Start recording finished domains. Unless ``resume`` is ``True``, entries are cleared."""
+        if not self.path:
+            return
+        if not resume or not self.entries:
+            self.entries = {}
+            atomic_write(self.path, json.dumps({'fingerprint': self.fingerprint}) + '\n')
+        self._file = self.path.open('a', encoding='utf-8')
+
+    def completed(self, domain: str, stat: os.stat_result) -> bool | None:
+        """
+        Check if a domain was finished and its source has not changed since.
+
+        Returns
+        -------
+        bool | None
+            ``None`` if the domain has to be exported. Otherwise whether it had content.
+        """
+        entry = self.entries.get(domain)
+        if entry is None or entry[:2] != (stat.st_size, stat.st_mtime_ns):
+            return None
+        return entry[2]
+
+    def record(self, domain: str, stat: os.stat_result, *, exported: bool) -> None:
+        """Record a finished domain."""
+        self.entries[domain] = (stat.st_size, stat.st_mtime_ns, exported)
+        if self._file:
+            self._file.write(json.dumps([domain, stat.st_size, stat.st_mtime_ns, exported]) + '\n')
+            self._file.flush()
+
+    def close(self, *, remove: bool = False) -> None:
+        """Stop recording. With ``remove``, delete the journal because the run completed."""
+        if self._file:
+            self._file.close()
+            self._file = None
+        if remove and self.path:
+            self.path.unlink(missing_ok=True)
@@ -0,0 +1,189 @@
+"""Single-instance run lock of an output directory."""
+from __future__ import annotations
+
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, Any
+import asyncio
+import fcntl
+import logging
+import os
+
+from .constants import LOCK_FILENAME, LOCK_POLL_INTERVAL_SECONDS, RERUN_REQUEST_FILENAME
+from .utils import prefs_export, setup_output_directory, setup_state_directory
+
+if TYPE_CHECKING:
+    from anyio import Path as AnyioPath
+
+    from .report import ExportReport
+    from .typing import LockMode
+
+__all__ = ('RunLock', 'locked_export')
+
+log = logging.getLogger(__name__)
+
+
+class RunLock:
+    """
+    Lock that lets only one export at a time use an output directory.
+
+    The lock is an advisory :py:func:`fcntl.flock` lock on a file in the state directory. The
+    operating system releases it when the process exits, so a crashed export never leaves a stale
+    lock behind. The file holds the process ID of the holder for diagnostics.
+
+    An export that finds the lock taken can ask the holder to export again once it finishes by
+    creating a request file next to it. See :py:meth:`request_rerun`.
+    """
+    def __init__(self, state_dir: Path) -> None:
+        self.path = state_dir / LOCK_FILENAME
+        """Lock file."""
+        self.rerun_path = state_dir / RERUN_REQUEST_FILENAME
+        """File whose existence asks the holder to export again."""
+        self._file: IO[str] | None = None
+
+    @property
+    def held(self) -> bool:
+        """Whether this instance holds the lock."""
+        return self._file is not None
+
+    @property
+    def rerun_requested(self) -> bool:
+        """Whether another export asked the holder to export again."""
+        return self.rerun_path.exists()
+
+    def acquire(self) -> bool:
+        """
+        Try to take the lock without waiting.
+
+        Returns
+        -------
+        bool
+            ``True`` if the lock was taken, ``False`` if another process holds it.
+        """
+        if self._file is not None:
+            return True
+        f = self.path.open('a+', encoding='utf-8')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        f.seek(0)
+        f.truncate()
+        f.write(f'{os.getpid()}\n')
+        f.flush()
+        self._file = f
+        log.debug('Took the run lock %s.', self.path)
+        return True
+
+    def holder(self) -> str:
+        """
+        Get the process ID written by the holder of the lock.
+
+        Returns
+        -------
+        str
+            The process ID, or an empty string if it is not known.
+        """
+        try:
+            return self.path.read_text(encoding='utf-8').strip()
+        except FileNotFoundError:
+            return ''
+
+    def release(self) -> None:
+        """Release the lock if this instance holds it."""
+        if self._file is None:
+            return
+        self._file.seek(0)
+        self._file.truncate()
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+        log.debug('Released the run lock %s.', self.path)
+
+    def request_rerun(self) -> None:
+        """Ask the holder of the lock to export again once it finishes."""
+        self.rerun_path.touch()
+
+    def take_rerun_request(self) -> bool:
+        """
+        Consume a request to export again.
+
+        Returns
+        -------
+        bool
+            ``True`` if an export was requested since the last call.
+        """
+        try:
+            self.rerun_path.unlink()
+        except FileNotFoundError:
+            return False
+        return True
+
+
+async def _take_lock(lock: RunLock, lock_mode: LockMode) -> bool:
+    if lock.acquire():
+        return True
+    holder = lock.holder() or 'unknown'
+    match lock_mode:
+        case 'exit':
+            log.info('Another export (process %s) is running. Exiting.', holder)
+            return False
+        case 'coalesce':
+            lock.request_rerun()
+            if lock.acquire():
+                # The holder finished in the meantime and the export about to start handles the
+                # request.
+                lock.take_rerun_request()
+                return True
+            log.info(
+                'Another export (process %s) is running. It will export again when it '
+                'finishes.', holder)
+            return False
+    log.info('Waiting for another export (process %s) to finish.', holder)
+    # The holder is another process, so there is nothing to wait on but the lock itself.
+    while not lock.acquire():  # ruff:ignore[async-busy-wait]
+        await asyncio.sleep(LOCK_POLL_INTERVAL_SECONDS)
+    return True
+
+
+async def locked_export(out_dir: AnyioPath,
+                        *args: Any,
+                        lock_mode: LockMode = 'wait',
+                        **kwargs: Any) -> ExportReport | None:
+    """
+    Run :py:func:`macprefs.utils.prefs_export` while holding the run lock of the output directory.
+
+    Only one export at a time can hold the lock. See :py:class:`RunLock`. If another
+    export holds it, ``lock_mode`` decides what happens:
+
+    - ``'wait'``: wait until the other export finishes, then export.
+    - ``'exit'``: return without exporting.
+    - ``'coalesce'``: ask the other export to export again once it finishes, and return.
+
+    While holding the lock, requests made by other exports are handled by exporting again. A request
+    made while the lock is being released is handled by taking the lock again. Requests are never
+    discarded without an export. Other arguments are passed to
+    :py:func:`macprefs.utils.prefs_export`.
+
+    Returns
+    -------
+    ExportReport | None
+        The report of the last export, or ``None`` if this call did not export.
+    """
+    out_dir, _ = await setup_output_directory(out_dir)
+    lock = RunLock(Path(await setup_state_directory(out_dir)))
+    if not await _take_lock(lock, lock_mode):
+        return None
+    try:
+        while True:
+            report = await prefs_export(out_dir, *args, **kwargs)
+            if not lock.take_rerun_request():
+                lock.release()
+                # A coalescing export may have asked between the check and the release and failed
+                # to take the lock. Handle its request unless another export took the lock since.
+                if not lock.rerun_requested or not lock.acquire():
+                    return report
+                lock.take_rerun_request()
+            log.info('Exporting again as requested by another export.')
+    finally:
+        lock.release()
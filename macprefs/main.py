@@ -1,63 +1,301 @@
-"""Main entry points for macprefs CLI."""
+"""
+Main entry points for macprefs CLI.
+
+Only :py:mod:`click` is imported at module level. Everything else, including the filter tables, is
+imported by the command that needs it so that ``--help``, configuration errors and launchd
+invocations start quickly.
+"""
 from __future__ import annotations
 
 from pathlib import Path
-import asyncio
+from typing import TYPE_CHECKING
 import logging
 
-from anyio import Path as AnyioPath
-from bascom import setup_logging
-from platformdirs import user_config_path, user_data_path
 import click
 
-from .config import read_config
-from .utils import install_job as do_install_job, prefs_export
+from .constants import (
+    BACKGROUND_JOBS,
+    BACKGROUND_READ_BYTES_PER_SECOND,
+    CONFIG_CACHE_FILENAME,
+    KEY_STATS_FILENAME,
+    STATE_DIRECTORY_NAME,
+)
+
+if TYPE_CHECKING:
+    from .typing import Jobs, LockMode
 
-__all__ = ('main',)
+__all__ = ('install_job', 'main', 'plist_textconv')
 
 log = logging.getLogger(__name__)
 
 
+def _default_config_file() -> Path:
+    from platformdirs import user_config_path
+    return user_config_path('macprefs') / 'config.toml'
+
+
+def _config_cache_file() -> Path:
+    from platformdirs import user_cache_path
+    return user_cache_path('macprefs') / CONFIG_CACHE_FILENAME
+
+
+def _default_output_directory() -> Path:
+    from platformdirs import user_data_path
+    return user_data_path('macprefs')
+
+
+def _parse_jobs(_ctx: click.Context, _param: click.Parameter, value: str | None) -> Jobs | None:
+    if value is None:
+        return None
+    if value == 'auto':
+        return 'auto'
+    try:
+        jobs = int(value)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        msg = 'must be a positive integer or "auto".'
+        raise click.BadParameter(msg)
+    return jobs
+
+
+def _setup_logging(*, debug: bool) -> None:
+    from bascom import setup_logging
+    setup_logging(debug=debug,
+                  loggers={
+                      'macprefs': {
+                          'level': 'DEBUG' if debug else 'INFO',
+                          'handlers': ('console',),
+                          'propagate': False
+                      }
+                  })
+
+
 @click.command('prefs-export', context_settings={'help_option_names': ['-h', '--help']})
 @click.option('-C',
               '--config',
               'config_file',
               help='Path to the configuration file.',
               type=click.Path(dir_okay=False, path_type=Path),
-              default=user_config_path('macprefs') / 'config.toml')
+              default=_default_config_file)
 @click.option('-K',
               '--deploy-key',
               help='Key for pushing to Git repository.',
-              type=click.Path(dir_okay=False, exists=True, path_type=AnyioPath, resolve_path=True))
+              type=click.Path(dir_okay=False, exists=True, path_type=Path, resolve_path=True))
+@click.option('--background',
+              help=('Lower the CPU and disk I/O priority and export fewer domains at once at a '
+                    'limited read rate so that other work is not slowed down.'),
+              is_flag=True)
+@click.option('-b',
+              '--binary',
+              help='Store property lists in binary format. Git diffs still show XML.',
+              is_flag=True)
+@click.option('--canonical',
+              help='Write property lists in a deterministic form to avoid spurious changes.',
+              is_flag=True)
+@click.option('--check',
+              help=('Report which domains changed semantically or only byte-wise without writing '
+                    'anything. Exits with status 1 if any domain changed semantically.'),
+              is_flag=True)
+@click.option('--clear-negative-cache',
+              help='Retry property lists that previously could not be read or parsed.',
+              is_flag=True)
 @click.option('-c', '--commit', help='Commit the changes with Git.', is_flag=True)
 @click.option('-d', '--debug', help='Enable debug logging.', is_flag=True)
+@click.option('-D',
+              '--domain',
+              'domains',
+              help='Only export this domain. Can be given more than once.',
+              metavar='DOMAIN',
+              multiple=True)
+@click.option('--domain-timeout',
+              help=('Give up on a domain after this many seconds and keep its previous export.'),
+              metavar='SECONDS',
+              type=click.FloatRange(min=0, min_open=True))
+@click.option('--domain-glob',
+              'domain_globs',
+              help='Only export domains matching this shell pattern. Can be given more than once.',
+              metavar='PATTERN',
+              multiple=True)
+@click.option('--filter-stats',
+              'show_filter_stats',
+              help=('Print hit counts of the ignore rules, rules that never matched and the '
+                    'slowest key patterns after exporting.'),
+              is_flag=True)
+@click.option(
+    '--find-volatile-keys',
+    'find_volatile',
+    help=('Print an extend-ignore-keys block for keys whose values changed on almost every '
+          'run recorded with --record-key-stats.'),
+    is_flag=True)
+@click.option(
+    '-j',
+    '--jobs',
+    help=('Number of domains to export at once, or "auto" (default) to size it from the CPU '
+          'count and file descriptor limit and adjust it while running.'),
+    metavar='N|auto',
+    callback=_parse_jobs)
+@click.option('--lock',
+              'lock_mode',
+              help=('What to do if another export is using the output directory: wait for it '
+                    '(default), exit with status 75, or ask it to export again when it finishes '
+                    'and exit.'),
+              type=click.Choice(['wait', 'exit', 'coalesce']))
+@click.option('--metrics-file',
+              help=('Write counters and durations of the export to this file in the OpenMetrics '
+                    'text format, for example for the textfile collector of the node exporter.'),
+              type=click.Path(dir_okay=False, path_type=Path, resolve_path=True))
+@click.option('--no-config-cache',
+              help='Do not use or update the cache of the compiled configuration.',
+              is_flag=True)
+@click.option('--plan',
+              help=('Print the keys and line counts each domain would change in the generated '
+                    'scripts without writing anything or running plutil or Git.'),
+              is_flag=True)
+@click.option('--read-rate',
+              help=('Read property lists at no more than this many bytes per second. Defaults to '
+                    f'{BACKGROUND_READ_BYTES_PER_SECOND // 1048576} MiB with --background, '
+                    'unlimited otherwise.'),
+              metavar='BYTES',
+              type=click.IntRange(min=1))
+@click.option('--record-key-stats',
+              help='Record value changes of accepted keys to find volatile keys.',
+              is_flag=True)
+@click.option('--resume',
+              help=('Continue an interrupted export. Domains it finished are skipped unless they '
+                    'changed since.'),
+              is_flag=True)
+@click.option('--skip-rejected',
+              help=('Do not write rejected-defaults.sh. Ignored keys are dropped while parsing.'),
+              is_flag=True)
+@click.option('-t',
+              '--timeout',
+              help=('Give up on the domains not exported after this many seconds and keep their '
+                    'previous export. Converting and committing the others still happens.'),
+              metavar='SECONDS',
+              type=click.FloatRange(min=0, min_open=True))
+@click.option('-w',
+              '--watch',
+              help=('Keep running and export again a few seconds after preferences change. Only '
+                    'changed domains are exported again.'),
+              is_flag=True)
 @click.option('-o',
               '--output-directory',
-              default=user_data_path('macprefs'),
+              default=_default_output_directory,
               help='Where to store the exported data.',
-              type=click.Path(file_okay=False, path_type=AnyioPath, resolve_path=True))
-def main(output_directory: AnyioPath,
+              type=click.Path(file_okay=False, path_type=Path, resolve_path=True))
+def main(output_directory: Path,
          config_file: Path,
-         deploy_key: AnyioPath | None = None,
+         deploy_key: Path | None = None,
          *,
+         background: bool = False,
+         binary: bool = False,
+         canonical: bool = False,
+         check: bool = False,
+         clear_negative_cache: bool = False,
          commit: bool = False,
-         debug: bool = False) -> None:
-    """Export preferences."""
-    setup_logging(debug=debug,
-                  loggers={
-                      'macprefs': {
-                          'level': 'DEBUG' if debug else 'INFO',
-                          'handlers': ('console',),
-                          'propagate': False
-                      }
-                  })
-    config = read_config(config_file)
-    config_deploy_key = config.get('deploy-key')
-    co = prefs_export(AnyioPath(output_directory),
-                      config,
-                      deploy_key or (AnyioPath(config_deploy_key) if config_deploy_key else None),
-                      commit=commit or config.get('commit', False))
-    asyncio.run(co, debug=debug)
+         debug: bool = False,
+         domain_globs: tuple[str, ...] = (),
+         domain_timeout: float | None = None,
+         domains: tuple[str, ...] = (),
+         find_volatile: bool = False,
+         jobs: Jobs | None = None,
+         lock_mode: LockMode | None = None,
+         metrics_file: Path | None = None,
+         no_config_cache: bool = False,
+         plan: bool = False,
+         read_rate: int | None = None,
+         record_key_stats: bool = False,
+         resume: bool = False,
+         show_filter_stats: bool = False,
+         skip_rejected: bool = False,
+         timeout: float | None = None,
+         watch: bool = False) -> None:
+    """Export preferences."""  # ruff:ignore[docstring-missing-exception]
+    import asyncio
+
+    from anyio import Path as AnyioPath
+
+    from .config import load_config
+    from .lock import locked_export
+    from .plan import plan_export
+    from .processing import FilterStats
+    from .tools import set_tool_paths
+    from .utils import check_export
+    from .watch import watch_export
+    _setup_logging(debug=debug)
+    config, key_filter = load_config(config_file, None if no_config_cache else _config_cache_file())
+    set_tool_paths(config.get('tools', {}))
+    binary = binary or config.get('binary', False)
+    if check:
+        changes = asyncio.run(check_export(AnyioPath(output_directory),
+                                           config,
+                                           binary=binary,
+                                           canonical=canonical or config.get('canonical', False)),
+                              debug=debug)
+        for domain, kind in changes.items():
+            click.echo(f'{kind}: {domain}')
+        if any(kind != 'byte-wise' for kind in changes.values()):
+            raise click.exceptions.Exit(1)
+        return
+    if plan:
+        plans = asyncio.run(plan_export(AnyioPath(output_directory),
+                                        config,
+                                        jobs=jobs or config.get('jobs', 'auto'),
+                                        key_filter=key_filter,
+                                        skip_rejected=skip_rejected
+                                        or config.get('skip-rejected', False)),
+                            debug=debug)
+        for domain_plan in plans:
+            click.echo(domain_plan.report(), nl=False)
+        click.echo(f'{len(plans)} domain(s) would change.')
+        return
+    if find_volatile:
+        from .stats import find_volatile_keys, load_key_stats, volatile_keys_toml
+        stats = load_key_stats(Path(output_directory) / STATE_DIRECTORY_NAME / KEY_STATS_FILENAME)
+        click.echo(volatile_keys_toml(find_volatile_keys(stats, key_filter)), nl=False)
+        return
+    if background := background or config.get('background', False):
+        from .concurrency import lower_priority
+        lower_priority()
+    key = deploy_key or config.get('deploy-key')
+    metrics_file = metrics_file or config.get('metrics-file')
+    filter_stats = FilterStats() if show_filter_stats else None
+    lock_mode = lock_mode or config.get('lock', 'wait')
+    export = watch_export if watch else locked_export
+    co = export(
+        AnyioPath(output_directory),
+        config,
+        AnyioPath(key) if key else None,
+        binary=binary,
+        canonical=canonical or config.get('canonical', False),
+        clear_negative_cache=clear_negative_cache,
+        commit=commit or config.get('commit', False),
+        domain_globs=domain_globs,
+        domain_timeout=domain_timeout or config.get('domain-timeout'),
+        domains=domains,
+        filter_stats=filter_stats,
+        jobs=jobs or config.get('jobs', BACKGROUND_JOBS if background else 'auto'),
+        key_filter=key_filter,
+        lock_mode=lock_mode,
+        metrics_file=AnyioPath(metrics_file) if metrics_file else None,
+        read_rate=read_rate
+        or config.get('read-rate', BACKGROUND_READ_BYTES_PER_SECOND if background else None),
+        record_stats=record_key_stats or config.get('record-key-stats', False),
+        resume=resume,
+        run_timeout=timeout or config.get('timeout'),
+        skip_rejected=skip_rejected or config.get('skip-rejected', False))
+    report = None
+    try:
+        report = asyncio.run(co, debug=debug)
+    except KeyboardInterrupt:
+        if not watch:
+            raise
+        log.debug('Stopped watching.')
+    if filter_stats is not None:
+        click.echo(filter_stats.report(), nl=False)
+    if report is None and lock_mode == 'exit' and not watch:
+        raise click.exceptions.Exit(75)
 
 
 @click.command('macprefs-install-job', context_settings={'help_option_names': ['-h', '--help']})
@@ -66,35 +304,59 @@ def main(output_directory: AnyioPath,
               'config_file',
               help='Path to the configuration file.',
               type=click.Path(dir_okay=False, path_type=Path),
-              default=user_config_path('macprefs') / 'config.toml')
+              default=_default_config_file)
 @click.option('-K',
               '--deploy-key',
               help='Key for pushing to Git repository.',
-              type=click.Path(dir_okay=False, exists=True, resolve_path=True, path_type=AnyioPath))
+              type=click.Path(dir_okay=False, exists=True, resolve_path=True, path_type=Path))
 @click.option('-d', '--debug', help='Enable debug logging.', is_flag=True)
+@click.option('-w',
+              '--watch',
+              help='Run prefs-export --watch continuously instead of exporting every night.',
+              is_flag=True)
 @click.option('-o',
               '--output-directory',
-              default=str(user_data_path('macprefs')),
+              default=_default_output_directory,
               help='Where to store the exported data.',
               type=click.Path(file_okay=False, resolve_path=True, path_type=Path))
-def install_job(output_directory: AnyioPath,
+def install_job(output_directory: Path,
                 config_file: Path,
-                deploy_key: AnyioPath | None = None,
+                deploy_key: Path | None = None,
                 *,
-                debug: bool = False) -> None:
+                debug: bool = False,
+                watch: bool = False) -> None:
     """Job installer."""  # ruff:ignore[docstring-missing-exception]
-    setup_logging(debug=debug,
-                  loggers={
-                      'macprefs': {
-                          'level': 'DEBUG' if debug else 'INFO',
-                          'handlers': ('console',),
-                          'propagate': False
-                      }
-                  })
+    import asyncio
+
+    from anyio import Path as AnyioPath
+
+    from .config import read_config
+    from .tools import set_tool_paths
+    from .utils import install_job as do_install_job
+    _setup_logging(debug=debug)
     config = read_config(config_file)
-    config_deploy_key = config.get('deploy-key')
-    if asyncio.run(do_install_job(
-            output_directory, deploy_key
-            or (AnyioPath(config_deploy_key) if config_deploy_key else None)),
+    set_tool_paths(config.get('tools', {}))
+    key = deploy_key or config.get('deploy-key')
+    if asyncio.run(do_install_job(AnyioPath(output_directory),
+                                  AnyioPath(key) if key else None,
+                                  watch=watch),
                    debug=debug) != 0:
         raise click.Abort
+
+
+@click.command('macprefs-plist-textconv', context_settings={'help_option_names': ['-h', '--help']})
+@click.argument('file', type=click.Path(dir_okay=False, exists=True, path_type=Path))
+def plist_textconv(file: Path) -> None:
+    """
+    Print a property list as XML.
+
+    Used as the ``textconv`` program of the ``plist`` Git diff driver. Files that cannot be
+    represented as XML are printed unchanged.
+    """
+    import plistlib
+    data = file.read_bytes()
+    try:
+        data = plistlib.dumps(plistlib.loads(data), fmt=plistlib.PlistFormat.FMT_XML)
+    except (plistlib.InvalidFileException, OverflowError, TypeError, ValueError) as e:
+        log.debug('Cannot convert `%s` to XML: %s', file, e)
+    click.echo(data, nl=False)
@@ -0,0 +1,177 @@
+"""Planning of an export without writing anything."""
+from __future__ import annotations
+
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any
+import asyncio
+import shlex
+
+from .concurrency import AdaptiveLimiter
+from .config import make_configured_key_filter
+from .plist2defaults import plist_to_defaults_commands
+from .processing import rejected_fields
+from .utils import _generate_configured_domains, _largest_first, _parse_source
+
+if TYPE_CHECKING:
+    from collections.abc import Mapping
+
+    from anyio import Path
+
+    from .processing import KeyFilter
+    from .typing import Jobs
+
+__all__ = ('DomainPlan', 'diff_scripts', 'plan_export', 'script_commands')
+
+
+@dataclass
+class DomainPlan:
+    """Changes an export would make to one domain of the generated scripts."""
+    domain: str
+    """Domain name as passed to ``defaults write``."""
+    added: list[str] = field(default_factory=list)
+    """Keys that would be added to ``exec-defaults.sh``."""
+    removed: list[str] = field(default_factory=list)
+    """Keys that would be removed from ``exec-defaults.sh``."""
+    changed: list[str] = field(default_factory=list)
+    """Keys whose command in ``exec-defaults.sh`` would change."""
+    lines: tuple[int, int] = (0, 0)
+    """Number of command lines of the domain in ``exec-defaults.sh`` before and after."""
+    rejected_lines: tuple[int, int] = (0, 0)
+    """Number of command lines of the domain in ``rejected-defaults.sh`` before and after."""
+    def report(self) -> str:
+        """
+        Format the changes for display.
+
+        Returns
+        -------
+        str
+            A summary line followed by one line per added, removed or changed key.
+        """
+        lines = [
+            (f'{self.domain}: {len(self.added)} added, {len(self.removed)} removed, '
+             f'{len(self.changed)} changed; exec-defaults.sh {self.lines[0]} -> {self.lines[1]} '
+             f'lines, rejected-defaults.sh {self.rejected_lines[0]} -> {self.rejected_lines[1]} '
+             'lines\n')
+        ]
+        for sign, keys in (('+', self.added), ('-', self.removed), ('~', self.changed)):
+            lines.extend(f'  {sign} {key}\n' for key in keys)
+        return ''.join(lines)
+
+
+def script_commands(text: str) -> dict[str, dict[str, str]]:
+    """
+    Split a script generated by macprefs into its ``defaults write`` commands.
+
+    Commands may span several lines, either with a trailing backslash or inside a quoted value.
+    Other lines are ignored.
+
+    Returns
+    -------
+    dict[str, dict[str, str]]
+        Mapping of domain to mapping of key to the text of its command.
+    """
+    ret: defaultdict[str, dict[str, str]] = defaultdict(dict)
+    command = ''
+    for line in text.splitlines():
+        if not command and not line.startswith('defaults write '):
+            continue
+        command = f'{command}\n{line}' if command else line
+        try:
+            args = shlex.split(command)
+        except ValueError:
+            continue
+        match args:
+            case ['defaults', 'write', domain, key, *_]:
+                ret[domain][key] = command
+        command = ''
+    return dict(ret)
+
+
+def _line_count(commands: Mapping[str, str]) -> int:
+    return sum(command.count('\n') + 1 for command in commands.values())
+
+
+def diff_scripts(before: Mapping[str, Mapping[str, str]], after: Mapping[str, Mapping[str, str]],
+                 rejected_before: Mapping[str, Mapping[str, str]],
+                 rejected_after: Mapping[str, Mapping[str, str]]) -> list[DomainPlan]:
+    """
+    Compare the commands of the generated scripts before and after an export.
+
+    The arguments are the results of :py:func:`script_commands` for ``exec-defaults.sh`` and
+    ``rejected-defaults.sh``.
+
+    Returns
+    -------
+    list[DomainPlan]
+        The domains whose commands differ, sorted by name.
+    """
+    plans = []
+    for domain in sorted({*before, *after, *rejected_before, *rejected_after}):
+        old = before.get(domain, {})
+        new = after.get(domain, {})
+        old_rejected = rejected_before.get(domain, {})
+        new_rejected = rejected_after.get(domain, {})
+        if old == new and old_rejected == new_rejected:
+            continue
+        plans.append(
+            DomainPlan(domain,
+                       added=sorted(new.keys() - old.keys()),
+                       removed=sorted(old.keys() - new.keys()),
+                       changed=sorted(
+                           key for key in old.keys() & new.keys() if old[key] != new[key]),
+                       lines=(_line_count(old), _line_count(new)),
+                       rejected_lines=(_line_count(old_rejected), _line_count(new_rejected))))
+    return plans
+
+
+async def _read_script(path: Path) -> dict[str, dict[str, str]]:
+    try:
+        return script_commands(await path.read_text())
+    except FileNotFoundError:
+        return {}
+
+
+async def plan_export(out_dir: Path,
+                      config: Mapping[str, Any] | None = None,
+                      *,
+                      jobs: Jobs = 'auto',
+                      key_filter: KeyFilter | None = None,
+                      skip_rejected: bool = False) -> list[DomainPlan]:
+    """
+    Compute what an export would change in the generated scripts without writing.
+
+    The property lists are read from their source and parsed, filtered and rendered in memory. No
+    file is copied or written and neither ``plutil`` nor Git is run. The rendered commands are
+    compared with ``exec-defaults.sh`` and ``rejected-defaults.sh`` in the output directory. Options
+    have the same meaning as for :py:func:`macprefs.utils.prefs_export`.
+
+    Returns
+    -------
+    list[DomainPlan]
+        The domains whose commands would change, sorted by name.
+    """
+    config = config or {}
+    if key_filter is None:
+        key_filter = make_configured_key_filter(config)
+    limiter = AdaptiveLimiter.from_jobs(jobs)
+    all_data = await asyncio.gather(*(
+        limiter.run(_parse_source, domain, key_filter=key_filter, keep_rejected=not skip_rejected)
+        for domain in await _largest_first([x
+                                            async for x in _generate_configured_domains(config)])))
+    exec_lines: list[str] = []
+    rejected_lines: list[str] = []
+    for domain, root in all_data:
+        if not root:
+            continue
+        exec_lines.extend(plist_to_defaults_commands(domain, root, key_filter))
+        if not skip_rejected:
+            rejected_lines.extend(
+                plist_to_defaults_commands(domain,
+                                           rejected_fields(root, key_filter, domain),
+                                           key_filter,
+                                           invert_filters=True))
+    return diff_scripts(await _read_script(out_dir / 'exec-defaults.sh'),
+                        script_commands('\n'.join(exec_lines)), await
+                        _read_script(out_dir / 'rejected-defaults.sh'),
+                        script_commands('\n'.join(rejected_lines)))
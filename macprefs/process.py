@@ -0,0 +1,172 @@
+"""Bounded subprocess execution."""
+from __future__ import annotations
+
+from collections import Counter, defaultdict
+from contextlib import suppress
+from dataclasses import dataclass, field
+from pathlib import PurePath
+from shlex import join
+from subprocess import CalledProcessError, CompletedProcess, TimeoutExpired
+from time import perf_counter
+from typing import TYPE_CHECKING
+from weakref import WeakKeyDictionary
+import asyncio
+import asyncio.subprocess as sp
+import logging
+import os
+
+from .constants import MAX_CONCURRENT_SUBPROCESSES
+
+if TYPE_CHECKING:
+    from collections.abc import Mapping
+
+__all__ = ('ProcessRunner', 'ProcessStats', 'default_runner', 'run_process')
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class ProcessStats:
+    """Counters of the subprocesses run by a :py:class:`ProcessRunner`, keyed by program name."""
+    spawns: Counter[str] = field(default_factory=Counter)
+    """Number of processes started."""
+    seconds: defaultdict[str, float] = field(default_factory=lambda: defaultdict(float))
+    """Total wall time of the processes, including waiting for their output."""
+    exit_codes: Counter[tuple[str, int]] = field(default_factory=Counter)
+    """Number of processes that exited with each status."""
+    timeouts: Counter[str] = field(default_factory=Counter)
+    """Number of processes killed after their timeout."""
+    def report(self) -> str:
+        """
+        Format the counters for display.
+
+        Returns
+        -------
+        str
+            One line per program.
+        """
+        lines = []
+        for program, count in sorted(self.spawns.items()):
+            codes = ', '.join(f'{code}: {n}' for (name, code), n in sorted(self.exit_codes.items())
+                              if name == program)
+            lines.append(f'{program}: {count} run(s) in {self.seconds[program]:.2f} s, exit codes '
+                         f'{{{codes}}}, {self.timeouts[program]} timed out\n')
+        return ''.join(lines)
+
+
+class ProcessRunner:
+    """
+    Run subprocesses with a cap on how many run at once.
+
+    Output is always captured and drained while the process runs, so a process that writes a lot to
+    standard output or standard error cannot block on a full pipe.
+    """
+    def __init__(self, limit: int = MAX_CONCURRENT_SUBPROCESSES) -> None:
+        self.limit = max(1, limit)
+        """Number of subprocesses allowed to run at once."""
+        self.stats = ProcessStats()
+        """Counters of the subprocesses run so far."""
+        self._semaphores: WeakKeyDictionary[asyncio.AbstractEventLoop,
+                                            asyncio.Semaphore] = WeakKeyDictionary()
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if (semaphore := self._semaphores.get(loop)) is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.limit)
+        return semaphore
+
+    async def run(self,
+                  *args: str | os.PathLike[str],
+                  check: bool = False,
+                  cwd: str | os.PathLike[str] | None = None,
+                  env: Mapping[str, str] | None = None,
+                  stdin: bytes | None = None,
+                  timeout: float | None = None) -> CompletedProcess[bytes]:
+        """
+        Run a command when the limit allows and wait for it to exit.
+
+        ``stdin`` is written to the standard input of the process. Otherwise standard input is
+        ``/dev/null``.
+
+        Returns
+        -------
+        subprocess.CompletedProcess[bytes]
+            The arguments, exit status and captured output.
+
+        Raises
+        ------
+        subprocess.CalledProcessError
+            If ``check`` is ``True`` and the command exits with a non-zero status.
+        subprocess.TimeoutExpired
+            If the command runs longer than ``timeout`` seconds. The process is killed, as it is
+            when the calling task is cancelled.
+        """
+        argv = [os.fspath(x) for x in args]
+        program = PurePath(argv[0]).name
+        async with self._semaphore():
+            log.debug('Running: %s', join(argv))
+            start = perf_counter()
+            p = await sp.create_subprocess_exec(*argv,
+                                                cwd=cwd,
+                                                env=env,
+                                                stdin=sp.DEVNULL if stdin is None else sp.PIPE,
+                                                stdout=sp.PIPE,
+                                                stderr=sp.PIPE)
+            self.stats.spawns[program] += 1
+            try:
+                stdout, stderr = await asyncio.wait_for(p.communicate(stdin), timeout)
+            except asyncio.TimeoutError:
+                self.stats.timeouts[program] += 1
+                raise TimeoutExpired(argv, timeout or 0) from None
+            finally:
+                if p.returncode is None:
+                    # Timed out or cancelled. The process must not outlive the caller.
+                    with suppress(ProcessLookupError):
+                        p.kill()
+                    await p.wait()
+                self.stats.seconds[program] += perf_counter() - start
+        returncode = p.returncode if p.returncode is not None else -1
+        self.stats.exit_codes[program, returncode] += 1
+        if returncode != 0:
+            log.debug('`%s` exited with status %d: %s', program, returncode,
+                      stderr.decode(errors='replace').strip())
+            if check:
+                raise CalledProcessError(returncode, argv, stdout, stderr)
+        return CompletedProcess(argv, returncode, stdout, stderr)
+
+
+_default_runner = ProcessRunner()
+
+
+def default_runner() -> ProcessRunner:
+    """
+    Get the runner shared by all of macprefs.
+
+    Returns
+    -------
+    ProcessRunner
+        The runner used by :py:func:`run_process`.
+    """
+    return _default_runner
+
+
+async def run_process(*args: str | os.PathLike[str],
+                      check: bool = False,
+                      cwd: str | os.PathLike[str] | None = None,
+                      env: Mapping[str, str] | None = None,
+                      stdin: bytes | None = None,
+                      timeout: float | None = None) -> CompletedProcess[bytes]:
+    """
+    Run a command with the shared runner. See :py:meth:`ProcessRunner.run`.
+
+    Returns
+    -------
+    subprocess.CompletedProcess[bytes]
+        The arguments, exit status and captured output.
+    """
+    return await _default_runner.run(*args,
+                                     check=check,
+                                     cwd=cwd,
+                                     env=env,
+                                     stdin=stdin,
+                                     timeout=timeout)
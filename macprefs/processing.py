@@ -1,60 +1,253 @@
 """Processing utilities."""
 from __future__ import annotations
 
-from copy import deepcopy
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from time import perf_counter
 from typing import TYPE_CHECKING, Any, cast
 import logging
 import re
 
-from .filters import BAD_KEYS
-from .filters.bad_keys_re import BAD_KEYS_RE
-
 if TYPE_CHECKING:
     from collections.abc import Callable, Iterable, Mapping
 
     from .typing import PlistList, PlistRoot
 
-__all__ = ('make_key_filter', 'remove_data_fields', 'remove_data_fields_list')
+__all__ = ('DomainFilter', 'FilterStats', 'KeyFilter', 'make_domain_filter', 'make_key_filter',
+           'rejected_fields', 'remove_data_fields', 'remove_data_fields_list')
 
 log = logging.getLogger(__name__)
 
 
+@dataclass
+class FilterStats:
+    """Hit counts and regular expression timings of the domain and key filters."""
+    rules: set[str] = field(default_factory=set)
+    """All known rules."""
+    rule_hits: Counter[str] = field(default_factory=Counter)
+    """Number of domains or keys each rule matched."""
+    rule_seconds: dict[str, float] = field(default_factory=lambda: defaultdict(float))
+    """Time spent matching each regular expression rule."""
+    domain_hits: Counter[str] = field(default_factory=Counter)
+    """Number of ignored keys per domain."""
+    keys_checked: int = 0
+    """Number of keys checked."""
+    def add_rules(self, rules: Iterable[str]) -> None:
+        """Register rules so that they are reported if they never match."""
+        self.rules.update(rules)
+
+    def hit(self, rule: str, domain: str | None = None) -> None:
+        """Record a match of a rule, optionally for a key in ``domain``."""
+        self.rule_hits[rule] += 1
+        if domain is not None:
+            self.domain_hits[domain] += 1
+
+    def dead_rules(self) -> list[str]:
+        """
+        List rules that never matched.
+
+        Returns
+        -------
+        list[str]
+            Sorted rule names.
+        """
+        return sorted(self.rules - set(self.rule_hits))
+
+    def most_expensive(self, limit: int = 10) -> list[tuple[str, float]]:
+        """
+        List the regular expressions that took the longest time to match.
+
+        Returns
+        -------
+        list[tuple[str, float]]
+            Rule names and total seconds, slowest first.
+        """
+        return sorted(self.rule_seconds.items(), key=lambda x: (-x[1], x[0]))[:limit]
+
+    def report(self, limit: int = 10) -> str:
+        """
+        Format the statistics for display.
+
+        Returns
+        -------
+        str
+            The report.
+        """
+        dead = self.dead_rules()
+        lines = [
+            f'Keys checked: {self.keys_checked}, ignored: {self.domain_hits.total()}.',
+            f'Dead rules ({len(dead)} of {len(self.rules)}):', *(f'  {x}' for x in dead),
+            'Most expensive patterns:', *(f'  {seconds * 1000:9.3f} ms  {rule}'
+                                          for rule, seconds in self.most_expensive(limit)),
+            'Ignored keys per domain:', *(f'  {count:6d}  {domain}'
+                                          for domain, count in self.domain_hits.most_common(limit))
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+class KeyFilter:
+    """
+    Predicate that returns ``True`` when a key should be ignored.
+
+    Decisions are cached per domain and key, so the second pass that writes rejected values costs a
+    dictionary lookup.
+
+    If ``stats`` is given, every rule is evaluated separately so hits and regular expression
+    timings can be attributed to individual rules. This is slower and meant for diagnostics.
+    """
+    def __init__(self,
+                 key_patterns: Iterable[str],
+                 bad_keys: Mapping[str, Iterable[str]],
+                 stats: FilterStats | None = None) -> None:
+        self.key_patterns = sorted(set(key_patterns))
+        """Regular expressions matched against keys of all domains."""
+        self.key_re = re.compile('|'.join(self.key_patterns)) if self.key_patterns else None
+        """:py:attr:`key_patterns` combined."""
+        self.bad_keys = {
+            domain: frozenset(x for x in keys if not x.startswith('re:'))
+            for domain, keys in bad_keys.items()
+        }
+        """Keys to ignore per domain."""
+        self.bad_key_res = {
+            domain: tuple(re.compile(x[3:]) for x in sorted(keys) if x.startswith('re:'))
+            for domain, keys in bad_keys.items()
+        }
+        """Regular expressions of keys to ignore per domain."""
+        self.stats = stats
+        """Statistics to update, if any."""
+        self._cache: dict[tuple[str, str], bool] = {}
+        if stats is not None:
+            stats.add_rules(f're:{x}' for x in self.key_patterns)
+            stats.add_rules(f'{domain}[{key}]' for domain, keys in bad_keys.items() for key in keys)
+        log.debug('Ignored keys RE: %s', self.key_re.pattern if self.key_re else '')
+
+    def __getstate__(self) -> dict[str, Any]:
+        """Get the state for pickling, without the decision cache or statistics."""  # ruff:ignore[docstring-missing-returns]
+        return {**self.__dict__, '_cache': {}, 'stats': None}
+
+    def __call__(self, domain: str, key: str) -> bool:
+        """Check if a key should be ignored."""  # ruff:ignore[docstring-missing-returns]
+        cache_key = (domain, key)
+        if (ret := self._cache.get(cache_key)) is None:
+            ret = self._cache[cache_key] = (self._check_with_stats(domain, key)
+                                            if self.stats is not None else self._check(domain, key))
+        return ret
+
+    def _check(self, domain: str, key: str) -> bool:
+        if self.key_re and self.key_re.match(key):
+            log.debug('Skipping %s[%s] because it matched the ignored keys RE.', domain, key)
+            return True
+        if key in self.bad_keys.get(domain, ()):
+            log.debug('Skipping %s[%s] because it matched the ignored keys dict.', domain, key)
+            return True
+        for x in self.bad_key_res.get(domain, ()):
+            if x.match(key):
+                log.debug('Skipping %s[%s] because it matched regular expression.', key, domain)
+                return True
+        return False
+
+    def _check_with_stats(self, domain: str, key: str) -> bool:
+        stats = cast('FilterStats', self.stats)
+        stats.keys_checked += 1
+        matched = []
+        for pattern in self.key_patterns:
+            start = perf_counter()
+            if re.match(pattern, key):
+                matched.append(f're:{pattern}')
+            stats.rule_seconds[f're:{pattern}'] += perf_counter() - start
+        if key in self.bad_keys.get(domain, ()):
+            matched.append(f'{domain}[{key}]')
+        for x in self.bad_key_res.get(domain, ()):
+            start = perf_counter()
+            if x.match(key):
+                matched.append(f'{domain}[re:{x.pattern}]')
+            stats.rule_seconds[f'{domain}[re:{x.pattern}]'] += perf_counter() - start
+        for rule in matched:
+            stats.hit(rule)
+        if matched:
+            log.debug('Skipping %s[%s] because it matched %s.', domain, key, ', '.join(matched))
+            stats.domain_hits[domain] += 1
+        return bool(matched)
+
+
 def make_key_filter(bad_keys_re_addendum: Iterable[str] | None = None,
-                    bad_keys_addendum: Mapping[str, set[str]] | None = None,
+                    bad_keys_addendum: Mapping[str, Iterable[str]] | None = None,
                     *,
                     reset_re: bool = False,
-                    reset_bad_keys: bool = False) -> Callable[[str, str], bool]:
+                    reset_bad_keys: bool = False,
+                    stats: FilterStats | None = None) -> KeyFilter:
     """
     Create a function to filter out ignored keys.
 
+    The built-in filter tables are loaded on the first call.
+
     Returns
     -------
-    Callable[[str, str], bool]
+    KeyFilter
         Predicate that returns ``True`` when a key should be ignored.
     """
-    bad_keys_re = ('|'.join(set(bad_keys_re_addendum or [])) if reset_re else f'{BAD_KEYS_RE}|' +
-                   '|'.join(set(bad_keys_re_addendum or []))).rstrip('|')
+    from .filters import BAD_KEYS, BAD_KEYS_RE_PATTERNS  # ruff:ignore[import-outside-top-level]
+    key_patterns = {*(bad_keys_re_addendum or [])}
+    if not reset_re:
+        key_patterns.update(rf'^(?:{x})\b' for x in BAD_KEYS_RE_PATTERNS)
     bad_keys = (bad_keys_addendum or {}) if reset_bad_keys else {
         **BAD_KEYS,
         **(bad_keys_addendum or {})
     }
-    log.debug('Ignored keys RE: %s', bad_keys_re)
+    return KeyFilter(key_patterns, bad_keys, stats)
+
+
+class DomainFilter:
+    """
+    Predicate that returns ``True`` when a domain should be ignored.
+
+    The domain is the name of the property list in ``~/Library/Preferences`` without the
+    extension. A filter holds no state between calls and can be reused by any number of exports.
+    """
+    def __init__(self, bad_domains: Iterable[str], bad_domain_prefixes: Iterable[str]) -> None:
+        self.bad_domains = frozenset(bad_domains)
+        """Domains to ignore."""
+        self.bad_domain_prefixes = tuple(sorted(set(bad_domain_prefixes)))
+        """Prefixes of domains to ignore."""
+
+    def __call__(self, domain: str) -> bool:
+        """Check if a domain should be ignored."""  # ruff:ignore[docstring-missing-returns]
+        return domain in self.bad_domains or domain.startswith(self.bad_domain_prefixes)
+
+
+def make_domain_filter(bad_domains_addendum: Iterable[str] | None = None,
+                       bad_domain_prefixes_addendum: Iterable[str] | None = None,
+                       *,
+                       reset_domains: bool = False,
+                       reset_prefixes: bool = False) -> DomainFilter:
+    """
+    Create a function to filter out ignored domains.
+
+    The built-in filter tables are loaded on the first call.
+
+    Returns
+    -------
+    DomainFilter
+        Predicate that returns ``True`` when a domain should be ignored.
+    """
+    from .filters import BAD_DOMAINS, BAD_DOMAIN_PREFIXES  # ruff:ignore[import-outside-top-level]
+    bad_domains = {*(bad_domains_addendum or [])}
+    if not reset_domains:
+        bad_domains.update(BAD_DOMAINS)
+    bad_domain_prefixes = {*(bad_domain_prefixes_addendum or [])}
+    if not reset_prefixes:
+        bad_domain_prefixes.update(BAD_DOMAIN_PREFIXES)
+    return DomainFilter(bad_domains, bad_domain_prefixes)
 
-    def should_ignore_key(domain: str, key: str) -> bool:
-        if bad_keys_re and re.match(bad_keys_re, key):
-            log.debug('Skipping %s[%s] because it matched the ignored keys RE.', domain, key)
-            return True
-        if domain in bad_keys and key in bad_keys[domain]:
-            log.debug('Skipping %s[%s] because it matched the ignored keys dict.', domain, key)
-            return True
-        if domain in bad_keys:
-            for x in {y for y in bad_keys[domain] if y.startswith('re:')}:
-                if re.match(x[3:], key):
-                    log.debug('Skipping %s[%s] because it matched regular expression.', key, domain)
-                    return True
-        return False
 
-    return should_ignore_key
+def _is_empty_after_cleaning(value: Any) -> bool:
+    if isinstance(value, bytes):
+        return True
+    if isinstance(value, list):
+        return all(_is_empty_after_cleaning(x) for x in value)
+    if isinstance(value, dict):
+        return all(_is_empty_after_cleaning(x) for x in value.values())
+    return False
 
 
 def remove_data_fields_list(pl_list: PlistList) -> PlistList:
@@ -68,7 +261,7 @@ def remove_data_fields_list(pl_list: PlistList) -> PlistList:
     """
     ret: list[Any] = []
     for value in pl_list:
-        val: Any = deepcopy(value)
+        val: Any = value
         if isinstance(value, bytes):
             continue
         if isinstance(value, list):
@@ -81,10 +274,19 @@ def remove_data_fields_list(pl_list: PlistList) -> PlistList:
     return cast('PlistList', ret)
 
 
-def remove_data_fields(root: PlistRoot) -> PlistRoot:
+def remove_data_fields(root: PlistRoot,
+                       key_filter: Callable[[str, str], bool] | None = None,
+                       domain: str = '',
+                       *,
+                       keep_rejected: bool = True) -> PlistRoot:
     """
     Clean up data fields from a :py:class:`macprefs.typing.PlistRoot`.
 
+    If ``key_filter`` is given, it is applied to the top-level keys of ``domain`` while cleaning.
+    Ignored keys are not cleaned. They are kept as they are if they would not be empty after
+    cleaning, so they can be cleaned later with :py:func:`rejected_fields` if they are written at
+    all. If ``keep_rejected`` is ``False``, they are dropped.
+
     Returns
     -------
     PlistRoot
@@ -92,14 +294,35 @@ def remove_data_fields(root: PlistRoot) -> PlistRoot:
     """
     ret: dict[str, Any] = {}
     for key, value in root.items():
-        val: Any = deepcopy(value)
+        if key_filter and key_filter(domain, key):
+            if keep_rejected and not _is_empty_after_cleaning(value):
+                ret[key] = value
+            continue
+        val: Any = value
         if isinstance(value, bytes):
             continue
         if isinstance(value, list):
-            val = remove_data_fields_list(cast('PlistList', val))
+            val = remove_data_fields_list(cast('PlistList', value))
         elif isinstance(value, dict):
-            val = remove_data_fields(cast('PlistRoot', val))
+            val = remove_data_fields(cast('PlistRoot', value))
         if isinstance(value, list | dict) and not val:
             continue
         ret[key] = val
     return cast('PlistRoot', ret)
+
+
+def rejected_fields(root: PlistRoot, key_filter: Callable[[str, str], bool],
+                    domain: str) -> PlistRoot:
+    """
+    Get the ignored keys of a root returned by :py:func:`remove_data_fields`, cleaned.
+
+    Returns
+    -------
+    PlistRoot
+        The ignored keys with data fields removed.
+    """
+    return remove_data_fields(
+        cast('PlistRoot', {
+            k: v
+            for k, v in root.items() if key_filter(domain, k)
+        }))
@@ -0,0 +1,146 @@
+"""Summary of an export run."""
+from __future__ import annotations
+
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from time import perf_counter, time
+from typing import TYPE_CHECKING
+import resource
+import sys
+
+if TYPE_CHECKING:
+    from collections.abc import Generator
+
+__all__ = ('ExportReport', 'peak_rss_bytes')
+
+
+def peak_rss_bytes() -> int:
+    """
+    Get the peak resident set size of the current process.
+
+    Returns
+    -------
+    int
+        The peak resident set size in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kibibytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+@dataclass
+class ExportReport:
+    """What happened during a call to :py:func:`macprefs.utils.prefs_export`."""
+    failed: list[str] = field(default_factory=list)
+    """Domains whose property list could not be converted, sorted by name."""
+    resumed: list[str] = field(default_factory=list)
+    """Domains skipped because an interrupted run had finished them, sorted by name."""
+    timed_out: list[str] = field(default_factory=list)
+    """Domains that were not exported in time and kept their previous export, sorted by name."""
+    domains_scanned: int = 0
+    """Number of domains considered after the domain filters and selection."""
+    domains_exported: int = 0
+    """Number of domains with an export, including the ones reused from the snapshot."""
+    bytes_read: int = 0
+    """Size of the property lists that were copied and parsed."""
+    bytes_written: int = 0
+    """Size of the property lists, script fragments and scripts that were written."""
+    keys_accepted: int = 0
+    """Number of top-level keys written to ``exec-defaults.sh``."""
+    keys_rejected: int = 0
+    """Number of top-level keys ignored by the key filter and kept for ``rejected-defaults.sh``."""
+    subprocesses: int = 0
+    """Number of subprocesses started."""
+    peak_rss_bytes: int = 0
+    """Peak resident set size of the process at the end of the run."""
+    stage_seconds: defaultdict[str, float] = field(default_factory=lambda: defaultdict(float))
+    """Wall time of each stage of the run."""
+    success: bool = False
+    """Whether the run completed."""
+    def report(self) -> str:
+        """
+        Format the report for display.
+
+        Returns
+        -------
+        str
+            One line per problem. Empty if there was none.
+        """
+        return ''.join([
+            *(f'Failed to convert: {domain}\n' for domain in self.failed),
+            *(f'Timed out: {domain}\n' for domain in self.timed_out)
+        ])
+
+    @property
+    def domains_skipped(self) -> int:
+        """Number of domains without content, skipped by the negative cache or resumed."""
+        return max(
+            0,
+            self.domains_scanned - self.domains_exported - len(self.failed) - len(self.timed_out))
+
+    @contextmanager
+    def stage(self, name: str) -> Generator[None, None, None]:
+        """Add the wall time of the block to the stage ``name``."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[name] += perf_counter() - start
+
+    def openmetrics(self, timestamp: float | None = None) -> str:
+        """
+        Format the report as an OpenMetrics text exposition.
+
+        The output is also valid Prometheus text format and can be read by the textfile collector
+        of the node exporter. All metrics are gauges describing the last run.
+
+        Returns
+        -------
+        str
+            The metric families followed by ``# EOF``.
+        """
+        families: list[tuple[str, str, str, list[tuple[str, float]]]] = [
+            ('macprefs_last_run_timestamp_seconds', 'seconds',
+             'Time the last export finished, in seconds since the epoch.', [
+                 ('', time() if timestamp is None else timestamp)
+             ]),
+            ('macprefs_last_run_success', '', 'Whether the last export completed.',
+             [('', int(self.success))]),
+            ('macprefs_run_duration_seconds', 'seconds', 'Wall time of the last export.',
+             [('', sum(self.stage_seconds.values()))]),
+            ('macprefs_stage_duration_seconds', 'seconds',
+             'Wall time of each stage of the last export.', [
+                 (f'stage="{stage}"', seconds)
+                 for stage, seconds in sorted(self.stage_seconds.items())
+             ]),
+            ('macprefs_domains', '', 'Number of domains by outcome in the last export.',
+             [(f'state="{state}"', count) for state, count in (
+                 ('exported', self.domains_exported),
+                 ('failed', len(self.failed)),
+                 ('resumed', len(self.resumed)),
+                 ('scanned', self.domains_scanned),
+                 ('skipped', self.domains_skipped),
+                 ('timed_out', len(self.timed_out)),
+             )]),
+            ('macprefs_read_bytes', 'bytes', 'Size of the property lists copied and parsed.',
+             [('', self.bytes_read)]),
+            ('macprefs_written_bytes', 'bytes', 'Size of the property lists and scripts written.',
+             [('', self.bytes_written)]),
+            ('macprefs_keys', '', 'Number of top-level keys accepted and rejected by the filters.',
+             [('state="accepted"', self.keys_accepted), ('state="rejected"', self.keys_rejected)]),
+            ('macprefs_subprocesses', '', 'Number of subprocesses started.', [('',
+                                                                               self.subprocesses)]),
+            ('macprefs_peak_rss_bytes', 'bytes', 'Peak resident set size of the process.',
+             [('', self.peak_rss_bytes)]),
+        ]
+        lines = []
+        for name, unit, help_text, samples in families:
+            lines.append(f'# TYPE {name} gauge\n')
+            if unit:
+                lines.append(f'# UNIT {name} {unit}\n')
+            lines.append(f'# HELP {name} {help_text}\n')
+            lines.extend(f'{name}{{{labels}}} {value}\n' if labels else f'{name} {value}\n'
+                         for labels, value in samples)
+        lines.append('# EOF\n')
+        return ''.join(lines)
@@ -0,0 +1,89 @@
+"""Canonical property list serialisation."""
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+import logging
+import plistlib
+
+from .journal import atomic_write
+
+if TYPE_CHECKING:
+    import os
+
+__all__ = ('canonical_plist_bytes', 'canonicalize', 'write_canonical_plist')
+
+log = logging.getLogger(__name__)
+
+
+def canonicalize(value: Any, *, binary: bool = False) -> Any:
+    """
+    Normalise a parsed property list value so that it always serialises the same way.
+
+    - Dates are converted to naive UTC. For XML output, they are truncated to whole seconds, which
+      is the precision of the format. Binary output keeps fractional seconds.
+    - ``-0.0`` becomes ``0.0``.
+    - For XML output, :py:class:`plistlib.UID` values are converted to ``{'CF$UID': n}``, matching
+      ``plutil -convert xml1``.
+
+    Returns
+    -------
+    Any
+        The normalised value.
+    """
+    if isinstance(value, dict):
+        return {k: canonicalize(v, binary=binary) for k, v in sorted(value.items())}
+    if isinstance(value, list | tuple):
+        return [canonicalize(v, binary=binary) for v in value]
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value if binary else value.replace(microsecond=0)
+    if isinstance(value, float) and value == 0:
+        return 0.0
+    if isinstance(value, plistlib.UID) and not binary:
+        return {'CF$UID': value.data}
+    return value
+
+
+def canonical_plist_bytes(plist: Any, *, binary: bool = False) -> bytes:
+    """
+    Serialise a property list deterministically.
+
+    Keys are sorted, values are normalised with :py:func:`canonicalize` and the layout is the fixed
+    one produced by :py:mod:`plistlib`, so semantically identical input always produces identical
+    bytes.
+
+    Returns
+    -------
+    bytes
+        The serialised property list.
+    """
+    return plistlib.dumps(
+        canonicalize(plist, binary=binary),
+        fmt=plistlib.PlistFormat.FMT_BINARY if binary else plistlib.PlistFormat.FMT_XML,
+        sort_keys=True)
+
+
+def write_canonical_plist(path: os.PathLike[str] | str, *, binary: bool = False) -> bool:
+    """
+    Rewrite a property list file in canonical form.
+
+    The file is only written if its content changes, and then replaced atomically.
+
+    Returns
+    -------
+    bool
+        ``False`` if the file could not be parsed or represented, in which case it is left as is.
+    """
+    file = Path(path)
+    data = file.read_bytes()
+    try:
+        out = canonical_plist_bytes(plistlib.loads(data), binary=binary)
+    except (plistlib.InvalidFileException, OverflowError, TypeError, ValueError) as e:
+        log.debug('Cannot write `%s` in canonical form: %s', file, e)
+        return False
+    if out != data:
+        atomic_write(file, out)
+    return True
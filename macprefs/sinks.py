@@ -0,0 +1,185 @@
+"""Additional output directories fed by one export."""
+from __future__ import annotations
+
+from contextlib import suppress
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, cast
+
+from anyio import Path
+import anyio.to_thread
+
+from .config import make_configured_key_filter
+from .constants import REJECTED_SCRIPTS_DIRECTORY_NAME, SCRIPTS_DIRECTORY_NAME
+from .journal import atomic_write
+from .processing import remove_data_fields
+from .utils import (
+    _generate_configured_domains,
+    _out_domain,
+    _write_domain_fragments,
+    convert_plist,
+    setup_output_directory,
+    setup_plist_diff_driver,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import Mapping
+
+    from .concurrency import AdaptiveLimiter
+    from .processing import KeyFilter
+    from .report import ExportReport
+    from .typing import PlistRoot
+
+__all__ = ('Sink',)
+
+
+@dataclass
+class Sink:
+    """
+    Output directory that receives the domains parsed for the main output directory.
+
+    :py:func:`macprefs.utils.prefs_export` copies and parses each property list once. Every sink
+    then gets its own property list files, script fragments and scripts, written with its own key
+    filter and format options, and is optionally committed with Git.
+
+    ``config`` holds the filter options of the sink, as in the configuration file. Its domain
+    filters can only ignore more domains than the main output directory, as a domain the main
+    output directory ignores is never parsed. Its key filters are independent.
+    """
+    out_dir: Path
+    """Output directory."""
+    config: dict[str, Any] = field(default_factory=dict)
+    """Filter options."""
+    key_filter: KeyFilter | None = None
+    """Key filter. Created from :py:attr:`config` if not given."""
+    deploy_key: Path | None = None
+    """Key for pushing to the Git repository."""
+    binary: bool = False
+    """Store property lists in binary format."""
+    canonical: bool = False
+    """Write property lists in a deterministic form."""
+    commit: bool = False
+    """Commit the changes with Git."""
+    skip_rejected: bool = False
+    """Do not write ``rejected-defaults.sh``."""
+    def __post_init__(self) -> None:
+        """Create the key filter from the configuration if it was not given."""
+        if self.key_filter is None:
+            self.key_filter = make_configured_key_filter(self.config)
+
+    @classmethod
+    def from_config(cls, table: Mapping[str, Any]) -> Sink:
+        """
+        Create a sink from a table of the ``sinks`` array in the configuration file.
+
+        Returns
+        -------
+        Sink
+            The sink. Keys other than the output options are used as its filter options.
+        """
+        options = {
+            'binary', 'canonical', 'commit', 'deploy-key', 'output-directory', 'skip-rejected'
+        }
+        return cls(Path(table['output-directory']), {
+            k: v
+            for k, v in table.items() if k not in options
+        },
+                   deploy_key=Path(table['deploy-key']) if 'deploy-key' in table else None,
+                   binary=table.get('binary', False),
+                   canonical=table.get('canonical', False),
+                   commit=table.get('commit', False),
+                   skip_rejected=table.get('skip-rejected', False))
+
+
+@dataclass
+class _SinkExport:
+    """Write the domains exported to the main output directory to a sink."""
+    sink: Sink
+    domains: set[str]
+    """Domains accepted by the domain filters of the sink."""
+    new: bool = False
+    """Whether the sink had no script fragments before this run."""
+    known: list[str] = field(default_factory=list)
+    """Output names of the domains that have an export in the sink."""
+    async def export(self,
+                     domain: str,
+                     root: PlistRoot,
+                     plist_in: Path,
+                     limiter: AdaptiveLimiter,
+                     report: ExportReport,
+                     *,
+                     binary: bool,
+                     canonical: bool,
+                     reused: bool = False) -> bool:
+        """
+        Write the property list and fragments of a domain with the options of the sink.
+
+        ``root`` is cleaned again with the key filter of the sink. ``plist_in`` is the property
+        list exported to the main output directory, stored with ``binary`` and ``canonical``. It is
+        copied and only converted if the sink stores property lists differently.
+
+        If ``reused`` is ``True``, ``root`` was reused from the snapshot and the previous output of
+        the sink is kept if it exists.
+
+        Returns
+        -------
+        bool
+            ``False`` if the conversion failed.
+        """
+        if domain not in self.domains:
+            return True
+        sink = self.sink
+        key_filter = cast('KeyFilter', sink.key_filter)
+        if not (root := remove_data_fields(
+                root, key_filter, domain, keep_rejected=not sink.skip_rejected)):
+            return True
+        out_domain = _out_domain(domain)
+        self.known.append(out_domain)
+        scripts_dir = sink.out_dir / SCRIPTS_DIRECTORY_NAME
+        plist_out = sink.out_dir / 'Preferences' / f'{out_domain}.plist'
+        if reused and await (scripts_dir /
+                             f'{out_domain}.sh').exists() and await plist_out.exists():
+            return True
+        report.bytes_written += await _write_domain_fragments(scripts_dir,
+                                                              domain,
+                                                              root,
+                                                              key_filter,
+                                                              skip_rejected=sink.skip_rejected)
+        await anyio.to_thread.run_sync(atomic_write, plist_out, await plist_in.read_bytes())
+        if (sink.binary, sink.canonical) != (binary, canonical) and await limiter.run(
+                convert_plist, plist_out, binary=sink.binary, canonical=sink.canonical) != 0:
+            return False
+        with suppress(OSError):
+            report.bytes_written += (await plist_out.stat()).st_size
+        return True
+
+    def keep(self, domain: str) -> None:
+        """Keep the previous export of a domain that was not exported again."""
+        if domain in self.domains:
+            self.known.append(_out_domain(domain))
+
+
+def _sink_options(item: Sink | Mapping[str, Any]) -> dict[str, Any]:
+    sink = item if isinstance(item, Sink) else Sink.from_config(item)
+    return {
+        'binary': sink.binary,
+        'canonical': sink.canonical,
+        'config': sink.config,
+        'out_dir': str(sink.out_dir),
+        'skip_rejected': sink.skip_rejected
+    }
+
+
+async def _setup_sinks(config: Mapping[str, Any], *, has_git: bool) -> list[_SinkExport]:
+    ret = []
+    for item in config.get('sinks', ()):
+        sink = item if isinstance(item, Sink) else Sink.from_config(item)
+        scripts_dir = sink.out_dir / SCRIPTS_DIRECTORY_NAME
+        new = not await scripts_dir.exists()
+        await setup_output_directory(sink.out_dir)
+        await (scripts_dir / REJECTED_SCRIPTS_DIRECTORY_NAME).mkdir(parents=True, exist_ok=True)
+        if sink.binary:
+            await setup_plist_diff_driver(sink.out_dir, has_git=has_git)
+        ret.append(
+            _SinkExport(sink, {x
+                               async for x in _generate_configured_domains(sink.config)}, new=new))
+    return ret
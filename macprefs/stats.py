@@ -0,0 +1,173 @@
+"""Per-key change statistics used to find volatile keys."""
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, NamedTuple
+import hashlib
+import json
+import logging
+import re
+
+import tomlkit
+
+from .journal import atomic_write
+from .serialization import canonicalize
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable
+    from pathlib import Path
+
+    from .typing import PlistRoot, PlistValue
+
+__all__ = ('VolatileKey', 'find_volatile_keys', 'load_key_stats', 'record_key_stats',
+           'save_key_stats', 'update_key_stats', 'volatile_keys_toml')
+
+log = logging.getLogger(__name__)
+
+KEY_STATS_VERSION = 1
+"""Version of the key statistics file format."""
+
+
+class VolatileKey(NamedTuple):
+    """A key whose value changes on most runs."""
+    domain: str
+    """Domain name."""
+    key: str
+    """Key name."""
+    changes: int
+    """Number of runs in which the value differed from the previous run."""
+    runs: int
+    """Number of runs in which the key was seen."""
+    @property
+    def churn(self) -> float:
+        """Fraction of consecutive runs in which the value changed."""
+        return self.changes / max(self.runs - 1, 1)
+
+
+def load_key_stats(path: Path) -> dict[str, Any]:
+    """
+    Load key statistics.
+
+    Returns
+    -------
+    dict[str, Any]
+        The statistics. Empty statistics are returned if the file does not exist or is from an
+        incompatible version.
+    """
+    stats: dict[str, Any]
+    try:
+        stats = json.loads(path.read_text(encoding='utf-8'))
+    except (FileNotFoundError, ValueError):
+        stats = {}
+    if stats.get('version') != KEY_STATS_VERSION:
+        log.debug('Starting new key statistics.')
+        return {'version': KEY_STATS_VERSION, 'runs': 0, 'keys': {}}
+    return stats
+
+
+def save_key_stats(path: Path, stats: dict[str, Any]) -> None:
+    """Save key statistics."""
+    atomic_write(path, json.dumps(stats, separators=(',', ':'), sort_keys=True))
+
+
+def _value_hash(value: PlistValue) -> str:
+    return hashlib.blake2b(repr(canonicalize(value)).encode(), digest_size=8).hexdigest()
+
+
+def update_key_stats(stats: dict[str, Any],
+                     all_data: Iterable[tuple[str, PlistRoot]],
+                     key_filter: Callable[[str, str], bool] | None = None) -> None:
+    """
+    Record the values of one run in key statistics.
+
+    Each key is stored as ``[value hash, runs seen, changes]``. Keys ignored by ``key_filter`` are
+    not recorded.
+    """
+    stats['runs'] += 1
+    keys: dict[str, dict[str, list[Any]]] = stats['keys']
+    for domain, root in all_data:
+        if not root:
+            continue
+        domain_stats = keys.setdefault(domain, {})
+        for key, value in root.items():
+            if key_filter and key_filter(domain, key):
+                continue
+            value_hash = _value_hash(value)
+            if (entry := domain_stats.get(key)) is None:
+                domain_stats[key] = [value_hash, 1, 0]
+                continue
+            if entry[0] != value_hash:
+                entry[0] = value_hash
+                entry[2] += 1
+            entry[1] += 1
+
+
+def record_key_stats(path: Path,
+                     all_data: Iterable[tuple[str, PlistRoot]],
+                     key_filter: Callable[[str, str], bool] | None = None) -> None:
+    """Load key statistics, record the values of one run and save them."""
+    stats = load_key_stats(path)
+    update_key_stats(stats, all_data, key_filter)
+    save_key_stats(path, stats)
+
+
+def find_volatile_keys(stats: dict[str, Any],
+                       key_filter: Callable[[str, str], bool] | None = None,
+                       *,
+                       min_runs: int = 5,
+                       threshold: float = 0.9) -> list[VolatileKey]:
+    """
+    Find keys whose value changes on almost every run.
+
+    Parameters
+    ----------
+    stats : dict[str, Any]
+        Statistics from :py:func:`load_key_stats`.
+    key_filter : Callable[[str, str], bool] | None
+        Keys for which this returns ``True`` are already ignored and are not reported.
+    min_runs : int
+        Minimum number of runs a key must have been seen in.
+    threshold : float
+        Minimum fraction of consecutive runs in which the value changed.
+
+    Returns
+    -------
+    list[VolatileKey]
+        Volatile keys, most volatile first.
+    """
+    ret = [
+        VolatileKey(domain, key, changes, runs) for domain, domain_stats in stats['keys'].items()
+        for key, (_, runs, changes) in domain_stats.items() if runs >= min_runs
+        if not (key_filter and key_filter(domain, key))
+    ]
+    return sorted((x for x in ret if x.churn >= threshold),
+                  key=lambda x: (-x.churn, -x.changes, x.domain, x.key))
+
+
+def volatile_keys_toml(keys: Iterable[VolatileKey]) -> str:
+    """
+    Write a configuration block ignoring volatile keys.
+
+    The block is in the format accepted by :py:func:`macprefs.config.read_config` and is preceded
+    by comments ranking the keys by churn. Keys that start with ``re:`` are escaped as regular
+    expressions.
+
+    Returns
+    -------
+    str
+        TOML text.
+    """
+    ranked = list(keys)
+    ignore_keys: dict[str, list[str]] = {}
+    for x in ranked:
+        ignore_keys.setdefault(
+            x.domain, []).append(f're:^{re.escape(x.key)}$' if x.key.startswith('re:') else x.key)
+    lines = [
+        '# Volatile keys ranked by churn (changes / consecutive runs):',
+        *(f'# {x.churn:6.1%} ({x.changes}/{x.runs - 1}) {x.domain} {x.key}' for x in ranked)
+    ]
+    return '\n'.join(lines) + '\n' + tomlkit.dumps(
+        {'tool': {
+            'macprefs': {
+                'extend-ignore-keys': ignore_keys
+            }
+        }})
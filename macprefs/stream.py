@@ -0,0 +1,101 @@
+"""Exporting preferences in memory."""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, cast
+import asyncio
+
+from .concurrency import AdaptiveLimiter
+from .config import make_configured_key_filter
+from .processing import rejected_fields
+from .utils import _domain_selector, _generate_configured_domains, _largest_first, _parse_source
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncGenerator, Callable, Iterable, Mapping
+
+    from .processing import DomainFilter, KeyFilter
+    from .typing import Jobs, PlistRoot
+
+__all__ = ('DomainResult', 'stream_domains')
+
+
+@dataclass(frozen=True)
+class DomainResult:
+    """Preferences of one domain yielded by :py:func:`stream_domains`."""
+    domain: str
+    """Domain name as passed to ``defaults write``. The global domain is ``-globalDomain``."""
+    root: PlistRoot
+    """Root with data fields removed from the accepted keys. Ignored keys are kept as they are."""
+    accepted: PlistRoot
+    """Top-level keys accepted by the key filter, with data fields removed."""
+    rejected: PlistRoot
+    """Top-level keys ignored by the key filter, with data fields removed."""
+    @classmethod
+    def from_root(cls, domain: str, root: PlistRoot, key_filter: Callable[[str, str],
+                                                                          bool]) -> DomainResult:
+        """
+        Split a root returned by :py:func:`macprefs.processing.remove_data_fields`.
+
+        Returns
+        -------
+        DomainResult
+            The result.
+        """
+        return cls(domain, root,
+                   cast('PlistRoot', {
+                       k: v
+                       for k, v in root.items() if not key_filter(domain, k)
+                   }), rejected_fields(root, key_filter, domain))
+
+
+async def stream_domains(config: Mapping[str, Any] | None = None,
+                         *,
+                         domain_filter: DomainFilter | None = None,
+                         domain_globs: Iterable[str] = (),
+                         domains: Iterable[str] = (),
+                         jobs: Jobs = 'auto',
+                         key_filter: KeyFilter | None = None) -> AsyncGenerator[DomainResult, None]:
+    """
+    Export preferences in memory, yielding each domain as soon as it is parsed.
+
+    The property lists are read from their source and cleaned like in
+    :py:func:`macprefs.utils.prefs_export`, but nothing is copied or written, no state or cache is
+    used and no subprocess is run. This is meant for other programs that process preferences
+    themselves.
+
+    ``domain_filter`` and ``key_filter`` are used instead of creating them from ``config``. Create
+    them once with :py:func:`macprefs.config.make_configured_domain_filter` and
+    :py:func:`macprefs.config.make_configured_key_filter` to reuse them across calls. ``domains``,
+    ``domain_globs`` and ``jobs`` have the same meaning as for
+    :py:func:`macprefs.utils.prefs_export`.
+
+    Domains without content or whose property list cannot be read or parsed are skipped. If the
+    caller stops iterating, the domains still being read are cancelled.
+
+    Yields
+    ------
+    DomainResult
+        The domain with its cleaned root and its accepted and rejected keys, in the order the
+        domains finish.
+    """
+    config = config or {}
+    if key_filter is None:
+        key_filter = make_configured_key_filter(config)
+    selected = _domain_selector(domains, domain_globs)
+    limiter = AdaptiveLimiter.from_jobs(jobs)
+    tasks = [
+        asyncio.ensure_future(limiter.run(_parse_source, domain, key_filter=key_filter))
+        for domain in await _largest_first([
+            x async for x in _generate_configured_domains(config, domain_filter=domain_filter)
+            if selected is None or selected(x)
+        ])
+    ]
+    try:
+        for task in asyncio.as_completed(tasks):
+            domain, root = await task
+            if root:
+                yield DomainResult.from_root(domain, root, key_filter)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
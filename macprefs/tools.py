@@ -0,0 +1,60 @@
+"""Discovery of the external programs used by macprefs."""
+from __future__ import annotations
+
+from functools import cache
+from pathlib import Path
+from typing import TYPE_CHECKING
+import logging
+import shutil
+
+if TYPE_CHECKING:
+    from collections.abc import Mapping
+
+__all__ = ('TOOL_NAMES', 'find_tool', 'set_tool_paths', 'tool_path')
+
+log = logging.getLogger(__name__)
+
+TOOL_NAMES = ('git', 'launchctl', 'plutil', 'prefs-export')
+"""Programs whose paths can be set with :py:func:`set_tool_paths` or the ``tools`` configuration
+table."""
+_overrides: dict[str, str] = {}
+
+
+@cache
+def find_tool(name: str) -> str | None:
+    """
+    Find an external program without starting a shell.
+
+    A path set with :py:func:`set_tool_paths` is used as is. Otherwise ``PATH`` is searched with
+    :py:func:`shutil.which`. Results are cached until :py:func:`set_tool_paths` is called.
+
+    Returns
+    -------
+    str | None
+        The path of the program, or ``None`` if it cannot be found.
+    """
+    if (path := _overrides.get(name)) is not None:
+        return path
+    path = shutil.which(name)
+    log.debug('Found `%s` at %s.', name, path)
+    return path
+
+
+def tool_path(name: str) -> str:
+    """
+    Get the path to run an external program with.
+
+    Returns
+    -------
+    str
+        The path found by :py:func:`find_tool`, or ``name`` itself so that running it fails with the
+        usual error if it cannot be found.
+    """
+    return find_tool(name) or name
+
+
+def set_tool_paths(paths: Mapping[str, str]) -> None:
+    """Replace the paths of external programs and forget the ones found before."""
+    _overrides.clear()
+    _overrides.update({name: str(Path(path).expanduser()) for name, path in paths.items()})
+    find_tool.cache_clear()
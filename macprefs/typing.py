@@ -3,10 +3,19 @@ from __future__ import annotations
 
 from collections.abc import Mapping, Sequence, ValuesView
 from datetime import datetime
-from typing import Any, TypeAlias
+from typing import Any, Literal, TypeAlias
 
-__all__ = ('ComplexInnerTypes', 'PlistList', 'PlistRoot', 'PlistValue', 'SimpleArg')
+__all__ = ('ChangeKind', 'ComplexInnerTypes', 'FileState', 'Jobs', 'LockMode', 'PlistList',
+           'PlistRoot', 'PlistValue', 'SimpleArg')
 
+ChangeKind: TypeAlias = Literal['added', 'byte-wise', 'removed', 'semantic']
+"""Kind of change of an exported domain. ``byte-wise`` means only the serialisation differs."""
+FileState: TypeAlias = dict[str, tuple[int, int]]
+"""Mapping of file name to modification time in nanoseconds and size."""
+Jobs: TypeAlias = int | Literal['auto']
+"""Number of concurrent export tasks, or ``'auto'`` to size and adjust it automatically."""
+LockMode: TypeAlias = Literal['coalesce', 'exit', 'wait']
+"""What to do when another export holds the run lock of the output directory."""
 ComplexInnerTypes: TypeAlias = list[Any] | Mapping[str, Any] | bytes
 """Non-scalar inner types of a property list."""
 PlistValue: TypeAlias = Mapping[str, Any] | list[Any] | bool | int | float | str | datetime | bytes
@@ -1,16 +1,19 @@
 """Utility functions."""
 from __future__ import annotations
 
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
+from fnmatch import fnmatchcase
+from functools import partial
 from shlex import quote
-from subprocess import CalledProcessError
+from subprocess import CalledProcessError, CompletedProcess, TimeoutExpired
+from time import monotonic, perf_counter
 from typing import IO, TYPE_CHECKING, Any, cast
 import asyncio
-import asyncio.subprocess as sp
 import logging
-import operator
 import os
+import pathlib
 import plistlib
 import shutil
 
@@ -18,73 +21,185 @@ from anyio import Path
 from platformdirs import user_log_path
 import anyio.to_thread
 
-from .constants import GLOBAL_DOMAIN_ARG, MAX_CONCURRENT_EXPORT_TASKS
+from .cache import NegativeCache, SnapshotCache, config_fingerprint
+from .concurrency import AdaptiveLimiter, RateLimiter
+from .config import make_configured_domain_filter, make_configured_key_filter
+from .constants import (
+    GIT_ATTRIBUTES_PLIST_LINE,
+    GIT_TIMEOUT_SECONDS,
+    GLOBAL_DOMAIN_ARG,
+    JOURNAL_FILENAME,
+    KEY_STATS_FILENAME,
+    LAUNCHCTL_TIMEOUT_SECONDS,
+    NEGATIVE_CACHE_FILENAME,
+    PLIST_TEXTCONV_COMMAND,
+    PLUTIL_TIMEOUT_SECONDS,
+    REJECTED_SCRIPTS_DIRECTORY_NAME,
+    SCRIPTS_DIRECTORY_NAME,
+    SNAPSHOT_FILENAME,
+    STATE_DIRECTORY_NAME,
+)
 from .exceptions import PropertyListConversionError
-from .filters.bad_domains import BAD_DOMAINS, BAD_DOMAIN_PREFIXES
+from .journal import RunJournal, atomic_write
 from .plist2defaults import plist_to_defaults_commands
-from .processing import make_key_filter, remove_data_fields
+from .process import default_runner, run_process
+from .processing import make_domain_filter, rejected_fields, remove_data_fields
+from .report import ExportReport, peak_rss_bytes
+from .serialization import canonical_plist_bytes, canonicalize, write_canonical_plist
+from .stats import record_key_stats
+from .tools import find_tool, tool_path
 
 if TYPE_CHECKING:
-    from collections.abc import AsyncIterator, Iterable
+    from collections.abc import (
+        AsyncIterator,
+        Callable,
+        Container,
+        Iterable,
+        Mapping,
+    )
 
-    from .typing import PlistRoot
+    from .processing import DomainFilter, FilterStats, KeyFilter
+    from .sinks import _SinkExport
+    from .typing import ChangeKind, Jobs, PlistRoot
 
-__all__ = ('defaults_export', 'generate_domains', 'git', 'install_job', 'is_git_installed',
-           'prefs_export', 'setup_output_directory')
+__all__ = ('check_export', 'convert_plist', 'defaults_export', 'generate_domains', 'git',
+           'install_job', 'is_git_installed', 'load_snapshot', 'make_configured_key_filter',
+           'prefs_export', 'setup_output_directory', 'setup_plist_diff_driver',
+           'setup_state_directory')
 
 log = logging.getLogger(__name__)
 
+_EXEC_DEFAULTS_HEADER = ('#!/usr/bin/env bash\n'
+                         '# shellcheck disable=SC1003,SC1010,SC1112,SC2016,SC2088\n'
+                         '# This file is generated, but is versioned.\n\n')
+_REJECTED_DEFAULTS_HEADER = ('# Rejected defaults values.\n'
+                             '# shellcheck disable=SC1003,SC1010,SC1112,SC2016,SC2088\n'
+                             '# This file is generated, but is versioned.\n\n')
 
-async def is_git_installed() -> bool:
+
+async def is_git_installed() -> bool:  # ruff:ignore[unused-async]
     """
     Check if Git is installed.
 
     Returns
     -------
     bool
-        ``True`` if the ``git`` executable is on ``PATH``.
+        ``True`` if the ``git`` executable is found by :py:func:`macprefs.tools.find_tool`.
     """
-    return (await (await sp.create_subprocess_exec('bash', '-c', 'command -v git',
-                                                   stdout=sp.PIPE)).wait() == 0)
+    return find_tool('git') is not None
 
 
-async def generate_domains(bad_domains_addendum: Iterable[str],
-                           bad_domain_prefixes_addendum: Iterable[str],
+async def generate_domains(bad_domains_addendum: Iterable[str] = (),
+                           bad_domain_prefixes_addendum: Iterable[str] = (),
                            *,
+                           domain_filter: DomainFilter | None = None,
                            reset_domains: bool = False,
-                           reset_prefixes: bool = False) -> AsyncIterator[str]:
+                           reset_prefixes: bool = False,
+                           stats: FilterStats | None = None) -> AsyncIterator[str]:
     """
     Generate the list of domains to export.
 
+    Domains are ignored with ``domain_filter``. If it is not given, it is created from the other
+    arguments with :py:func:`macprefs.processing.make_domain_filter`.
+
+    If ``stats`` is given, the ignored domains and prefixes are registered as rules named
+    ``domain:<name>`` and ``prefix:<prefix>`` and their hits are counted.
+
     Yields
     ------
     str
         The domain name.
     """
-    all_bad_domains = (bad_domains_addendum
-                       if reset_domains else {*BAD_DOMAINS, *bad_domains_addendum})
-    all_bad_domain_prefixes = (bad_domain_prefixes_addendum if reset_prefixes else
-                               {*BAD_DOMAIN_PREFIXES, *bad_domain_prefixes_addendum})
+    if domain_filter is None:
+        domain_filter = make_domain_filter(bad_domains_addendum,
+                                           bad_domain_prefixes_addendum,
+                                           reset_domains=reset_domains,
+                                           reset_prefixes=reset_prefixes)
+    if stats is not None:
+        stats.add_rules(f'domain:{x}' for x in domain_filter.bad_domains)
+        stats.add_rules(f'prefix:{x}' for x in domain_filter.bad_domain_prefixes)
     lib_prefs_path = (await Path.home()) / 'Library/Preferences'
     async for plist in lib_prefs_path.glob('*.plist'):
-        if plist.stem in all_bad_domains:
-            log.debug('Skipping `%s` because it is in the ignored domains list.', plist.stem)
-            continue
         if plist.name.startswith('.'):
             log.debug('Skipping `%s` because it begins with a `.`.', plist.stem)
             continue
-        has_ignored_prefix = False
-        for prefix in all_bad_domain_prefixes:
-            if plist.stem.startswith(prefix):
-                log.debug('Skipping `%s` because it begins with `%s`.', plist.stem, prefix)
-                has_ignored_prefix = True
-                break
-        if not has_ignored_prefix:
+        if not domain_filter(plist.stem):
             yield plist.stem
+            continue
+        rule = (f'domain:{plist.stem}' if plist.stem in domain_filter.bad_domains else 'prefix:' +
+                next(x for x in domain_filter.bad_domain_prefixes if plist.stem.startswith(x)))
+        log.debug('Skipping `%s` because of the ignore rule `%s`.', plist.stem, rule)
+        if stats is not None:
+            stats.hit(rule)
     yield GLOBAL_DOMAIN_ARG
 
 
-async def try_parse_plist(domain: str, plist_out: Path) -> tuple[str, PlistRoot]:
+def _generate_configured_domains(config: Mapping[str, Any],
+                                 stats: FilterStats | None = None,
+                                 domain_filter: DomainFilter | None = None) -> AsyncIterator[str]:
+    return generate_domains(domain_filter=domain_filter or make_configured_domain_filter(config),
+                            stats=stats)
+
+
+def _out_domain(domain: str) -> str:
+    return 'globalDomain' if domain == GLOBAL_DOMAIN_ARG else domain
+
+
+def _defaults_domain(out_domain: str) -> str:
+    return GLOBAL_DOMAIN_ARG if out_domain == 'globalDomain' else out_domain
+
+
+def _domain_selector(domains: Iterable[str],
+                     domain_globs: Iterable[str]) -> Callable[[str], bool] | None:
+    names = set(domains)
+    globs = tuple(domain_globs)
+    if not names and not globs:
+        return None
+
+    def selected(domain: str) -> bool:
+        return any(x in names or any(fnmatchcase(x, glob) for glob in globs)
+                   for x in {domain, _out_domain(domain),
+                             _defaults_domain(domain)})
+
+    return selected
+
+
+def _source_name(domain: str) -> str:
+    return '.GlobalPreferences' if domain == GLOBAL_DOMAIN_ARG else domain
+
+
+async def _source_plist(domain: str) -> Path:
+    return (await Path.home()) / 'Library/Preferences' / f'{_source_name(domain)}.plist'
+
+
+async def _largest_first(domains: Iterable[str]) -> list[str]:
+    """
+    Sort domains so that the largest property lists are exported first.
+
+    Starting the slowest tasks first keeps a few large files from finishing long after the rest.
+    The sizes come from one scan of the preferences directory.
+
+    Returns
+    -------
+    list[str]
+        Domains by decreasing size of their property list, then by name.
+    """
+    # macprefs.watch imports this module.
+    from .watch import scan_directory  # ruff:ignore[import-outside-top-level]
+    try:
+        state = await anyio.to_thread.run_sync(scan_directory,
+                                               (await Path.home()) / 'Library/Preferences')
+    except OSError:
+        state = {}
+    return sorted(domains, key=lambda x: (-state.get(f'{_source_name(x)}.plist', (0, 0))[1], x))
+
+
+async def try_parse_plist(domain: str,
+                          plist_out: Path,
+                          *,
+                          key_filter: Callable[[str, str], bool] | None = None,
+                          keep_rejected: bool = True,
+                          on_invalid: Callable[[], object] | None = None) -> tuple[str, PlistRoot]:
     async with await plist_out.open('rb') as f:
         try:
             plist_parsed = await anyio.to_thread.run_sync(plistlib.load, f.wrapped)
@@ -92,8 +207,13 @@ async def try_parse_plist(domain: str, plist_out: Path) -> tuple[str, PlistRoot]
             log.debug('%s: Invalid property list file: %s', f.name, e)
             # If this condition is reached, the domain is likely in the
             # BAD_DOMAINS list so the output will be discarded
+            if on_invalid:
+                on_invalid()
             return domain, {}
-        return domain, remove_data_fields(plist_parsed)
+        return domain, remove_data_fields(plist_parsed,
+                                          key_filter,
+                                          domain,
+                                          keep_rejected=keep_rejected)
 
 
 @asynccontextmanager
@@ -111,52 +231,45 @@ async def chdir(path: os.PathLike[Any] | str) -> AsyncIterator[None]:
 async def git(cmd: Iterable[str],
               work_tree: Path,
               git_dir: Path | None = None,
-              ssh_key: str | None = None) -> sp.Process:
+              ssh_key: str | None = None) -> CompletedProcess[bytes]:
     """
     Run a Git command.
 
+    The command is run by :py:func:`macprefs.process.run_process` and killed after
+    :py:data:`macprefs.constants.GIT_TIMEOUT_SECONDS`.
+
     Returns
     -------
-    subprocess.Process
-        The subprocess handle after the command completes successfully.
+    subprocess.CompletedProcess[bytes]
+        The completed command with its captured output.
 
     Raises
     ------
     CalledProcessError
         If the command exits with a non-zero status.
-    RuntimeError
-        If the subprocess is missing expected pipes or state.
     """
     if not git_dir:
         git_dir = (await work_tree.resolve(strict=True)) / '.git'
         if not (await git_dir.exists()):
             await work_tree.mkdir(parents=True, exist_ok=True)
-            async with chdir(work_tree):
-                log.debug('Running: git init')
-                p = await sp.create_subprocess_exec('git', 'init', stdout=sp.PIPE, stderr=sp.PIPE)
-                await p.wait()
+            await run_process(tool_path('git'), 'init', cwd=work_tree, timeout=GIT_TIMEOUT_SECONDS)
     if ssh_key:
         await git(('config', 'core.sshCommand',
                    (f'ssh -i {ssh_key} -F /dev/null -o UserKnownHostsFile=/dev/null '
                     '-o StrictHostKeyChecking=no')), work_tree, git_dir)
     cmd_list = list(cmd)
-    rest = ' '.join(map(quote, cmd_list))
-    log.debug('Running: git "--git-dir=%s" "--work-tree=%s" %s', git_dir, work_tree, rest)
-    p = await sp.create_subprocess_exec('git',
-                                        f'--git-dir={git_dir}',
-                                        f'--work-tree={work_tree}',
-                                        *cmd_list,
-                                        stderr=sp.PIPE)
-    if (await p.wait()) != 0:
-        stderr_pipe = p.stderr
-        rc = p.returncode
-        if rc is None or stderr_pipe is None:
-            msg = 'Git subprocess finished in an unexpected state.'
-            raise RuntimeError(msg)
-        stderr = (await stderr_pipe.read()).decode()
+    p = await run_process(tool_path('git'),
+                          f'--git-dir={git_dir}',
+                          f'--work-tree={work_tree}',
+                          *cmd_list,
+                          timeout=GIT_TIMEOUT_SECONDS)
+    if p.returncode != 0:
         quoted_args = ' '.join(
-            quote(x) for x in (f'--git-dir={git_dir}', f'--work-tree={work_tree}'))
-        raise CalledProcessError(rc, f'git {quoted_args} {rest}', stderr=stderr)
+            quote(x) for x in (f'--git-dir={git_dir}', f'--work-tree={work_tree}', *cmd_list))
+        raise CalledProcessError(p.returncode,
+                                 f'git {quoted_args}',
+                                 output=p.stdout,
+                                 stderr=p.stderr.decode())
     return p
 
 
@@ -168,18 +281,8 @@ async def _push_current_branch(work_tree: Path) -> None:
     ----------
     work_tree : Path
         The Git work tree directory.
-
-    Raises
-    ------
-    RuntimeError
-        If the branch name cannot be read from the subprocess.
     """
-    branch_process = await git(('branch', '--show-current'), work_tree)
-    stdout = branch_process.stdout
-    if stdout is None:
-        msg = 'The git branch stdout pipe is unavailable.'
-        raise RuntimeError(msg)
-    branch = (await stdout.read()).decode().strip()
+    branch = (await git(('branch', '--show-current'), work_tree)).stdout.decode().strip()
     await git(('push', '-u', '--porcelain', '--no-signed', 'origin', branch), work_tree)
 
 
@@ -198,189 +301,858 @@ async def setup_output_directory(out_dir: Path) -> tuple[Path, Path]:
     return out_dir, repo_prefs_dir
 
 
-async def defaults_export(domain: str, repo_prefs_dir: Path) -> tuple[str, PlistRoot]:
+async def setup_state_directory(out_dir: Path) -> Path:
     """
-    Export a domain using the ``defaults`` command.
+    Set up the directory for local state in the output directory.
+
+    The directory contains a ``.gitignore`` file so its content is never committed.
 
     Returns
     -------
-    tuple[str, PlistRoot]
-        The domain name and parsed plist contents. Values may be empty if export failed.
+    Path
+        The state directory path.
+    """
+    state_dir = out_dir / STATE_DIRECTORY_NAME
+    await state_dir.mkdir(exist_ok=True, parents=True)
+    gitignore = state_dir / '.gitignore'
+    if not await gitignore.exists():
+        await gitignore.write_text('*\n')
+    return state_dir
+
+
+async def load_snapshot(out_dir: Path,
+                        config: Mapping[str, Any] | None = None,
+                        *,
+                        binary: bool = False,
+                        canonical: bool = False,
+                        skip_rejected: bool = False) -> SnapshotCache:
+    """
+    Load the snapshot of the previous export in an output directory.
+
+    The snapshot holds the cleaned roots of every exported domain and is only valid for the same
+    macprefs version, filter configuration and output options, including those of the sinks.
+
+    Returns
+    -------
+    SnapshotCache
+        The snapshot. It is empty if there is no valid snapshot.
+    """
+    state_dir = await setup_state_directory(out_dir)
+    config = config or {}
+    options: dict[str, Any] = {}
+    if sinks := config.get('sinks'):
+        # macprefs.sinks imports this module.
+        from .sinks import _sink_options  # ruff:ignore[import-outside-top-level]
+        # Sinks keep their previous output for domains reused from the snapshot.
+        options['sinks'] = [_sink_options(x) for x in sinks]
+    return await anyio.to_thread.run_sync(
+        SnapshotCache.load, pathlib.Path(state_dir / SNAPSHOT_FILENAME),
+        config_fingerprint(config,
+                           binary=binary,
+                           canonical=canonical,
+                           skip_rejected=skip_rejected,
+                           **options))
+
+
+async def setup_plist_diff_driver(out_dir: Path, *, has_git: bool = True) -> None:
     """
-    plist_out = (repo_prefs_dir /
-                 f'{"globalDomain" if domain == GLOBAL_DOMAIN_ARG else domain}.plist')
-    plist_in = ((await Path.home()) / 'Library/Preferences' /
-                f'{".GlobalPreferences" if domain == GLOBAL_DOMAIN_ARG else domain}.plist')
+    Make Git show exported binary property lists as XML.
+
+    Adds the ``plist`` diff attribute for ``Preferences/*.plist`` to ``.gitattributes`` in the
+    output directory and, if Git is available, configures the repository to use
+    ``macprefs-plist-textconv`` as the driver's ``textconv`` program.
+    """
+    gitattributes = out_dir / '.gitattributes'
+    lines = (await gitattributes.read_text()).splitlines() if await gitattributes.exists() else []
+    if GIT_ATTRIBUTES_PLIST_LINE not in lines:
+        log.debug('Adding `%s` to %s.', GIT_ATTRIBUTES_PLIST_LINE, gitattributes)
+        await gitattributes.write_text('\n'.join((*lines, GIT_ATTRIBUTES_PLIST_LINE)) + '\n')
+    if has_git:
+        await git(('config', 'diff.plist.textconv', PLIST_TEXTCONV_COMMAND), out_dir)
+        await git(('config', 'diff.plist.cachetextconv', 'true'), out_dir)
+
+
+async def _copy_and_parse(domain: str, plist_in: Path, tmp_out: Path,
+                          **kwargs: Any) -> tuple[str, PlistRoot] | None:
     try:
         try:
-            await cast('Any', plist_in).copy(plist_out)
+            await cast('Any', plist_in).copy(tmp_out)
         except AttributeError:  # pragma: no cover
-            await anyio.to_thread.run_sync(shutil.copy, plist_in, plist_out)
+            await anyio.to_thread.run_sync(shutil.copy, plist_in, tmp_out)
     except PermissionError:
+        return None
+    log.debug('Copied %s to %s.', plist_in, tmp_out)
+    return await try_parse_plist(domain, tmp_out, **kwargs)
+
+
+async def defaults_export(domain: str,
+                          repo_prefs_dir: Path,
+                          negative_cache: NegativeCache | None = None,
+                          snapshot: SnapshotCache | None = None,
+                          *,
+                          key_filter: Callable[[str, str], bool] | None = None,
+                          keep_rejected: bool = True,
+                          read_limiter: RateLimiter | None = None,
+                          stat: os.stat_result | None = None) -> tuple[str, PlistRoot]:
+    """
+    Export a domain using the ``defaults`` command.
+
+    If ``negative_cache`` is given, a property list that could not be copied or parsed before is
+    skipped until its size or modification time changes, and new failures are added to it.
+
+    If ``snapshot`` is given and the source has not changed since the previous export, the stored
+    root is reused without copying or parsing. Otherwise the new root is stored in it.
+
+    The property list is copied to a temporary file next to the exported one, which is replaced
+    once parsing is done. If the export is cancelled, the previous export is left as it was.
+
+    ``key_filter`` and ``keep_rejected`` are applied while cleaning. See
+    :py:func:`macprefs.processing.remove_data_fields`.
+
+    If ``read_limiter`` is given, copying waits until the size of the property list fits in its
+    rate.
+
+    ``stat`` is the status of the source property list if the caller already has it. If it is
+    needed and cannot be read, for example because the file is protected or was removed, the
+    domain is skipped as if copying failed.
+
+    Returns
+    -------
+    tuple[str, PlistRoot]
+        The domain name and parsed plist contents. Values may be empty if export failed.
+    """
+    plist_out = repo_prefs_dir / f'{_out_domain(domain)}.plist'
+    plist_in = await _source_plist(domain)
+    on_invalid = None
+    if stat is None and (negative_cache is not None or snapshot is not None
+                         or read_limiter is not None):
+        try:
+            stat = await plist_in.stat()
+        except OSError:
+            log.debug('Cannot read the status of `%s`.', plist_in, exc_info=True)
+            return domain, {}
+    if negative_cache is not None and stat:
+        if negative_cache.contains(str(plist_in), stat):
+            log.debug('Skipping `%s` because it failed before and has not changed.', plist_in)
+            return domain, {}
+        on_invalid = partial(negative_cache.add, str(plist_in), stat)
+    if (snapshot is not None and stat and (root := snapshot.get_fresh(domain, stat)) is not None
+            and await plist_out.exists()):
+        log.debug('Reusing the previous export of `%s`.', domain)
+        return domain, root
+    if read_limiter is not None and stat:
+        await read_limiter.acquire(stat.st_size)
+    tmp_out = repo_prefs_dir / f'.{_out_domain(domain)}.plist.tmp'
+    ret = None
+    try:
+        ret = await _copy_and_parse(domain,
+                                    plist_in,
+                                    tmp_out,
+                                    key_filter=key_filter,
+                                    keep_rejected=keep_rejected,
+                                    on_invalid=on_invalid)
+    finally:
+        if ret is None:
+            await tmp_out.unlink(missing_ok=True)
+    if ret is None:
         # Restrictive environment
+        if on_invalid:
+            on_invalid()
         return domain, {}
-    log.debug('Copied %s to %s.', plist_in, plist_out)
-    return await try_parse_plist(domain, plist_out)
+    await tmp_out.replace(plist_out)
+    if snapshot is not None:
+        snapshot.put(domain, ret[1], stat)
+    return ret
+
+
+async def _export_domain(domain: str, *args: Any, deadline: float | None,
+                         domain_timeout: float | None, timed_out: list[str],
+                         **kwargs: Any) -> tuple[str, PlistRoot]:
+    budget = min((x for x in (domain_timeout, None if deadline is None else deadline - monotonic())
+                  if x is not None),
+                 default=None)
+    if budget is None or budget > 0:
+        # Only this scope's own deadline counts as a timeout. A TimeoutError raised by the export
+        # itself, such as ETIMEDOUT from a network home directory, is a failure.
+        with anyio.move_on_after(budget):
+            return await defaults_export(domain, *args, **kwargs)
+    log.warning('Timed out exporting `%s`. Keeping its previous export.', domain)
+    timed_out.append(domain)
+    return domain, {}
+
+
+async def convert_plist(plist_path: Path, *, binary: bool = False, canonical: bool = False) -> int:
+    """
+    Convert an exported property list to its stored format.
+
+    With ``canonical``, the file is rewritten in-process by
+    :py:func:`macprefs.serialization.write_canonical_plist`. ``plutil`` is used otherwise, or if the
+    file cannot be represented by :py:mod:`plistlib`. It is killed after
+    :py:data:`macprefs.constants.PLUTIL_TIMEOUT_SECONDS`.
+
+    Returns
+    -------
+    int
+        The exit status of the conversion. ``0`` means success.
+    """
+    if canonical and await anyio.to_thread.run_sync(partial(write_canonical_plist, binary=binary),
+                                                    str(plist_path)):
+        return 0
+    try:
+        p = await run_process(tool_path('plutil'),
+                              '-convert',
+                              'binary1' if binary else 'xml1',
+                              plist_path,
+                              timeout=PLUTIL_TIMEOUT_SECONDS)
+    except TimeoutExpired:
+        log.warning('Timed out converting `%s`.', plist_path.name)
+        return 1
+    if p.returncode != 0:
+        log.warning('Failed to convert `%s`: %s', plist_path.name,
+                    p.stderr.decode(errors='replace').strip())
+    return p.returncode
+
+
+async def check_export(out_dir: Path,
+                       config: Mapping[str, Any] | None = None,
+                       *,
+                       binary: bool = False,
+                       canonical: bool = False) -> dict[str, ChangeKind]:
+    """
+    Compare the current preferences with an existing export without writing anything.
+
+    Each exported domain is compared with its file in ``Preferences``. With ``canonical``, the file
+    is expected to be byte for byte the canonical form of the current preferences, and files that
+    differ only in serialisation (key order, whitespace, float or date formatting) are reported as
+    ``byte-wise`` changes. Otherwise, as ``plutil`` output is not deterministic, files are only
+    compared semantically. Dates are compared at the precision of the format given by ``binary``.
+    Unchanged domains are omitted.
+
+    Returns
+    -------
+    dict[str, ChangeKind]
+        Changed domains, sorted by name, mapped to the kind of change.
+    """
+    config = config or {}
+    repo_prefs_dir = out_dir / 'Preferences'
+    changes: dict[str, ChangeKind] = {}
+    known_domains = set()
+    async for domain in _generate_configured_domains(config):
+        try:
+            source = await (await _source_plist(domain)).read_bytes()
+            parsed = await anyio.to_thread.run_sync(plistlib.loads, source)
+        except (FileNotFoundError, PermissionError, plistlib.InvalidFileException, ValueError):
+            continue
+        if not remove_data_fields(parsed):
+            continue
+        out_domain = _out_domain(domain)
+        known_domains.add(out_domain)
+        plist_out = repo_prefs_dir / f'{out_domain}.plist'
+        if not await plist_out.exists():
+            changes[out_domain] = 'added'
+            continue
+        existing = await plist_out.read_bytes()
+        if canonical:
+            try:
+                if existing == await anyio.to_thread.run_sync(
+                        partial(canonical_plist_bytes, parsed, binary=binary)):
+                    continue
+            except (OverflowError, TypeError):
+                pass
+        try:
+            existing_parsed = await anyio.to_thread.run_sync(plistlib.loads, existing)
+        except (plistlib.InvalidFileException, ValueError):
+            changes[out_domain] = 'semantic'
+            continue
+        if canonicalize(existing_parsed, binary=binary) != canonicalize(parsed, binary=binary):
+            changes[out_domain] = 'semantic'
+        elif canonical:
+            changes[out_domain] = 'byte-wise'
+    if await repo_prefs_dir.exists():
+        async for path in repo_prefs_dir.glob('*.plist'):
+            if path.stem not in known_domains:
+                changes[path.stem] = 'removed'
+    return dict(sorted(changes.items()))
+
+
+async def _parse_source(domain: str,
+                        *,
+                        key_filter: KeyFilter,
+                        keep_rejected: bool = True) -> tuple[str, PlistRoot]:
+    try:
+        return await try_parse_plist(domain,
+                                     await _source_plist(domain),
+                                     key_filter=key_filter,
+                                     keep_rejected=keep_rejected)
+    except (FileNotFoundError, PermissionError):
+        return domain, {}
+
+
+async def _write_fragment(path: Path, lines: Iterable[str]) -> int:
+    if text := ''.join(f'{line}\n' for line in lines):
+        await anyio.to_thread.run_sync(atomic_write, path, text)
+    else:
+        await path.unlink(missing_ok=True)
+    return len(text.encode())
+
+
+async def _remove_stale_fragments(fragments_dir: Path, known_domains: Container[str],
+                                  selected: Callable[[str], bool] | None) -> None:
+    async for path in fragments_dir.glob('*.sh'):
+        if path.stem not in known_domains and (selected is None or selected(path.stem)):
+            log.debug('Removing stale fragment %s.', path)
+            await path.unlink()
+
+
+async def _assemble_script(path: Path,
+                           header: str,
+                           fragments_dir: Path,
+                           mode: int | None = None) -> int:
+    fragments = sorted([x async for x in fragments_dir.glob('*.sh')],
+                       key=lambda x: _defaults_domain(x.stem))
+    text = header + ''.join([await fragment.read_text() for fragment in fragments])
+    await anyio.to_thread.run_sync(atomic_write, path, text, mode)
+    return len(text.encode())
+
+
+async def _assemble_scripts(out_dir: Path, *, skip_rejected: bool = False) -> int:
+    scripts_dir = out_dir / SCRIPTS_DIRECTORY_NAME
+    written = await _assemble_script(out_dir / 'exec-defaults.sh', _EXEC_DEFAULTS_HEADER,
+                                     scripts_dir, 0o755)
+    rejected_defaults = out_dir / 'rejected-defaults.sh'
+    if skip_rejected:
+        await rejected_defaults.unlink(missing_ok=True)
+    else:
+        written += await _assemble_script(rejected_defaults, _REJECTED_DEFAULTS_HEADER,
+                                          scripts_dir / REJECTED_SCRIPTS_DIRECTORY_NAME)
+    return written
+
+
+async def _write_domain_fragments(scripts_dir: Path,
+                                  domain: str,
+                                  root: PlistRoot,
+                                  key_filter: KeyFilter,
+                                  *,
+                                  skip_rejected: bool = False) -> int:
+    out_domain = _out_domain(domain)
+    written = await _write_fragment(scripts_dir / f'{out_domain}.sh',
+                                    plist_to_defaults_commands(domain, root, key_filter))
+    if not skip_rejected:
+        written += await _write_fragment(
+            scripts_dir / REJECTED_SCRIPTS_DIRECTORY_NAME / f'{out_domain}.sh',
+            plist_to_defaults_commands(domain,
+                                       rejected_fields(root, key_filter, domain),
+                                       key_filter,
+                                       invert_filters=True))
+    return written
+
+
+@dataclass
+class _DomainExport:
+    """
+    Export one domain at a time, then write its fragments and convert its property list.
+
+    Each finished domain is then written to the sinks, and recorded in the journal so that an
+    interrupted run can be resumed.
+    """
+    repo_prefs_dir: Path
+    scripts_dir: Path
+    journal: RunJournal
+    key_filter: KeyFilter
+    limiter: AdaptiveLimiter
+    negative_cache: NegativeCache
+    report: ExportReport
+    snapshot: SnapshotCache
+    binary: bool = False
+    canonical: bool = False
+    deadline: float | None = None
+    domain_timeout: float | None = None
+    read_limiter: RateLimiter | None = None
+    resume: bool = False
+    skip_rejected: bool = False
+    sinks: list[_SinkExport] = field(default_factory=list)
+    known: list[str] = field(default_factory=list)
+    """Output names of the domains that have an export, including the ones kept as they were."""
+    async def run(self, domains: Iterable[str]) -> list[tuple[str, PlistRoot]]:
+        """
+        Export domains concurrently.
+
+        Returns
+        -------
+        list[tuple[str, PlistRoot]]
+            The domains that were exported and their cleaned roots. Domains that timed out or were
+            finished by an interrupted run are left out.
+        """
+        await anyio.to_thread.run_sync(partial(self.journal.open, resume=self.resume))
+        try:
+            return [
+                x for x in await asyncio.gather(*(self.export(domain) for domain in domains))
+                if x is not None
+            ]
+        finally:
+            self.journal.close()
+
+    async def export(self, domain: str) -> tuple[str, PlistRoot] | None:
+        """
+        Export a domain, write its fragments, convert it and record it in the journal.
+
+        Returns
+        -------
+        tuple[str, PlistRoot] | None
+            The domain and its cleaned root, or ``None`` if it timed out or was resumed.
+        """
+        if (exported := await self.limiter.run(self._export, domain)) is None:
+            return None
+        domain, sinks_root, stat = exported
+        out_domain = _out_domain(domain)
+        if domain in self.report.timed_out:
+            self._keep(domain)
+            return None
+        root = self._accepted(domain, sinks_root)
+        if root:
+            self.known.append(out_domain)
+            self._count_keys(domain, root)
+            await self._write_fragments(domain, root)
+            reused = domain in self.snapshot.hits
+            if not reused and not await self._convert(domain, stat):
+                return domain, root
+            self.report.domains_exported += 1
+            for sink in self.sinks:
+                if not await sink.export(domain,
+                                         sinks_root,
+                                         self.repo_prefs_dir / f'{out_domain}.plist',
+                                         self.limiter,
+                                         self.report,
+                                         binary=self.binary,
+                                         canonical=self.canonical,
+                                         reused=reused):
+                    self.report.failed.append(domain)
+                    return domain, root
+        if stat:
+            await anyio.to_thread.run_sync(
+                partial(self.journal.record, domain, stat, exported=bool(root)))
+        return domain, root
+
+    async def _export(self, domain: str) -> tuple[str, PlistRoot, os.stat_result | None] | None:
+        try:
+            stat = await (await _source_plist(domain)).stat()
+        except OSError:
+            stat = None
+        if self.resume and stat and (exported := self.journal.completed(domain, stat)) is not None:
+            log.debug('Skipping `%s` because the interrupted run finished it.', domain)
+            self.report.resumed.append(domain)
+            if exported:
+                self._keep(domain)
+            return None
+        domain, root = await _export_domain(domain,
+                                            self.repo_prefs_dir,
+                                            self.negative_cache,
+                                            self.snapshot,
+                                            deadline=self.deadline,
+                                            domain_timeout=self.domain_timeout,
+                                            key_filter=self.key_filter,
+                                            keep_rejected=not self.skip_rejected
+                                            or bool(self.sinks),
+                                            read_limiter=self.read_limiter,
+                                            stat=stat,
+                                            timed_out=self.report.timed_out)
+        return domain, root, stat
+
+    def _accepted(self, domain: str, root: PlistRoot) -> PlistRoot:
+        if not (self.skip_rejected and self.sinks):
+            return root
+        # Ignored keys were only kept for the sinks.
+        return cast('PlistRoot', {k: v for k, v in root.items() if not self.key_filter(domain, k)})
+
+    def _keep(self, domain: str) -> None:
+        self.known.append(_out_domain(domain))
+        for sink in self.sinks:
+            sink.keep(domain)
+
+    def _count_keys(self, domain: str, root: PlistRoot) -> None:
+        rejected = sum(1 for key in root if self.key_filter(domain, key))
+        self.report.keys_accepted += len(root) - rejected
+        self.report.keys_rejected += rejected
+
+    async def _convert(self, domain: str, stat: os.stat_result | None) -> bool:
+        plist_out = self.repo_prefs_dir / f'{_out_domain(domain)}.plist'
+        if await self.limiter.run(convert_plist,
+                                  plist_out,
+                                  binary=self.binary,
+                                  canonical=self.canonical) != 0:
+            self.report.failed.append(domain)
+            return False
+        self.report.bytes_read += stat.st_size if stat else 0
+        with suppress(OSError):
+            self.report.bytes_written += (await plist_out.stat()).st_size
+        return True
+
+    async def _write_fragments(self, domain: str, root: PlistRoot) -> None:
+        if domain in self.snapshot.hits and await (self.scripts_dir /
+                                                   f'{_out_domain(domain)}.sh').exists():
+            return
+        self.report.bytes_written += await _write_domain_fragments(self.scripts_dir,
+                                                                   domain,
+                                                                   root,
+                                                                   self.key_filter,
+                                                                   skip_rejected=self.skip_rejected)
 
 
 def plistlib_dump_xml(plist: Any, fp: IO[bytes]) -> None:
     plistlib.dump(plist, fp, fmt=plistlib.PlistFormat.FMT_XML)
 
 
-async def install_job(output_dir: Path, deploy_key: Path | None = None) -> int:
+async def install_job(output_dir: Path,
+                      deploy_key: Path | None = None,
+                      *,
+                      watch: bool = False) -> int:
     """
     Install a launchd job to run macprefs.
 
+    The job exports every night at midnight. With ``watch``, it runs ``prefs-export --watch``
+    instead and launchd restarts it if it exits. Either way it runs ``prefs-export --background``
+    with the ``Background`` process type and low priority I/O, so that it does not slow down
+    interactive work, for example when a missed nightly export runs as the Mac wakes up.
+
+    ``launchctl`` commands are killed after :py:data:`macprefs.constants.LAUNCHCTL_TIMEOUT_SECONDS`.
+
     Returns
     -------
     int
-        ``0`` if ``launchctl`` load and start succeeded, otherwise ``1``.
-
-    Raises
-    ------
-    RuntimeError
-        If the ``prefs-export`` subprocess has no stdout pipe.
+        ``0`` if ``launchctl`` load and start succeeded, otherwise ``1``. Also ``1`` if
+        ``prefs-export`` cannot be found.
     """
-    p = await sp.create_subprocess_exec('bash', '-c', 'command -v prefs-export', stdout=sp.PIPE)
-    if p.stdout is None:
-        msg = 'The prefs-export stdout pipe is unavailable.'
-        raise RuntimeError(msg)
-    prefs_export_path = (await p.stdout.read()).decode().strip()
+    if not (prefs_export_path := find_tool('prefs-export')):
+        log.error('Cannot find `prefs-export`. Set its path in the `tools` configuration table.')
+        return 1
     plist_path = (await Path.home()) / 'Library/LaunchAgents/sh.tat.macprefs.plist'
     log_path = str(user_log_path('macprefs', ensure_exists=True) / 'macprefs.log')
+    job: dict[str, Any] = {
+        'EnvironmentVariables': {
+            'NO_COLOR': '1'
+        },
+        'Label':
+            'sh.tat.macprefs',
+        'LowPriorityIO':
+            True,
+        'ProcessType':
+            'Background',
+        'ProgramArguments': [
+            prefs_export_path, '--output-directory',
+            str(await output_dir.resolve(strict=True)), '--commit', '--background'
+        ] + (['--deploy-key', str(await deploy_key.resolve(strict=True))] if deploy_key else []) +
+                            (['--watch'] if watch else []),
+        'RunAtLoad':
+            True,
+        'StandardErrorPath':
+            log_path,
+        'StandardOutPath':
+            log_path
+    }
+    if watch:
+        job['KeepAlive'] = True
+    else:
+        job['StartCalendarInterval'] = {'Hour': 0, 'Minute': 0}
     async with await plist_path.open('wb+') as f:
-        await anyio.to_thread.run_sync(
-            plistlib_dump_xml, {
-                'EnvironmentVariables': {
-                    'NO_COLOR': '1'
-                },
-                'Label':
-                    'sh.tat.macprefs',
-                'ProgramArguments': [
-                    prefs_export_path, '--output-directory',
-                    str(output_dir.resolve(strict=True)), '--commit'
-                ] + (['--deploy-key', deploy_key.resolve(strict=True)] if deploy_key else []),
-                'RunAtLoad':
-                    True,
-                'StandardErrorPath':
-                    log_path,
-                'StandardOutPath':
-                    log_path,
-                'StartCalendarInterval': {
-                    'Hour': 0,
-                    'Minute': 0
-                }
-            }, f.wrapped)
+        await anyio.to_thread.run_sync(plistlib_dump_xml, job, f.wrapped)
     plist_path_s = str(plist_path)
-    cmd: tuple[str, ...] = ('launchctl', 'stop', plist_path_s)
-    log.debug('Running: %s', ' '.join(quote(x) for x in cmd))
-    await (await sp.create_subprocess_exec(*cmd, stderr=sp.PIPE, stdout=sp.PIPE)).wait()
-    cmd = ('launchctl', 'unload', '-w', plist_path_s)
-    log.debug('Running: %s', ' '.join(quote(x) for x in cmd))
-    await (await sp.create_subprocess_exec(*cmd, stderr=sp.PIPE, stdout=sp.PIPE)).wait()
-    cmd = ('launchctl', 'load', '-w', plist_path_s)
-    log.debug('Running: %s', ' '.join(quote(x) for x in cmd))
-    process1 = await sp.create_subprocess_exec(*cmd)
-    await process1.wait()
-    cmd = ('launchctl', 'start', plist_path_s)
-    log.debug('Running: %s', ' '.join(quote(x) for x in cmd))
-    process2 = await sp.create_subprocess_exec(*cmd)
-    await process2.wait()
-    return 0 if process1.returncode == 0 and process2.returncode == 0 else 1
+    launchctl = tool_path('launchctl')
+    await run_process(launchctl, 'stop', plist_path_s, timeout=LAUNCHCTL_TIMEOUT_SECONDS)
+    await run_process(launchctl, 'unload', '-w', plist_path_s, timeout=LAUNCHCTL_TIMEOUT_SECONDS)
+    ret = 0
+    for cmd in (('load', '-w'), ('start',)):
+        p = await run_process(launchctl, *cmd, plist_path_s, timeout=LAUNCHCTL_TIMEOUT_SECONDS)
+        if p.returncode != 0:
+            log.error('`launchctl %s` failed: %s', cmd[0],
+                      p.stderr.decode(errors='replace').strip())
+            ret = 1
+    return ret
 
 
 async def prefs_export(out_dir: Path,
                        config: dict[str, Any] | None = None,
                        deploy_key: Path | None = None,
                        *,
-                       commit: bool = False) -> None:
+                       binary: bool = False,
+                       canonical: bool = False,
+                       clear_negative_cache: bool = False,
+                       commit: bool = False,
+                       domain_globs: Iterable[str] = (),
+                       domain_timeout: float | None = None,
+                       domains: Iterable[str] = (),
+                       filter_stats: FilterStats | None = None,
+                       jobs: Jobs = 'auto',
+                       key_filter: KeyFilter | None = None,
+                       metrics_file: Path | None = None,
+                       read_rate: float | None = None,
+                       record_stats: bool = False,
+                       resume: bool = False,
+                       skip_rejected: bool = False,
+                       run_timeout: float | None = None,
+                       snapshot: SnapshotCache | None = None) -> ExportReport:
     """
     Export filtered preferences to a directory.
 
     Also writes scripts `exec-defaults.sh` and `rejected-defaults.sh` to the output directory, both
     of which contain ``defaults`` commands to set preferences equivalent to the exported property
-    list files.
+    list files. The commands of each domain are kept in a fragment, ``scripts/<domain>.sh`` and
+    ``scripts/rejected/<domain>.sh``, and the scripts are assembled by concatenating the fragments
+    in domain order.
+
+    ``domains`` and ``domain_globs`` limit the export to the domains with these names or matching
+    these :py:mod:`fnmatch` patterns. Only their property lists and fragments are updated, and the
+    scripts are assembled from the fragments of the other domains as they are. Key statistics are
+    not recorded and the snapshot keeps the other domains. If there are no fragments yet, all
+    domains are exported.
+
+    The key filter is applied while the property lists are cleaned, so ignored keys are only cleaned
+    when `rejected-defaults.sh` is written. If ``skip_rejected`` is ``True``, ignored keys are
+    dropped while parsing and `rejected-defaults.sh` is not written (an existing one is removed).
+    Domains that only have ignored keys are then not exported.
+
+    If ``binary`` is ``True``, the property lists are stored in binary format and the output
+    directory is set up so that Git diffs still show XML. See :py:func:`setup_plist_diff_driver`.
+
+    Each item of the ``sinks`` list in ``config``, a :py:class:`macprefs.sinks.Sink` or a table as
+    in the configuration file, is an additional output directory with its own filters and options.
+    Property lists are still copied and parsed once. Each domain exported to ``out_dir`` is then
+    cleaned with the key filter of every sink that accepts it, written to its fragments and copied,
+    converting only if the format differs. The scripts of the sinks are assembled and committed like
+    the ones of ``out_dir``. Ignored keys are kept while parsing so that every sink can use them.
+
+    If ``canonical`` is ``True``, the property lists are written in a deterministic form so that
+    semantically identical preferences always produce identical files. See
+    :py:func:`convert_plist`.
+
+    The cleaned roots are stored in a snapshot in the state directory. Domains whose source has not
+    changed since are reused from it without copying, parsing or converting. See
+    :py:func:`load_snapshot`. A long-running caller can pass the ``snapshot`` loaded with the same
+    options to keep it in memory between exports.
+
+    Property lists that cannot be read or parsed are remembered in the state directory and skipped
+    until they change. See :py:func:`defaults_export`. ``clear_negative_cache`` forgets them first.
+
+    If ``filter_stats`` is given, the domain and key filters record their hits and timings in it.
+    See :py:class:`macprefs.processing.FilterStats`.
+
+    ``jobs`` limits how many domains are exported and converted at once. With ``'auto'``, the limit
+    is sized from the CPU count and the file descriptor limit and adjusted from task durations. See
+    :py:class:`macprefs.concurrency.AdaptiveLimiter`. Domains with the largest property lists are
+    started first. The scripts are still written in domain order.
+
+    ``read_rate`` limits the rate at which property lists are copied, in bytes per second. See
+    :py:class:`macprefs.concurrency.RateLimiter`. Together with a small ``jobs`` value and
+    :py:func:`macprefs.concurrency.lower_priority`, it keeps a background export from slowing down
+    other work.
+
+    ``key_filter`` is used instead of creating the key filter from ``config``, for example one
+    loaded by :py:func:`macprefs.config.load_config`. It is ignored if ``filter_stats`` is given.
+
+    If ``record_stats`` is ``True``, the values of accepted keys are recorded in the state directory
+    so that volatile keys can be found with :py:func:`macprefs.stats.find_volatile_keys`.
+
+    ``domain_timeout`` limits the time spent copying and parsing one domain, and ``run_timeout``
+    the time until all domains are exported, in seconds. A domain that runs out of time is cancelled
+    and keeps its previous property list and script fragments. The rest of the export, including
+    the conversions and the commit, still runs.
+
+    Each domain is exported, rendered and converted on its own, and recorded in a journal in the
+    state directory once it is finished. All files are replaced atomically. If the run is
+    interrupted, ``resume`` continues it: domains in the journal whose source has not changed are
+    skipped, as long as the options are the same. Key statistics are then not recorded. The journal
+    is removed when the run completes.
+
+    If ``metrics_file`` is given, the report is written to it in the OpenMetrics text format after
+    the run, also when a conversion fails. See :py:meth:`macprefs.report.ExportReport.openmetrics`.
+
+    Returns
+    -------
+    ExportReport
+        The domains that timed out or were resumed, and counters and stage durations of the run.
 
     Raises
     ------
     PropertyListConversionError
         If any ``plutil`` command fails.
     """
+    start = perf_counter()
+    spawns = sum(default_runner().stats.spawns.values())
+    deadline = None if run_timeout is None else monotonic() + run_timeout
     config = config or {}
     has_git = await is_git_installed()
     out_dir, repo_prefs_dir = await setup_output_directory(out_dir)
-    export_tasks = []
-    all_data: list[tuple[str, PlistRoot]] = []
-    async for domain in generate_domains(
-        {*config.get('extend-ignore-domains', []), *config.get('ignore-domains', [])}, {
-            *config.get('extend-ignore-domain-prefixes', []),
-            *config.get('ignore-domain-prefixes', [])
-        },
-            reset_domains='ignore-domains' in config,
-            reset_prefixes='ignore-domain-prefixes' in config):
-        export_tasks.append(defaults_export(domain, repo_prefs_dir))
-        if len(export_tasks) == MAX_CONCURRENT_EXPORT_TASKS:
-            all_data.extend(await asyncio.gather(*export_tasks))
-            export_tasks = []
-    all_data.extend(await asyncio.gather(*export_tasks))
-    exec_defaults = out_dir / 'exec-defaults.sh'
-    tasks = []
-    known_domains = []
-    key_filter = make_key_filter(
-        {*config.get('extend-ignore-key-regexes', []), *config.get('ignore-key-regexes', [])}, {
-            **config.get('extend-ignore-keys', {}),
-            **config.get('ignore-keys', {})
-        },
-        reset_re='ignore-key-regexes' in config,
-        reset_bad_keys='ignore-keys' in config)
-    async with await exec_defaults.open('w+') as f:
-        await f.write('#!/usr/bin/env bash\n')
-        await f.write('# shellcheck disable=SC1003,SC1010,SC1112,SC2016,SC2088\n')
-        await f.write('# This file is generated, but is versioned.\n\n')
-        for domain, root in sorted(all_data, key=operator.itemgetter(0)):
-            if not root:  # Skip empty dicts
-                continue
-            for line in plist_to_defaults_commands(domain, root, key_filter):
-                await f.write(f'{line}\n')
-            out_domain = ('globalDomain' if domain == GLOBAL_DOMAIN_ARG else domain)
-            known_domains.append(out_domain)
-            plist_path = repo_prefs_dir / f'{out_domain}.plist'
-            log.debug('Executing: plutil -convert xml1 %s', quote(plist_path.name))
-            p = await sp.create_subprocess_exec('plutil', '-convert', 'xml1', plist_path)
-            tasks.append(asyncio.create_task(p.wait()))
-    await exec_defaults.chmod(0o755)
-    rejected_defaults = out_dir / 'rejected-defaults.sh'
-    async with await rejected_defaults.open('w+') as f:
-        await f.write('# Rejected defaults values.\n')
-        await f.write('# shellcheck disable=SC1003,SC1010,SC1112,SC2016,SC2088\n')
-        await f.write('# This file is generated, but is versioned.\n\n')
-        for domain, root in sorted(all_data, key=operator.itemgetter(0)):
-            if not root:  # Skip empty dicts
-                continue
-            for line in plist_to_defaults_commands(domain, root, key_filter, invert_filters=True):
-                await f.write(f'{line}\n')
-    results = (await asyncio.wait(tasks))[0]
-    if any(future.result() != 0 for future in results):
+    state_dir = await setup_state_directory(out_dir)
+    if binary:
+        await setup_plist_diff_driver(out_dir, has_git=has_git)
+    negative_cache = await anyio.to_thread.run_sync(
+        NegativeCache.load, pathlib.Path(state_dir / NEGATIVE_CACHE_FILENAME))
+    if clear_negative_cache:
+        log.debug('Clearing the negative cache.')
+        negative_cache.clear()
+    if snapshot is None:
+        snapshot = await load_snapshot(out_dir,
+                                       config,
+                                       binary=binary,
+                                       canonical=canonical,
+                                       skip_rejected=skip_rejected and not config.get('sinks'))
+    # A previous export that failed did not save the snapshot and left its hits behind.
+    snapshot.hits.clear()
+    if key_filter is None or filter_stats is not None:
+        key_filter = make_configured_key_filter(config, filter_stats)
+    scripts_dir = out_dir / SCRIPTS_DIRECTORY_NAME
+    # macprefs.sinks imports this module.
+    from .sinks import _setup_sinks  # ruff:ignore[import-outside-top-level]
+    sinks = await _setup_sinks(config, has_git=has_git)
+    if (selected := _domain_selector(
+            domains, domain_globs)) is not None and (not (await scripts_dir.exists())
+                                                     or any(x.new for x in sinks)):
+        log.info('Exporting all domains because there are no script fragments yet.')
+        selected = None
+    await (scripts_dir / REJECTED_SCRIPTS_DIRECTORY_NAME).mkdir(parents=True, exist_ok=True)
+    journal = await _load_journal(state_dir,
+                                  config_fingerprint(config,
+                                                     binary=binary,
+                                                     canonical=canonical,
+                                                     sinks=[str(x.sink.out_dir) for x in sinks],
+                                                     skip_rejected=skip_rejected),
+                                  resume=resume)
+    report = ExportReport()
+    exporter = _DomainExport(repo_prefs_dir,
+                             scripts_dir,
+                             journal,
+                             key_filter,
+                             AdaptiveLimiter.from_jobs(jobs),
+                             negative_cache,
+                             report,
+                             snapshot,
+                             binary=binary,
+                             canonical=canonical,
+                             deadline=deadline,
+                             domain_timeout=domain_timeout,
+                             read_limiter=None if read_rate is None else RateLimiter(read_rate),
+                             resume=resume,
+                             sinks=sinks,
+                             skip_rejected=skip_rejected)
+    all_domains = await _largest_first([
+        x async for x in _generate_configured_domains(config, filter_stats)
+        if selected is None or selected(x)
+    ])
+    report.domains_scanned = len(all_domains)
+    report.stage_seconds['setup'] = perf_counter() - start
+    with report.stage('export'):
+        all_data = await exporter.run(all_domains)
+    report.failed.sort()
+    report.resumed.sort()
+    report.timed_out.sort()
+    if report.resumed:
+        log.info('Resumed after %d domain(s) finished by the interrupted run.', len(report.resumed))
+    if report.timed_out:
+        log.warning('Timed out exporting %d domain(s). Their previous export was kept: %s',
+                    len(report.timed_out), ', '.join(report.timed_out))
+    with report.stage('scripts'):
+        await _remove_stale_fragments(scripts_dir, exporter.known, selected)
+        await _remove_stale_fragments(scripts_dir / REJECTED_SCRIPTS_DIRECTORY_NAME,
+                                      () if skip_rejected else exporter.known, selected)
+        report.bytes_written += await _assemble_scripts(out_dir, skip_rejected=skip_rejected)
+        for sink_export in sinks:
+            sink = sink_export.sink
+            await _remove_stale_fragments(sink.out_dir / SCRIPTS_DIRECTORY_NAME, sink_export.known,
+                                          selected)
+            await _remove_stale_fragments(
+                sink.out_dir / SCRIPTS_DIRECTORY_NAME / REJECTED_SCRIPTS_DIRECTORY_NAME,
+                () if sink.skip_rejected else sink_export.known, selected)
+            report.bytes_written += await _assemble_scripts(sink.out_dir,
+                                                            skip_rejected=sink.skip_rejected)
+    with report.stage('save'):
+        await anyio.to_thread.run_sync(negative_cache.save)
+        if record_stats and selected is None and not report.resumed:
+            await anyio.to_thread.run_sync(record_key_stats,
+                                           pathlib.Path(state_dir / KEY_STATS_FILENAME), all_data,
+                                           key_filter)
+        if not report.failed:
+            if selected is None:
+                snapshot.retain(all_domains)
+            await anyio.to_thread.run_sync(snapshot.save)
+    if report.failed:
+        await _finish_report(report, metrics_file, spawns)
         raise PropertyListConversionError
-    if has_git and (delete_with_git := [
-            str(x) async for x in repo_prefs_dir.iterdir()
-            if x.name != '.gitignore' and x.name[:-6] not in known_domains and (await x.exists())
-            if not (await x.is_dir())
-    ]):
-        # Clean up very old plists
-        await git(('rm', '-f', '--ignore-unmatch', '--', *delete_with_git), out_dir)
-        log.debug('Executing: rm -f -- %s', ' '.join(map(quote, delete_with_git)))
-        p = await sp.create_subprocess_exec('rm', '-f', '--', *delete_with_git, stderr=sp.PIPE)
-        await p.wait()
-    if has_git and commit:
-        log.debug('Committing changes.')
-        await git(('add', '.'), out_dir)
+    if has_git:
+        await _commit_export(out_dir,
+                             deploy_key,
+                             exporter.known,
+                             selected,
+                             commit=commit,
+                             report=report)
+        for sink_export in sinks:
+            await _commit_export(sink_export.sink.out_dir,
+                                 sink_export.sink.deploy_key,
+                                 sink_export.known,
+                                 selected,
+                                 commit=sink_export.sink.commit,
+                                 report=report)
+    await anyio.to_thread.run_sync(partial(journal.close, remove=True))
+    report.success = True
+    await _finish_report(report, metrics_file, spawns)
+    log.debug('Subprocesses run so far:\n%s', default_runner().stats.report().rstrip())
+    return report
+
+
+async def _load_journal(state_dir: Path, fingerprint: str, *, resume: bool) -> RunJournal:
+    path = pathlib.Path(state_dir / JOURNAL_FILENAME)
+    if not resume:
+        return RunJournal(path, fingerprint)
+    journal = await anyio.to_thread.run_sync(RunJournal.load, path, fingerprint)
+    if not journal.entries:
+        log.info('Nothing to resume. Exporting all domains.')
+    return journal
+
+
+async def _commit_export(out_dir: Path, deploy_key: Path | None, known_domains: Container[str],
+                         selected: Callable[[str], bool] | None, *, commit: bool,
+                         report: ExportReport) -> None:
+    repo_prefs_dir = out_dir / 'Preferences'
+    with report.stage('cleanup'):
+        if delete_with_git := [
+                str(x) async for x in repo_prefs_dir.iterdir()
+                if x.name != '.gitignore' and x.name[:-6] not in known_domains and (
+                    selected is None or selected(x.name[:-6])) and (await x.exists())
+                if not (await x.is_dir())
+        ]:
+            # Clean up very old plists
+            await git(('rm', '-f', '--ignore-unmatch', '--', *delete_with_git), out_dir)
+            await run_process('rm', '-f', '--', *delete_with_git)
+    if not commit:
+        return
+    log.debug('Committing changes.')
+    with report.stage('commit'):
         try:
-            await git(('commit', '--no-gpg-sign', '--quiet', '--no-verify',
-                       '--author=macprefs <macprefs@tat.sh>', '-m',
-                       f'Automatic commit @ {datetime.now(tz=timezone.utc).strftime("%c")}'),
-                      out_dir)
-            if deploy_key:
+            await git(('add', '.'), out_dir)
+            try:
+                await git(('commit', '--no-gpg-sign', '--quiet', '--no-verify',
+                           '--author=macprefs <macprefs@tat.sh>', '-m',
+                           f'Automatic commit @ {datetime.now(tz=timezone.utc).strftime("%c")}'),
+                          out_dir)
+            except CalledProcessError:
+                log.info('Likely no changes to commit.')
+                return
+        except TimeoutExpired as e:
+            log.warning('Timed out committing the changes in `%s` after %g seconds.', out_dir,
+                        e.timeout)
+            return
+    if deploy_key:
+        with report.stage('push'):
+            try:
                 await _push_current_branch(out_dir)
-        except CalledProcessError:
-            log.info('Likely no changes to commit.')
+            except CalledProcessError:
+                log.info('Likely no changes to commit.')
+            except TimeoutExpired as e:
+                log.warning('Timed out pushing the changes in `%s` after %g seconds.', out_dir,
+                            e.timeout)
+
+
+async def _finish_report(report: ExportReport, metrics_file: Path | None, spawns: int) -> None:
+    report.subprocesses = sum(default_runner().stats.spawns.values()) - spawns
+    report.peak_rss_bytes = peak_rss_bytes()
+    if metrics_file is not None:
+        log.debug('Writing metrics to %s.', metrics_file)
+        await anyio.to_thread.run_sync(atomic_write, metrics_file, report.openmetrics())
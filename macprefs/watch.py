@@ -0,0 +1,254 @@
+"""Watching the preferences directory for changes."""
+from __future__ import annotations
+
+from contextlib import suppress
+from functools import partial
+from subprocess import CalledProcessError
+from time import monotonic
+from typing import TYPE_CHECKING, Any
+import asyncio
+import logging
+import os
+import select
+
+from anyio import Path
+from typing_extensions import Self
+import anyio.to_thread
+
+from .config import make_configured_key_filter
+from .constants import (
+    GLOBAL_DOMAIN_ARG,
+    WATCH_DEBOUNCE_SECONDS,
+    WATCH_MAX_DELAY_SECONDS,
+    WATCH_POLL_INTERVAL_SECONDS,
+)
+from .exceptions import PropertyListConversionError
+from .lock import locked_export
+from .utils import _domain_selector, _generate_configured_domains, load_snapshot
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncGenerator, Iterable
+    from types import TracebackType
+
+    from .processing import KeyFilter
+    from .typing import FileState
+
+__all__ = ('DirectoryEvents', 'changed_files', 'scan_directory', 'watch_directory', 'watch_export')
+
+log = logging.getLogger(__name__)
+
+
+def scan_directory(directory: str | os.PathLike[str], suffix: str = '.plist') -> FileState:
+    """
+    Get the modification time and size of the files in a directory.
+
+    Returns
+    -------
+    FileState
+        The state of the files whose name ends with ``suffix``.
+    """
+    ret: FileState = {}
+    with os.scandir(directory) as it:
+        for entry in it:
+            if not entry.name.endswith(suffix):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            ret[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    return ret
+
+
+def changed_files(old: FileState, new: FileState) -> set[str]:
+    """
+    Compare two directory states.
+
+    Returns
+    -------
+    set[str]
+        Names of the files that were added, removed or changed.
+    """
+    return {name for name in old.keys() | new.keys() if old.get(name) != new.get(name)}
+
+
+class DirectoryEvents:
+    """
+    Wait for changes to the entries of a directory.
+
+    On macOS, the directory is watched with ``kqueue``. Preference files are replaced atomically, so
+    every write renames a file into the directory and wakes up :py:meth:`wait`. Elsewhere
+    :py:meth:`wait` only sleeps and callers find changes by polling with :py:func:`scan_directory`.
+    """
+    def __init__(self, directory: str | os.PathLike[str]) -> None:
+        self.directory = directory
+        """Directory to watch."""
+        self._fd: int | None = None
+        self._kqueue: select.kqueue | None = None
+
+    def __enter__(self) -> Self:
+        """Start watching the directory."""  # ruff:ignore[docstring-missing-returns]
+        if hasattr(select, 'kqueue'):  # pragma: no cover
+            self._open_kqueue()
+        else:
+            log.debug('Polling `%s`.', self.directory)
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, exc_val: BaseException | None,
+                 exc_tb: TracebackType | None) -> None:
+        """Stop watching the directory."""
+        if self._kqueue is not None:  # pragma: no cover
+            self._kqueue.close()
+            self._kqueue = None
+        if self._fd is not None:  # pragma: no cover
+            os.close(self._fd)
+            self._fd = None
+
+    def _open_kqueue(self) -> None:  # pragma: no cover
+        self._fd = os.open(self.directory, getattr(os, 'O_EVTONLY', os.O_RDONLY))
+        self._kqueue = select.kqueue()
+        self._kqueue.control([
+            select.kevent(self._fd,
+                          filter=select.KQ_FILTER_VNODE,
+                          flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+                          fflags=select.KQ_NOTE_WRITE | select.KQ_NOTE_EXTEND)
+        ], 0, 0)
+        log.debug('Watching `%s` with kqueue.', self.directory)
+
+    async def wait(self, delay: float) -> None:
+        """Wait until the directory changes or ``delay`` seconds have passed."""
+        if self._kqueue is not None:  # pragma: no cover
+            await _wait_kqueue(self._kqueue, delay)
+        else:
+            await asyncio.sleep(delay)
+
+
+async def _wait_kqueue(kq: select.kqueue, delay: float) -> None:  # pragma: no cover
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+    loop.add_reader(kq.fileno(), event.set)
+    try:
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(event.wait(), delay)
+    finally:
+        loop.remove_reader(kq.fileno())
+    if event.is_set():
+        kq.control(None, 16, 0)
+
+
+async def watch_directory(
+        directory: str | os.PathLike[str],
+        *,
+        debounce: float = WATCH_DEBOUNCE_SECONDS,
+        max_delay: float = WATCH_MAX_DELAY_SECONDS,
+        poll_interval: float = WATCH_POLL_INTERVAL_SECONDS) -> AsyncGenerator[set[str], None]:
+    """
+    Watch a directory for changed property lists.
+
+    Changes are collected until none happened for ``debounce`` seconds, or for at most
+    ``max_delay`` seconds while files keep changing. The directory is rescanned at least every
+    ``poll_interval`` seconds.
+
+    Yields
+    ------
+    set[str]
+        Names of the property lists that were added, removed or changed, without the suffix.
+    """
+    state = await anyio.to_thread.run_sync(scan_directory, directory)
+    pending: set[str] = set()
+    first_change = last_change = 0.0
+    with DirectoryEvents(directory) as events:
+        while True:
+            await events.wait(
+                max(0, last_change + debounce - monotonic()) if pending else poll_interval)
+            new_state = await anyio.to_thread.run_sync(scan_directory, directory)
+            changed = changed_files(state, new_state)
+            state = new_state
+            now = monotonic()
+            if changed:
+                log.debug('Changed: %s', ', '.join(sorted(changed)))
+                if not pending:
+                    first_change = now
+                pending |= {name.removesuffix('.plist') for name in changed}
+                last_change = now
+            if pending and (now - last_change >= debounce or now - first_change >= max_delay):
+                yield pending  # ruff:ignore[yield-in-context-manager-in-async-generator]
+                pending = set()
+
+
+def _watched_domain(name: str) -> str:
+    return GLOBAL_DOMAIN_ARG if name == '.GlobalPreferences' else name
+
+
+async def watch_export(out_dir: Path,
+                       config: dict[str, Any] | None = None,
+                       deploy_key: Path | None = None,
+                       *,
+                       binary: bool = False,
+                       canonical: bool = False,
+                       clear_negative_cache: bool = False,
+                       debounce: float = WATCH_DEBOUNCE_SECONDS,
+                       domain_globs: Iterable[str] = (),
+                       domains: Iterable[str] = (),
+                       key_filter: KeyFilter | None = None,
+                       poll_interval: float = WATCH_POLL_INTERVAL_SECONDS,
+                       resume: bool = False,
+                       skip_rejected: bool = False,
+                       **kwargs: Any) -> None:
+    """
+    Export preferences, then export them again whenever they change. Runs until cancelled.
+
+    After the first export, each export is limited to the domains whose property list changed.
+    The key filter and the snapshot stay in memory between exports. Changes that only affect
+    ignored domains, or domains not selected by ``domains`` and ``domain_globs``, do not start an
+    export. See :py:func:`watch_directory` for ``debounce`` and ``poll_interval``.
+    ``clear_negative_cache`` and ``resume`` only apply to the first export.
+
+    Each export holds the run lock of the output directory. Other keyword arguments, including
+    ``lock_mode``, are passed to :py:func:`macprefs.lock.locked_export`. A failed export is
+    logged and the next change is waited for.
+    """
+    config = config or {}
+    if key_filter is None:
+        key_filter = make_configured_key_filter(config)
+    snapshot = await load_snapshot(out_dir,
+                                   config,
+                                   binary=binary,
+                                   canonical=canonical,
+                                   skip_rejected=skip_rejected and not config.get('sinks'))
+    export = partial(locked_export,
+                     out_dir,
+                     config,
+                     deploy_key,
+                     binary=binary,
+                     canonical=canonical,
+                     key_filter=key_filter,
+                     skip_rejected=skip_rejected,
+                     snapshot=snapshot,
+                     **kwargs)
+    domains = list(domains)
+    domain_globs = list(domain_globs)
+    await export(clear_negative_cache=clear_negative_cache,
+                 domain_globs=domain_globs,
+                 domains=domains,
+                 resume=resume)
+    selected = _domain_selector(domains, domain_globs)
+    known = {x async for x in _generate_configured_domains(config)}
+    async for changed in watch_directory((await Path.home()) / 'Library/Preferences',
+                                         debounce=debounce,
+                                         poll_interval=poll_interval):
+        current = {x async for x in _generate_configured_domains(config)}
+        relevant = {
+            x
+            for x in {_watched_domain(y)
+                      for y in changed} & (known | current) if selected is None or selected(x)
+        }
+        known = current
+        if not relevant:
+            log.debug('Ignoring changes to ignored domains.')
+            continue
+        log.info('Exporting after changes to %s.', ', '.join(sorted(relevant)))
+        try:
+            await export(domains=sorted(relevant))
+        except (CalledProcessError, OSError, PropertyListConversionError):
+            log.exception('Export failed.')
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+import pickle  # ruff:ignore[suspicious-pickle-import]
+
+from macprefs.cache import NegativeCache, SnapshotCache, config_fingerprint
+import pytest
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from pytest_mock import MockerFixture
+
+
+def test_negative_cache(tmp_path: Path) -> None:
+    cache_path = tmp_path / 'cache.json'
+    plist = tmp_path / 'test.plist'
+    plist.write_bytes(b'invalid')
+    cache = NegativeCache.load(cache_path)
+    assert cache.contains(str(plist), plist.stat()) is False
+    cache.add(str(plist), plist.stat())
+    cache.save()
+    cache = NegativeCache.load(cache_path)
+    assert cache.contains(str(plist), plist.stat()) is True
+    plist.write_bytes(b'changed content')
+    assert cache.contains(str(plist), plist.stat()) is False
+    assert cache.entries == {}
+
+
+def test_negative_cache_save_unchanged(tmp_path: Path) -> None:
+    cache_path = tmp_path / 'cache.json'
+    NegativeCache.load(cache_path).save()
+    assert not cache_path.exists()
+
+
+def test_negative_cache_clear(tmp_path: Path) -> None:
+    cache_path = tmp_path / 'cache.json'
+    cache = NegativeCache(cache_path, {'a': [1, 2]})
+    cache.clear()
+    cache.save()
+    assert NegativeCache.load(cache_path).entries == {}
+
+
+def test_negative_cache_load_invalid(tmp_path: Path) -> None:
+    cache_path = tmp_path / 'cache.json'
+    cache_path.write_text('[]')
+    assert NegativeCache.load(cache_path).entries == {}
+    cache_path.write_text('invalid')
+    assert NegativeCache.load(cache_path).entries == {}
+
+
+def test_config_fingerprint() -> None:
+    assert config_fingerprint({}) == config_fingerprint({'deploy-key': '/key'})
+    assert config_fingerprint({}) != config_fingerprint({'extend-ignore-keys': {'a': ['b']}})
+    assert config_fingerprint({}) != config_fingerprint({}, binary=True)
+
+
+def test_snapshot_cache_round_trip(tmp_path: Path) -> None:
+    path = tmp_path / 'snapshot.bin'
+    source = tmp_path / 'source.plist'
+    source.write_bytes(b'content')
+    snapshot = SnapshotCache.load(path, 'fp')
+    assert snapshot.domains() == []
+    snapshot.put('b', {'key': 'value'}, source.stat())
+    snapshot.put('a', {'key': [1, 2]})
+    assert snapshot.get('b') == {'key': 'value'}
+    snapshot.save()
+    snapshot = SnapshotCache.load(path, 'fp')
+    assert snapshot.load_all() == {'a': {'key': [1, 2]}, 'b': {'key': 'value'}}
+    assert snapshot.get('missing') is None
+    assert snapshot.get_fresh('missing', source.stat()) is None
+    assert snapshot.get_fresh('a', source.stat()) is None
+    assert snapshot.get_fresh('b', source.stat()) == {'key': 'value'}
+    assert snapshot.hits == {'b'}
+    snapshot.retain(['b'])
+    snapshot.save()
+    assert snapshot.hits == set()
+    assert SnapshotCache.load(path, 'fp').domains() == ['b']
+
+
+def test_snapshot_cache_get_fresh_new_entry(tmp_path: Path) -> None:
+    source = tmp_path / 'source.plist'
+    source.write_bytes(b'content')
+    snapshot = SnapshotCache()
+    snapshot.put('a', {'key': 'value'}, source.stat())
+    assert snapshot.get_fresh('a', source.stat()) == {'key': 'value'}
+    snapshot.save()
+
+
+def test_snapshot_cache_fingerprint_mismatch(tmp_path: Path) -> None:
+    path = tmp_path / 'snapshot.bin'
+    snapshot = SnapshotCache(path, 'fp')
+    snapshot.put('a', {'key': 'value'})
+    snapshot.save()
+    assert SnapshotCache.load(path, 'other').domains() == []
+
+
+def test_snapshot_cache_invalid(tmp_path: Path) -> None:
+    path = tmp_path / 'snapshot.bin'
+    path.write_bytes(b'invalid')
+    assert SnapshotCache.load(path, 'fp').domains() == []
+    path.write_bytes(b'MPSNAP01\x04\x00\x00\x00\x00\x00\x00\x00abcd')
+    assert SnapshotCache.load(path, 'fp').domains() == []
+
+
+@pytest.mark.parametrize('header', [[], {
+    'fingerprint': 'fp'
+}, {
+    'fingerprint': 'fp',
+    'generation': 1,
+    'index': {
+        'a': 'invalid'
+    }
+}])
+def test_snapshot_cache_invalid_header(tmp_path: Path, header: object) -> None:
+    path = tmp_path / 'snapshot.bin'
+    data = pickle.dumps(header)
+    path.write_bytes(b'MPSNAP01' + len(data).to_bytes(8, 'little') + data)
+    assert SnapshotCache.load(path, 'fp').domains() == []
+
+
+def test_snapshot_cache_invalid_load_error(tmp_path: Path, mocker: MockerFixture) -> None:
+    path = tmp_path / 'snapshot.bin'
+    snapshot = SnapshotCache(path, 'fp')
+    snapshot.put('a', {'key': 'value'})
+    snapshot.save()
+    mocker.patch('macprefs.cache.pickle.loads', side_effect=ValueError)
+    assert SnapshotCache.load(path, 'fp').domains() == []
+
+
+def test_snapshot_cache_put_discards_hit(tmp_path: Path) -> None:
+    source = tmp_path / 'source.plist'
+    source.write_bytes(b'content')
+    snapshot = SnapshotCache()
+    snapshot.put('a', {'key': 'value'}, source.stat())
+    snapshot.put('b', {'key': 'value'}, source.stat())
+    assert snapshot.get_fresh('a', source.stat()) == {'key': 'value'}
+    assert snapshot.get_fresh('b', source.stat()) == {'key': 'value'}
+    snapshot.put('a', {'key': 'changed'}, source.stat())
+    snapshot.remove('b')
+    assert snapshot.hits == set()
+
+
+def test_snapshot_cache_eviction(tmp_path: Path) -> None:
+    path = tmp_path / 'snapshot.bin'
+    source = tmp_path / 'source.plist'
+    source.write_bytes(b'content')
+    snapshot = SnapshotCache(path, 'fp', max_bytes=150)
+    snapshot.put('old', {'key': 'x' * 50}, source.stat())
+    snapshot.put('used', {'key': 'y' * 50}, source.stat())
+    snapshot.save()
+    snapshot = SnapshotCache.load(path, 'fp', max_bytes=150)
+    assert snapshot.get_fresh('used', source.stat()) is not None
+    snapshot.put('new', {'key': 'z' * 50})
+    snapshot.save()
+    assert SnapshotCache.load(path, 'fp').domains() == ['new', 'used']
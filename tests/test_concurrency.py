@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+import asyncio
+import errno
+import resource
+
+from macprefs.concurrency import AdaptiveLimiter, RateLimiter, auto_jobs, fd_limit, lower_priority
+import pytest
+
+if TYPE_CHECKING:
+    from pytest_mock import MockerFixture
+
+
+def test_fd_limit_infinity(mocker: MockerFixture) -> None:
+    mocker.patch('macprefs.concurrency.resource.getrlimit',
+                 return_value=(resource.RLIM_INFINITY, resource.RLIM_INFINITY))
+    assert fd_limit() == 65536
+
+
+@pytest.mark.parametrize(('cpus', 'nofile', 'expected'), [(4, 10240, 32), (16, 256, 56),
+                                                          (None, 10240, 8), (4, 10, 1)])
+def test_auto_jobs(mocker: MockerFixture, cpus: int | None, nofile: int, expected: int) -> None:
+    mocker.patch('macprefs.concurrency.os.cpu_count', return_value=cpus)
+    mocker.patch('macprefs.concurrency.resource.getrlimit', return_value=(nofile, nofile))
+    assert auto_jobs() == expected
+
+
+def test_from_jobs(mocker: MockerFixture) -> None:
+    mocker.patch('macprefs.concurrency.auto_jobs', return_value=100)
+    limiter = AdaptiveLimiter.from_jobs('auto')
+    assert (limiter.limit, limiter.max_limit, limiter.adaptive) == (40, 100, True)
+    limiter = AdaptiveLimiter.from_jobs(3)
+    assert (limiter.limit, limiter.max_limit, limiter.adaptive) == (3, 3, False)
+
+
+@pytest.mark.asyncio
+async def test_run_limits_concurrency() -> None:
+    limiter = AdaptiveLimiter(2)
+    running = 0
+    peak = 0
+
+    async def task(x: int) -> int:
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0)
+        running -= 1
+        return x
+
+    assert await asyncio.gather(*(limiter.run(task, x) for x in range(6))) == list(range(6))
+    assert peak == 2
+    assert limiter.active == 0
+
+
+@pytest.mark.asyncio
+async def test_run_retries_on_emfile(mocker: MockerFixture) -> None:
+    mocker.patch('macprefs.concurrency.FD_RETRY_DELAY_SECONDS', 0)
+    limiter = AdaptiveLimiter(8)
+    func = mocker.AsyncMock(side_effect=[
+        OSError(errno.EMFILE, 'Too many open files'),
+        BlockingIOError(errno.EAGAIN, 'Resource temporarily unavailable'), 'ok'
+    ])
+    assert await limiter.run(func, 'arg') == 'ok'
+    assert func.await_count == 3
+    assert limiter.limit == limiter.max_limit == 1
+    assert limiter.active == 0
+
+
+@pytest.mark.asyncio
+async def test_run_gives_up(mocker: MockerFixture) -> None:
+    mocker.patch('macprefs.concurrency.FD_RETRY_DELAY_SECONDS', 0)
+    mocker.patch('macprefs.concurrency.FD_RETRY_ATTEMPTS', 1)
+    limiter = AdaptiveLimiter(2)
+    func = mocker.AsyncMock(side_effect=OSError(errno.EMFILE, 'Too many open files'))
+    with pytest.raises(OSError, match='Too many open files'):
+        await limiter.run(func)
+    assert func.await_count == 2
+    func = mocker.AsyncMock(side_effect=PermissionError(errno.EACCES, 'Permission denied'))
+    with pytest.raises(PermissionError):
+        await limiter.run(func)
+    assert func.await_count == 1
+    assert limiter.active == 0
+
+
+def test_adaptive_limit() -> None:
+    limiter = AdaptiveLimiter(8, 16, adaptive=True)
+    for _ in range(8):
+        limiter.record(0.01)
+    assert limiter.limit == 9
+    for _ in range(9):
+        limiter.record(1.0)
+    assert limiter.limit == 6
+    for _ in range(200):
+        limiter.record(0.01)
+    assert limiter.limit == 16
+
+
+def test_fixed_limit() -> None:
+    limiter = AdaptiveLimiter(8)
+    for _ in range(100):
+        limiter.record(0.01)
+    assert limiter.limit == 8
+
+
+def test_lower_priority(mocker: MockerFixture) -> None:
+    mocker.patch('macprefs.concurrency.sys.platform', 'darwin')
+    mocker.patch('macprefs.concurrency.os.getpriority', return_value=0)
+    mock_setpriority = mocker.patch('macprefs.concurrency.os.setpriority')
+    mock_cdll = mocker.patch('macprefs.concurrency.ctypes.CDLL')
+    mock_cdll.return_value.setiopolicy_np.return_value = 0
+    lower_priority()
+    mock_setpriority.assert_called_once_with(mocker.ANY, 0, 10)
+    mock_cdll.return_value.setiopolicy_np.assert_called_once_with(0, 0, 3)
+
+
+def test_lower_priority_failures(mocker: MockerFixture) -> None:
+    mocker.patch('macprefs.concurrency.sys.platform', 'darwin')
+    mocker.patch('macprefs.concurrency.os.getpriority', return_value=0)
+    mocker.patch('macprefs.concurrency.os.setpriority',
+                 side_effect=PermissionError(errno.EACCES, 'Permission denied'))
+    mock_cdll = mocker.patch('macprefs.concurrency.ctypes.CDLL')
+    mock_cdll.return_value.setiopolicy_np.return_value = -1
+    mocker.patch('macprefs.concurrency.ctypes.get_errno', return_value=errno.EPERM)
+    mock_log_warning = mocker.patch('macprefs.concurrency.log.warning')
+    lower_priority()
+    assert mock_log_warning.call_count == 2
+
+
+def test_lower_priority_already_low(mocker: MockerFixture) -> None:
+    mocker.patch('macprefs.concurrency.sys.platform', 'linux')
+    mocker.patch('macprefs.concurrency.os.getpriority', return_value=19)
+    mock_setpriority = mocker.patch('macprefs.concurrency.os.setpriority')
+    mock_cdll = mocker.patch('macprefs.concurrency.ctypes.CDLL')
+    lower_priority()
+    mock_setpriority.assert_not_called()
+    mock_cdll.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter(mocker: MockerFixture) -> None:
+    mock_monotonic = mocker.patch('macprefs.concurrency.monotonic', return_value=100.0)
+    mock_sleep = mocker.patch('macprefs.concurrency.asyncio.sleep')
+    limiter = RateLimiter(1000)
+    await limiter.acquire(600)
+    mock_sleep.assert_not_called()
+    await limiter.acquire(900)
+    mock_sleep.assert_awaited_once_with(0.5)
+    mock_monotonic.return_value = 101.0
+    await limiter.acquire(500)
+    mock_sleep.assert_awaited_once()
+    await limiter.acquire(250)
+    mock_sleep.assert_awaited_with(0.25)
+    mock_sleep.reset_mock()
+    mock_monotonic.return_value = 110.0
+    await limiter.acquire(1000)
+    mock_sleep.assert_not_called()
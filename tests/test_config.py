@@ -1,10 +1,17 @@
 from __future__ import annotations
 
 from pathlib import Path
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any
+import errno
+import pickle  # ruff:ignore[suspicious-pickle-import]
 
-from macprefs.config import read_config
-from macprefs.exceptions import ConfigTypeError
+from macprefs.config import (
+    _has_ambiguous_repetition,  # ruff:ignore[import-private-name]
+    load_config,
+    make_configured_domain_filter,
+    read_config,
+)
+from macprefs.exceptions import ConfigRegexError, ConfigTypeError
 import pytest
 
 if TYPE_CHECKING:
@@ -22,7 +29,7 @@ def test_read_config_no_file(mocker: MockerFixture) -> None:
 def test_read_config_file_exists(mocker: MockerFixture) -> None:
     mocker.patch('macprefs.config.Path.exists', return_value=True)
     mocker.patch('macprefs.config.Path.read_text', return_value='')
-    mock_tomlkit_loads = mocker.patch('macprefs.config.tomlkit.loads',
+    mock_tomllib_loads = mocker.patch('macprefs.config.tomllib.loads',
                                       return_value={'tool': {
                                           'macprefs': {
                                               'key': 'value'
@@ -35,13 +42,13 @@ def test_read_config_file_exists(mocker: MockerFixture) -> None:
         'extend-ignore-domain-prefixes': [],
         'extend-ignore-domains': []
     }
-    mock_tomlkit_loads.assert_called_once()
+    mock_tomllib_loads.assert_called_once()
 
 
 def test_read_config_invalid_mapping(mocker: MockerFixture) -> None:
     mocker.patch('macprefs.config.Path.exists', return_value=True)
     mocker.patch('macprefs.config.Path.read_text', return_value='')
-    mocker.patch('macprefs.config.tomlkit.loads',
+    mocker.patch('macprefs.config.tomllib.loads',
                  return_value={'tool': {
                      'macprefs': {
                          'ignore-keys': 'not-a-dict'
@@ -54,7 +61,7 @@ def test_read_config_invalid_mapping(mocker: MockerFixture) -> None:
 def test_read_config_invalid_sequence(mocker: MockerFixture) -> None:
     mocker.patch('macprefs.config.Path.exists', return_value=True)
     mocker.patch('macprefs.config.Path.read_text', return_value='')
-    mocker.patch('macprefs.config.tomlkit.loads',
+    mocker.patch('macprefs.config.tomllib.loads',
                  return_value={'tool': {
                      'macprefs': {
                          'ignore-key-regexes': 123
@@ -67,7 +74,7 @@ def test_read_config_invalid_sequence(mocker: MockerFixture) -> None:
 def test_read_config_invalid_sequence_inner_type(mocker: MockerFixture) -> None:
     mocker.patch('macprefs.config.Path.exists', return_value=True)
     mocker.patch('macprefs.config.Path.read_text', return_value='')
-    mocker.patch('macprefs.config.tomlkit.loads',
+    mocker.patch('macprefs.config.tomllib.loads',
                  return_value={'tool': {
                      'macprefs': {
                          'ignore-key-regexes': [1, 2, 3]
@@ -80,7 +87,7 @@ def test_read_config_invalid_sequence_inner_type(mocker: MockerFixture) -> None:
 def test_read_config_list_of_strings(mocker: MockerFixture) -> None:
     mocker.patch('macprefs.config.Path.exists', return_value=True)
     mocker.patch('macprefs.config.Path.read_text', return_value='')
-    mocker.patch('macprefs.config.tomlkit.loads',
+    mocker.patch('macprefs.config.tomllib.loads',
                  return_value={'tool': {
                      'macprefs': {
                          'ignore-key-regexes': ['a', 'b', 'c']
@@ -99,7 +106,7 @@ def test_read_config_list_of_strings(mocker: MockerFixture) -> None:
 def test_read_config_dict_to_invalid_type(mocker: MockerFixture) -> None:
     mocker.patch('macprefs.config.Path.exists', return_value=True)
     mocker.patch('macprefs.config.Path.read_text', return_value='')
-    mocker.patch('macprefs.config.tomlkit.loads',
+    mocker.patch('macprefs.config.tomllib.loads',
                  return_value={'tool': {
                      'macprefs': {
                          'extend-ignore-keys': {
@@ -114,7 +121,7 @@ def test_read_config_dict_to_invalid_type(mocker: MockerFixture) -> None:
 def test_read_config_dict_to_invalid_type_inner(mocker: MockerFixture) -> None:
     mocker.patch('macprefs.config.Path.exists', return_value=True)
     mocker.patch('macprefs.config.Path.read_text', return_value='')
-    mocker.patch('macprefs.config.tomlkit.loads',
+    mocker.patch('macprefs.config.tomllib.loads',
                  return_value={'tool': {
                      'macprefs': {
                          'extend-ignore-keys': {
@@ -130,7 +137,7 @@ def test_read_config_dict(mocker: MockerFixture) -> None:
     mocker.patch('macprefs.config.Path.exists', return_value=True)
     mocker.patch('macprefs.config.Path.read_text', return_value='')
     mocker.patch(
-        'macprefs.config.tomlkit.loads',
+        'macprefs.config.tomllib.loads',
         return_value={'tool': {
             'macprefs': {
                 'extend-ignore-keys': {
@@ -154,7 +161,7 @@ def test_read_config_deploy_key_warning(mocker: MockerFixture) -> None:
     mock_path = mocker.MagicMock()
     mock_path.return_value.exists.side_effect = [True, False]
     mock_path.return_value.read_text.return_value = ''
-    mocker.patch('macprefs.config.tomlkit.loads',
+    mocker.patch('macprefs.config.tomllib.loads',
                  return_value={'tool': {
                      'macprefs': {
                          'deploy-key': '/fake/deploy-key'
@@ -176,7 +183,7 @@ def test_read_config_deploy_key(mocker: MockerFixture) -> None:
     mock_path = mocker.MagicMock()
     mock_path.return_value.exists.side_effect = [True, False]
     mock_path.return_value.read_text.return_value = ''
-    mocker.patch('macprefs.config.tomlkit.loads',
+    mocker.patch('macprefs.config.tomllib.loads',
                  return_value={'tool': {
                      'macprefs': {
                          'deploy-key': '/fake/deploy-key'
@@ -190,3 +197,408 @@ def test_read_config_deploy_key(mocker: MockerFixture) -> None:
         'extend-ignore-domains': [],
         'deploy-key': '/fake/deploy-key'
     }
+
+
+def test_read_config_binary(mocker: MockerFixture) -> None:
+    mocker.patch('macprefs.config.Path.exists', return_value=True)
+    mocker.patch('macprefs.config.Path.read_text', return_value='')
+    mocker.patch('macprefs.config.tomllib.loads',
+                 return_value={'tool': {
+                     'macprefs': {
+                         'binary': True
+                     }
+                 }})
+    result = read_config(Path('/fake/path'))
+    assert result['binary'] is True
+
+
+def test_read_config_binary_invalid(mocker: MockerFixture) -> None:
+    mocker.patch('macprefs.config.Path.exists', return_value=True)
+    mocker.patch('macprefs.config.Path.read_text', return_value='')
+    mocker.patch('macprefs.config.tomllib.loads',
+                 return_value={'tool': {
+                     'macprefs': {
+                         'binary': 'yes'
+                     }
+                 }})
+    with pytest.raises(ConfigTypeError, match='binary must be of type boolean'):
+        read_config(Path('/fake/path'))
+
+
+def test_read_config_invalid_regex(mocker: MockerFixture) -> None:
+    mocker.patch('macprefs.config.Path.exists', return_value=True)
+    mocker.patch('macprefs.config.Path.read_text', return_value='')
+    mocker.patch(
+        'macprefs.config.tomllib.loads',
+        return_value={'tool': {
+            'macprefs': {
+                'extend-ignore-key-regexes': ['^ok', '(unclosed']
+            }
+        }})
+    with pytest.raises(ConfigRegexError, match=r'extend-ignore-key-regexes .*`\(unclosed`'):
+        read_config(Path('/fake/path'))
+
+
+def test_read_config_slow_regex(mocker: MockerFixture) -> None:
+    mocker.patch('macprefs.config.Path.exists', return_value=True)
+    mocker.patch('macprefs.config.Path.read_text', return_value='')
+    mocker.patch('macprefs.config.tomllib.loads',
+                 return_value={
+                     'tool': {
+                         'macprefs': {
+                             'extend-ignore-keys': {
+                                 'domain': ['plain', 're:^a.*b.*c$']
+                             }
+                         }
+                     }
+                 })
+    mocker.patch('macprefs.config.REGEX_STRESS_BUDGET_SECONDS', -1)
+    mock_logger = mocker.patch('macprefs.config.log.warning')
+    result = read_config(Path('/fake/path'))
+    assert result['extend-ignore-keys'] == {'domain': ['plain', 're:^a.*b.*c$']}
+    mock_logger.assert_called_once_with(mocker.ANY, 'extend-ignore-keys.domain', '^a.*b.*c$',
+                                        mocker.ANY, 9)
+
+
+@pytest.mark.parametrize('pattern', ['(a+)+$', '^(?:x|xxy)*z'])
+def test_read_config_ambiguous_repetition(mocker: MockerFixture, pattern: str) -> None:
+    mocker.patch('macprefs.config.Path.exists', return_value=True)
+    mocker.patch('macprefs.config.Path.read_text', return_value='')
+    mocker.patch(
+        'macprefs.config.tomllib.loads',
+        return_value={'tool': {
+            'macprefs': {
+                'ignore-key-regexes': ['^Apple[A-Z]+', pattern]
+            }
+        }})
+    mock_perf_counter = mocker.patch('macprefs.config.perf_counter', return_value=0)
+    mock_logger = mocker.patch('macprefs.config.log.warning')
+    result = read_config(Path('/fake/path'))
+    assert result['ignore-key-regexes'] == ['^Apple[A-Z]+', pattern]
+    mock_logger.assert_called_once_with(mocker.ANY, 'ignore-key-regexes', pattern)
+    # The ambiguous pattern is not timed.
+    assert mock_perf_counter.call_count == len(range(8, 34, 2)) * 8 * 2
+
+
+@pytest.mark.parametrize(
+    'pattern', [r'(?:\w+\.)+Frame', r'(\d+,)*\d+', '(?:[A-Z][a-z]+)+Window', '^(?:x|y)+z'])
+def test_read_config_unambiguous_repetition(mocker: MockerFixture, pattern: str) -> None:
+    mocker.patch('macprefs.config.Path.exists', return_value=True)
+    mocker.patch('macprefs.config.Path.read_text', return_value='')
+    mocker.patch('macprefs.config.tomllib.loads',
+                 return_value={'tool': {
+                     'macprefs': {
+                         'extend-ignore-key-regexes': [pattern]
+                     }
+                 }})
+    mock_logger = mocker.patch('macprefs.config.log.warning')
+    assert read_config(Path('/fake/path'))['extend-ignore-key-regexes'] == [pattern]
+    mock_logger.assert_not_called()
+
+
+@pytest.mark.parametrize(('pattern', 'expected'), [
+    ('(a+)+$', True),
+    (r'(?:\w*_)*x', True),
+    (r'(?:\w+\.?)+$', True),
+    ('(a{2,})*', True),
+    ('(a*)*', True),
+    ('(x+x+)+y', True),
+    ('(a|aa)*', True),
+    ('(?:.|a)+', True),
+    (r'(?P<name>\d|\dx)+', True),
+    ('a+b*', False),
+    ('(ab)+', False),
+    ('((a)+b)*', False),
+    (r'(?:\w+\.)+Frame', False),
+    (r'(\d+,)*\d+', False),
+    ('(?:[A-Z][a-z]+)+Window', False),
+    ('(a|b)*', False),
+    ('(?:a|b)(a|a)', False),
+    ('(?i)(a|b)+', False),
+    ('(?=a)(a)+', False),
+    ('([a+]b)*', False),
+    (r'(\++)', False),
+    ('(a{2,3})*', False),
+    ('(a{,})*', False),
+    (r'^(com\.apple\.)?[A-Z]+', False),
+])
+def test_has_ambiguous_repetition(pattern: str, *, expected: bool) -> None:
+    assert _has_ambiguous_repetition(pattern) is expected
+
+
+def test_load_config_cache(tmp_path: Path, mocker: MockerFixture) -> None:
+    config_file = tmp_path / 'config.toml'
+    config_file.write_text("[tool.macprefs]\nextend-ignore-key-regexes = ['^custom_']\n",
+                           encoding='utf-8')
+    cache_file = tmp_path / 'cache' / 'config.pickle'
+    config, key_filter = load_config(config_file, cache_file)
+    assert config['extend-ignore-key-regexes'] == ['^custom_']
+    assert key_filter('domain', 'custom_key') is True
+    assert cache_file.exists()
+    mock_read_config = mocker.patch('macprefs.config.read_config', side_effect=read_config)
+    cached_config, cached_key_filter = load_config(config_file, cache_file)
+    mock_read_config.assert_not_called()
+    assert cached_config == config
+    assert cached_key_filter('domain', 'custom_key') is True
+    config_file.write_text("[tool.macprefs]\nextend-ignore-key-regexes = ['^other_']\n",
+                           encoding='utf-8')
+    load_config(config_file, cache_file)
+    mock_read_config.assert_called_once_with(config_file)
+
+
+def test_load_config_invalid_cache(tmp_path: Path) -> None:
+    config_file = tmp_path / 'config.toml'
+    config_file.write_text('[tool.macprefs]\nbinary = true\n', encoding='utf-8')
+    cache_file = tmp_path / 'config.pickle'
+    cache_file.write_bytes(b'invalid')
+    config, _ = load_config(config_file, cache_file)
+    assert config['binary'] is True
+    assert load_config(config_file, cache_file)[0] == config
+
+
+@pytest.mark.parametrize('error', [ValueError, TypeError, KeyError, IndexError])
+def test_load_config_cache_load_error(tmp_path: Path, mocker: MockerFixture,
+                                      error: type[Exception]) -> None:
+    config_file = tmp_path / 'config.toml'
+    config_file.write_text('[tool.macprefs]\nbinary = true\n', encoding='utf-8')
+    cache_file = tmp_path / 'config.pickle'
+    load_config(config_file, cache_file)
+    mocker.patch('macprefs.config.pickle.loads', side_effect=error)
+    assert load_config(config_file, cache_file)[0]['binary'] is True
+
+
+def test_load_config_cache_unwritable(tmp_path: Path, mocker: MockerFixture) -> None:
+    config_file = tmp_path / 'config.toml'
+    config_file.write_text('[tool.macprefs]\nbinary = true\n', encoding='utf-8')
+    (tmp_path / 'file').write_text('')
+    assert load_config(config_file, tmp_path / 'file' / 'config.pickle')[0]['binary'] is True
+    mocker.patch('macprefs.config.Path.write_bytes', side_effect=OSError(errno.ENOSPC, 'Full'))
+    cache_file = tmp_path / 'cache' / 'config.pickle'
+    assert load_config(config_file, cache_file)[0]['binary'] is True
+    assert not cache_file.exists()
+
+
+@pytest.mark.parametrize('payload', [['list'], {
+    'config': {}
+}, {
+    'config': 'not a table',
+    'key_filter': None
+}])
+def test_load_config_cache_unexpected_payload(tmp_path: Path, mocker: MockerFixture,
+                                              payload: object) -> None:
+    config_file = tmp_path / 'config.toml'
+    config_file.write_text('[tool.macprefs]\nbinary = true\n', encoding='utf-8')
+    cache_file = tmp_path / 'config.pickle'
+    load_config(config_file, cache_file)
+    cache_key = pickle.loads(cache_file.read_bytes())['key']  # ruff:ignore[suspicious-pickle-usage]
+    if isinstance(payload, dict):
+        payload['key'] = cache_key
+    cache_file.write_bytes(pickle.dumps(payload))
+    mock_read_config = mocker.patch('macprefs.config.read_config', side_effect=read_config)
+    assert load_config(config_file, cache_file)[0]['binary'] is True
+    mock_read_config.assert_called_once_with(config_file)
+
+
+def test_load_config_no_file(tmp_path: Path) -> None:
+    config, key_filter = load_config(tmp_path / 'missing.toml', tmp_path / 'config.pickle')
+    assert config == {}
+    assert key_filter('domain', 'key') is False
+    assert not (tmp_path / 'config.pickle').exists()
+
+
+@pytest.mark.parametrize('jobs', ['auto', 4])
+def test_read_config_jobs(mocker: MockerFixture, jobs: str | int) -> None:
+    mocker.patch('macprefs.config.Path.exists', return_value=True)
+    mocker.patch('macprefs.config.Path.read_text', return_value='')
+    mocker.patch('macprefs.config.tomllib.loads',
+                 return_value={'tool': {
+                     'macprefs': {
+                         'jobs': jobs
+                     }
+                 }})
+    assert read_config(Path('/fake/path'))['jobs'] == jobs
+
+
+@pytest.mark.parametrize('jobs', ['many', 0, True, 1.5])
+def test_read_config_jobs_invalid(mocker: MockerFixture, jobs: object) -> None:
+    mocker.patch('macprefs.config.Path.exists', return_value=True)
+    mocker.patch('macprefs.config.Path.read_text', return_value='')
+    mocker.patch('macprefs.config.tomllib.loads',
+                 return_value={'tool': {
+                     'macprefs': {
+                         'jobs': jobs
+                     }
+                 }})
+    with pytest.raises(ConfigTypeError, match='positive integer or "auto"'):
+        read_config(Path('/fake/path'))
+
+
+@pytest.mark.parametrize(('key', 'value'), [('domain-timeout', 2), ('timeout', 0.5)])
+def test_read_config_seconds(mocker: MockerFixture, key: str, value: float) -> None:
+    mocker.patch('macprefs.config.Path.exists', return_value=True)
+    mocker.patch('macprefs.config.Path.read_text', return_value='')
+    mocker.patch('macprefs.config.tomllib.loads', return_value={'tool': {'macprefs': {key: value}}})
+    assert read_config(Path('/fake/path'))[key] == value
+
+
+@pytest.mark.parametrize('value', ['1', 0, -1, True])
+def test_read_config_seconds_invalid(mocker: MockerFixture, value: object) -> None:
+    mocker.patch('macprefs.config.Path.exists', return_value=True)
+    mocker.patch('macprefs.config.Path.read_text', return_value='')
+    mocker.patch('macprefs.config.tomllib.loads',
+                 return_value={'tool': {
+                     'macprefs': {
+                         'timeout': value
+                     }
+                 }})
+    with pytest.raises(ConfigTypeError, match='positive number of seconds'):
+        read_config(Path('/fake/path'))
+
+
+def test_read_config_metrics_file(mocker: MockerFixture) -> None:
+    mocker.patch('macprefs.config.Path.exists', return_value=True)
+    mocker.patch('macprefs.config.Path.read_text', return_value='')
+    mocker.patch('macprefs.config.tomllib.loads',
+                 return_value={'tool': {
+                     'macprefs': {
+                         'metrics-file': '~/metrics/macprefs.prom'
+                     }
+                 }})
+    assert read_config(Path('/fake/path'))['metrics-file'] == str(
+        Path('~/metrics/macprefs.prom').expanduser())
+    mocker.patch('macprefs.config.tomllib.loads',
+                 return_value={'tool': {
+                     'macprefs': {
+                         'metrics-file': 1
+                     }
+                 }})
+    with pytest.raises(ConfigTypeError, match='path'):
+        read_config(Path('/fake/path'))
+
+
+def test_read_config_tools(mocker: MockerFixture) -> None:
+    mocker.patch('macprefs.config.Path.exists', return_value=True)
+    mocker.patch('macprefs.config.Path.read_text', return_value='')
+    mocker.patch('macprefs.config.tomllib.loads',
+                 return_value={'tool': {
+                     'macprefs': {
+                         'tools': {
+                             'git': '/opt/homebrew/bin/git'
+                         }
+                     }
+                 }})
+    assert read_config(Path('/fake/path'))['tools'] == {'git': '/opt/homebrew/bin/git'}
+
+
+@pytest.mark.parametrize('tools', [['git'], {'svn': '/usr/bin/svn'}, {'git': 1}])
+def test_read_config_tools_invalid(mocker: MockerFixture, tools: object) -> None:
+    mocker.patch('macprefs.config.Path.exists', return_value=True)
+    mocker.patch('macprefs.config.Path.read_text', return_value='')
+    mocker.patch('macprefs.config.tomllib.loads',
+                 return_value={'tool': {
+                     'macprefs': {
+                         'tools': tools
+                     }
+                 }})
+    with pytest.raises(ConfigTypeError, match='table of paths'):
+        read_config(Path('/fake/path'))
+
+
+def test_read_config_lock(mocker: MockerFixture) -> None:
+    mocker.patch('macprefs.config.Path.exists', return_value=True)
+    mocker.patch('macprefs.config.Path.read_text', return_value='')
+    mocker.patch('macprefs.config.tomllib.loads',
+                 return_value={'tool': {
+                     'macprefs': {
+                         'lock': 'coalesce'
+                     }
+                 }})
+    assert read_config(Path('/fake/path'))['lock'] == 'coalesce'
+    mocker.patch('macprefs.config.tomllib.loads',
+                 return_value={'tool': {
+                     'macprefs': {
+                         'lock': 'never'
+                     }
+                 }})
+    with pytest.raises(ConfigTypeError, match='"wait", "exit" or "coalesce"'):
+        read_config(Path('/fake/path'))
+
+
+def test_read_config_background(mocker: MockerFixture) -> None:
+    mocker.patch('macprefs.config.Path.exists', return_value=True)
+    mocker.patch('macprefs.config.Path.read_text', return_value='')
+    mocker.patch('macprefs.config.tomllib.loads',
+                 return_value={'tool': {
+                     'macprefs': {
+                         'background': True,
+                         'read-rate': 1048576
+                     }
+                 }})
+    config = read_config(Path('/fake/path'))
+    assert config['background'] is True
+    assert config['read-rate'] == 1048576
+    mocker.patch('macprefs.config.tomllib.loads',
+                 return_value={'tool': {
+                     'macprefs': {
+                         'read-rate': 0
+                     }
+                 }})
+    with pytest.raises(ConfigTypeError, match='positive number of bytes per second'):
+        read_config(Path('/fake/path'))
+
+
+def test_read_config_sinks(mocker: MockerFixture) -> None:
+    mocker.patch('macprefs.config.Path.exists', return_value=True)
+    mocker.patch('macprefs.config.Path.read_text', return_value='')
+    mocker.patch('macprefs.config.tomllib.loads',
+                 return_value={
+                     'tool': {
+                         'macprefs': {
+                             'sinks': [{
+                                 'output-directory': '~/backup',
+                                 'binary': True,
+                                 'ignore-domains': []
+                             }]
+                         }
+                     }
+                 })
+    sink = read_config(Path('/fake/path'))['sinks'][0]
+    assert sink['output-directory'] == str(Path('~/backup').expanduser())
+    assert sink['binary'] is True
+    assert sink['ignore-domains'] == []
+
+
+@pytest.mark.parametrize(('sinks', 'match'),
+                         [('not-a-list', 'array of tables'), ([{
+                             'binary': True
+                         }], 'array of tables'),
+                          ([{
+                              'output-directory': '/backup',
+                              'commit': 'yes'
+                          }], r'sinks\[0\]\.commit must be of type boolean'),
+                          ([{
+                              'output-directory': '/backup',
+                              'ignore-domains': 1
+                          }], r'sinks\[0\]\.ignore-domains must be of type list of strings')])
+def test_read_config_sinks_invalid(mocker: MockerFixture, sinks: Any, match: str) -> None:
+    mocker.patch('macprefs.config.Path.exists', return_value=True)
+    mocker.patch('macprefs.config.Path.read_text', return_value='')
+    mocker.patch('macprefs.config.tomllib.loads',
+                 return_value={'tool': {
+                     'macprefs': {
+                         'sinks': sinks
+                     }
+                 }})
+    with pytest.raises(ConfigTypeError, match=match):
+        read_config(Path('/fake/path'))
+
+
+def test_make_configured_domain_filter() -> None:
+    domain_filter = make_configured_domain_filter({
+        'extend-ignore-domains': ['com.example.bad'],
+        'ignore-domain-prefixes': ['com.example.']
+    })
+    assert domain_filter('com.example.bad')
+    assert domain_filter('com.example.app')
+    assert domain_filter('com.apple.security.KCN')
+    assert not domain_filter('com.apple.finder')
@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from macprefs.journal import RunJournal, atomic_write
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def test_atomic_write(tmp_path: Path) -> None:
+    path = tmp_path / 'file.sh'
+    path.write_text('old')
+    atomic_write(path, 'new', 0o755)
+    assert path.read_text() == 'new'
+    assert path.stat().st_mode & 0o777 == 0o755
+    atomic_write(path, b'bytes')
+    assert path.read_bytes() == b'bytes'
+    assert [x.name for x in tmp_path.iterdir()] == ['file.sh']
+
+
+def test_run_journal(tmp_path: Path) -> None:
+    path = tmp_path / 'journal.jsonl'
+    plist = tmp_path / 'domain.plist'
+    plist.write_bytes(b'content')
+    journal = RunJournal(path, 'abc')
+    journal.open()
+    journal.record('domain', plist.stat(), exported=True)
+    journal.record('empty', plist.stat(), exported=False)
+    journal.close()
+    journal = RunJournal.load(path, 'abc')
+    assert journal.completed('domain', plist.stat()) is True
+    assert journal.completed('empty', plist.stat()) is False
+    assert journal.completed('other', plist.stat()) is None
+    journal.open(resume=True)
+    journal.close()
+    assert RunJournal.load(path, 'abc').entries == journal.entries
+    plist.write_bytes(b'changed content')
+    assert journal.completed('domain', plist.stat()) is None
+    assert RunJournal.load(path, 'other').entries == {}
+    journal.close(remove=True)
+    assert not path.exists()
+
+
+def test_run_journal_incomplete(tmp_path: Path) -> None:
+    path = tmp_path / 'journal.jsonl'
+    path.write_text('{"fingerprint": "abc"}\n["domain", 1, 2, true]\n["other", 1')
+    assert RunJournal.load(path, 'abc').entries == {'domain': (1, 2, True)}
+    path.write_text('invalid\n')
+    assert RunJournal.load(path, 'abc').entries == {}
+    assert RunJournal.load(tmp_path / 'missing.jsonl', 'abc').entries == {}
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any
+import asyncio
+import os
+
+from anyio import Path as AnyioPath
+from macprefs.lock import RunLock, locked_export
+from macprefs.report import ExportReport
+import pytest
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from pytest_mock import MockerFixture
+
+
+def test_run_lock(tmp_path: Path) -> None:
+    first = RunLock(tmp_path)
+    second = RunLock(tmp_path)
+    assert first.acquire() is True
+    assert first.acquire() is True
+    assert first.held is True
+    assert second.acquire() is False
+    assert second.held is False
+    assert second.holder() == str(os.getpid())
+    first.release()
+    assert not first.holder()
+    assert second.acquire() is True
+    second.release()
+    second.release()
+
+
+def test_run_lock_holder_missing(tmp_path: Path) -> None:
+    assert not RunLock(tmp_path).holder()
+
+
+def test_run_lock_rerun_request(tmp_path: Path) -> None:
+    lock = RunLock(tmp_path)
+    assert lock.take_rerun_request() is False
+    assert not RunLock(tmp_path).rerun_requested
+    lock.request_rerun()
+    lock.request_rerun()
+    assert RunLock(tmp_path).rerun_requested
+    assert lock.take_rerun_request() is True
+    assert lock.take_rerun_request() is False
+
+
+@pytest.mark.asyncio
+async def test_locked_export(mocker: MockerFixture, tmp_path: Path) -> None:
+    out_dir = AnyioPath(tmp_path / 'out')
+    other = RunLock(tmp_path / 'out/.macprefs')
+    report = ExportReport()
+    requests = [True]
+
+    def fake_prefs_export(*_args: Any, **_kwargs: Any) -> ExportReport:
+        if requests:
+            RunLock(tmp_path / 'out/.macprefs').request_rerun()
+            requests.pop()
+        return report
+
+    mock_prefs_export = mocker.patch('macprefs.lock.prefs_export', side_effect=fake_prefs_export)
+    assert await locked_export(out_dir, None, commit=True) is report
+    assert mock_prefs_export.call_count == 2
+    mock_prefs_export.assert_called_with(out_dir, None, commit=True)
+    assert other.acquire() is True
+    mock_prefs_export.reset_mock()
+    assert await locked_export(out_dir, lock_mode='exit') is None
+    assert await locked_export(out_dir, lock_mode='coalesce') is None
+    mock_prefs_export.assert_not_called()
+    assert other.take_rerun_request() is True
+    mocker.patch('macprefs.lock.LOCK_POLL_INTERVAL_SECONDS', 0.01)
+    waiting = asyncio.create_task(locked_export(out_dir))
+    await asyncio.sleep(0.05)
+    mock_prefs_export.assert_not_called()
+    other.release()
+    assert await waiting is report
+    mock_prefs_export.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_locked_export_request_during_release(mocker: MockerFixture, tmp_path: Path) -> None:
+    out_dir = AnyioPath(tmp_path / 'out')
+    report = ExportReport()
+    take_rerun_request = RunLock.take_rerun_request
+    checks: list[bool] = []
+
+    def late_request(self: RunLock) -> bool:
+        ret = take_rerun_request(self)
+        if not checks:
+            # A coalescing export asks after the check, then fails to take the lock.
+            other = RunLock(self.path.parent)
+            other.request_rerun()
+            assert other.acquire() is False
+        checks.append(ret)
+        return ret
+
+    mocker.patch('macprefs.lock.RunLock.take_rerun_request', late_request)
+    mock_prefs_export = mocker.patch('macprefs.lock.prefs_export', return_value=report)
+    assert await locked_export(out_dir) is report
+    assert mock_prefs_export.call_count == 2
+    assert not RunLock(tmp_path / 'out/.macprefs').rerun_requested
+
+
+@pytest.mark.asyncio
+async def test_locked_export_pending_request(mocker: MockerFixture, tmp_path: Path) -> None:
+    (tmp_path / 'out/.macprefs').mkdir(parents=True)
+    RunLock(tmp_path / 'out/.macprefs').request_rerun()
+    mock_prefs_export = mocker.patch('macprefs.lock.prefs_export', return_value=ExportReport())
+    await locked_export(AnyioPath(tmp_path / 'out'))
+    assert mock_prefs_export.call_count == 2
+    mock_prefs_export.reset_mock()
+    await locked_export(AnyioPath(tmp_path / 'out'), lock_mode='coalesce')
+    mock_prefs_export.assert_called_once()
+    assert not RunLock(tmp_path / 'out/.macprefs').rerun_requested
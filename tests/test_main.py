@@ -2,9 +2,13 @@ from __future__ import annotations
 
 from pathlib import Path
 from typing import TYPE_CHECKING
+import os
+import plistlib
+import subprocess as sp
+import sys
 
 from click.testing import CliRunner
-from macprefs.main import install_job, main
+from macprefs.main import install_job, main, plist_textconv
 from platformdirs import user_data_path
 import pytest
 
@@ -13,20 +17,27 @@ if TYPE_CHECKING:
 
     from pytest_mock import MockerFixture
 
+LAZY_MODULES = {
+    'anyio', 'asyncio', 'bascom', 'macprefs.config', 'macprefs.filters.bad_domains',
+    'macprefs.filters.bad_keys', 'macprefs.filters.bad_keys_re', 'macprefs.lock', 'macprefs.plan',
+    'macprefs.plist2defaults', 'macprefs.utils', 'macprefs.watch', 'platformdirs', 'tomlkit'
+}
+"""Modules that must not be imported until a command runs."""
+
 
 @pytest.fixture
 def mock_do_install_job(mocker: MockerFixture) -> MagicMock:
-    return mocker.patch('macprefs.main.do_install_job', return_value=0)
+    return mocker.patch('macprefs.utils.install_job', return_value=0)
 
 
 @pytest.fixture
 def mock_setup_logging(mocker: MockerFixture) -> MagicMock:
-    return mocker.patch('macprefs.main.setup_logging')
+    return mocker.patch('bascom.setup_logging')
 
 
 @pytest.fixture
 def mock_config(mocker: MockerFixture) -> MagicMock:
-    return mocker.patch('macprefs.main.read_config', return_value={})
+    return mocker.patch('macprefs.config.read_config', return_value={})
 
 
 @pytest.fixture
@@ -36,24 +47,150 @@ def runner() -> CliRunner:
 
 def test_main_success(runner: CliRunner, mock_setup_logging: MagicMock, mock_config: MagicMock,
                       mocker: MockerFixture) -> None:
-    mock_prefs_export = mocker.patch('macprefs.main.prefs_export', return_value=0)
+    mock_locked_export = mocker.patch('macprefs.lock.locked_export', return_value=0)
     result = runner.invoke(main, ['--debug', '--commit'])
     assert result.exit_code == 0
     mock_config.assert_called_once()
     mock_setup_logging.assert_called_once_with(debug=True, loggers=mocker.ANY)
-    mock_prefs_export.assert_called_once()
+    mock_locked_export.assert_called_once()
 
 
 def test_main_with_config(runner: CliRunner, mocker: MockerFixture,
                           mock_setup_logging: MagicMock) -> None:
-    mock_prefs_export = mocker.patch('macprefs.main.prefs_export', return_value=0)
+    mock_locked_export = mocker.patch('macprefs.lock.locked_export', return_value=0)
     config_path = '/path/to/config.toml'
     result = runner.invoke(main, ['--config', config_path])
     assert result.exit_code == 0
-    mock_prefs_export.assert_called_once_with(mocker.ANY, mocker.ANY, None, commit=False)
+    mock_locked_export.assert_called_once_with(mocker.ANY,
+                                               mocker.ANY,
+                                               None,
+                                               binary=False,
+                                               canonical=False,
+                                               clear_negative_cache=False,
+                                               commit=False,
+                                               domain_globs=(),
+                                               domain_timeout=None,
+                                               domains=(),
+                                               filter_stats=None,
+                                               jobs='auto',
+                                               key_filter=mocker.ANY,
+                                               lock_mode='wait',
+                                               metrics_file=None,
+                                               read_rate=None,
+                                               record_stats=False,
+                                               resume=False,
+                                               run_timeout=None,
+                                               skip_rejected=False)
     mock_setup_logging.assert_called_once_with(debug=False, loggers=mocker.ANY)
 
 
+def test_main_filter_stats(runner: CliRunner, mocker: MockerFixture, mock_config: MagicMock,
+                           mock_setup_logging: MagicMock) -> None:
+    mock_locked_export = mocker.patch('macprefs.lock.locked_export', new_callable=mocker.Mock)
+    mocker.patch('asyncio.run')
+    result = runner.invoke(main, ['--filter-stats'])
+    assert result.exit_code == 0
+    assert 'Dead rules (0 of 0):' in result.output
+    assert mock_locked_export.call_args.kwargs['filter_stats'] is not None
+
+
+@pytest.mark.parametrize(('args', 'expected'), [(['-j', '8'], 8), (['--jobs', 'auto'], 'auto')])
+def test_main_jobs(runner: CliRunner, mocker: MockerFixture, mock_config: MagicMock,
+                   mock_setup_logging: MagicMock, args: list[str], expected: int | str) -> None:
+    mock_locked_export = mocker.patch('macprefs.lock.locked_export', new_callable=mocker.Mock)
+    mocker.patch('asyncio.run')
+    result = runner.invoke(main, args)
+    assert result.exit_code == 0
+    assert mock_locked_export.call_args.kwargs['jobs'] == expected
+
+
+def test_main_domains(runner: CliRunner, mocker: MockerFixture, mock_config: MagicMock,
+                      mock_setup_logging: MagicMock) -> None:
+    mock_locked_export = mocker.patch('macprefs.lock.locked_export', new_callable=mocker.Mock)
+    mocker.patch('asyncio.run')
+    result = runner.invoke(
+        main, ['-D', 'com.apple.dock', '--domain', 'org.a', '--domain-glob', 'com.apple.*'])
+    assert result.exit_code == 0
+    assert mock_locked_export.call_args.kwargs['domains'] == ('com.apple.dock', 'org.a')
+    assert mock_locked_export.call_args.kwargs['domain_globs'] == ('com.apple.*',)
+
+
+def test_main_timeouts(runner: CliRunner, mocker: MockerFixture,
+                       mock_setup_logging: MagicMock) -> None:
+    mocker.patch('macprefs.config.read_config',
+                 return_value={
+                     'domain-timeout': 5.0,
+                     'timeout': 60.0
+                 })
+    mock_locked_export = mocker.patch('macprefs.lock.locked_export', new_callable=mocker.Mock)
+    mocker.patch('asyncio.run')
+    result = runner.invoke(main, ['-t', '30'])
+    assert result.exit_code == 0
+    assert mock_locked_export.call_args.kwargs['domain_timeout'] == pytest.approx(5)
+    assert mock_locked_export.call_args.kwargs['run_timeout'] == pytest.approx(30)
+    assert runner.invoke(main, ['--domain-timeout', '0']).exit_code == 2
+
+
+def test_main_resume(runner: CliRunner, mocker: MockerFixture, mock_config: MagicMock,
+                     mock_setup_logging: MagicMock) -> None:
+    mock_locked_export = mocker.patch('macprefs.lock.locked_export', new_callable=mocker.Mock)
+    mocker.patch('asyncio.run')
+    result = runner.invoke(main, ['--resume'])
+    assert result.exit_code == 0
+    assert mock_locked_export.call_args.kwargs['resume'] is True
+
+
+def test_main_background(runner: CliRunner, mocker: MockerFixture, mock_config: MagicMock,
+                         mock_setup_logging: MagicMock) -> None:
+    mock_locked_export = mocker.patch('macprefs.lock.locked_export', new_callable=mocker.Mock)
+    mock_lower_priority = mocker.patch('macprefs.concurrency.lower_priority')
+    mocker.patch('asyncio.run')
+    result = runner.invoke(main, ['--background'])
+    assert result.exit_code == 0
+    mock_lower_priority.assert_called_once_with()
+    assert mock_locked_export.call_args.kwargs['jobs'] == 2
+    assert mock_locked_export.call_args.kwargs['read_rate'] == 8 * 1024 * 1024
+    result = runner.invoke(main, ['--background', '--jobs', '6', '--read-rate', '1024'])
+    assert result.exit_code == 0
+    assert mock_locked_export.call_args.kwargs['jobs'] == 6
+    assert mock_locked_export.call_args.kwargs['read_rate'] == 1024
+
+
+def test_main_lock_exit(runner: CliRunner, mocker: MockerFixture, mock_config: MagicMock,
+                        mock_setup_logging: MagicMock) -> None:
+    mock_locked_export = mocker.patch('macprefs.lock.locked_export', new_callable=mocker.Mock)
+    mocker.patch('asyncio.run', return_value=None)
+    result = runner.invoke(main, ['--lock', 'exit'])
+    assert result.exit_code == 75
+    assert mock_locked_export.call_args.kwargs['lock_mode'] == 'exit'
+
+
+@pytest.mark.parametrize('value', ['0', 'many'])
+def test_main_jobs_invalid(runner: CliRunner, value: str) -> None:
+    result = runner.invoke(main, ['--jobs', value])
+    assert result.exit_code == 2
+    assert 'positive integer or "auto"' in result.output
+
+
+def test_main_watch(runner: CliRunner, mocker: MockerFixture, mock_config: MagicMock,
+                    mock_setup_logging: MagicMock) -> None:
+    mock_locked_export = mocker.patch('macprefs.lock.locked_export', new_callable=mocker.Mock)
+    mock_watch_export = mocker.patch('macprefs.watch.watch_export', new_callable=mocker.Mock)
+    mocker.patch('asyncio.run', side_effect=KeyboardInterrupt)
+    result = runner.invoke(main, ['--watch'])
+    assert result.exit_code == 0
+    mock_watch_export.assert_called_once()
+    mock_locked_export.assert_not_called()
+
+
+def test_main_interrupted(runner: CliRunner, mocker: MockerFixture, mock_config: MagicMock,
+                          mock_setup_logging: MagicMock) -> None:
+    mocker.patch('macprefs.lock.locked_export', new_callable=mocker.Mock)
+    mocker.patch('asyncio.run', side_effect=KeyboardInterrupt)
+    result = runner.invoke(main, [])
+    assert result.exit_code != 0
+
+
 def test_install_job_success(runner: CliRunner, mock_do_install_job: MagicMock,
                              mock_setup_logging: MagicMock, mocker: MockerFixture) -> None:
     result = runner.invoke(install_job, ['--debug'])
@@ -64,7 +201,7 @@ def test_install_job_success(runner: CliRunner, mock_do_install_job: MagicMock,
 
 def test_install_job_failure(runner: CliRunner, mock_setup_logging: MagicMock,
                              mocker: MockerFixture, mock_config: MagicMock) -> None:
-    mock_do_install_job = mocker.patch('macprefs.main.do_install_job', return_value=1)
+    mock_do_install_job = mocker.patch('macprefs.utils.install_job', return_value=1)
     result = runner.invoke(install_job, ['--debug'])
     assert result.exit_code != 0
     mock_config.assert_called_once()
@@ -80,5 +217,113 @@ def test_install_job_with_deploy_key(runner: CliRunner, mock_do_install_job: Mag
     assert result.exit_code == 0
     mock_config.assert_called_once()
     prefs_dir = user_data_path('macprefs')
-    mock_do_install_job.assert_called_once_with(prefs_dir, Path(deploy_key_path))
+    mock_do_install_job.assert_called_once_with(prefs_dir, Path(deploy_key_path), watch=False)
     mock_setup_logging.assert_called_once_with(debug=False, loggers=mocker.ANY)
+
+
+def test_plist_textconv(runner: CliRunner, tmp_path: Path) -> None:
+    plist = tmp_path / 'test.plist'
+    plist.write_bytes(plistlib.dumps({'key': 'value'}, fmt=plistlib.PlistFormat.FMT_BINARY))
+    result = runner.invoke(plist_textconv, [str(plist)])
+    assert result.exit_code == 0
+    assert result.stdout_bytes == plistlib.dumps({'key': 'value'}, fmt=plistlib.PlistFormat.FMT_XML)
+
+
+def test_plist_textconv_invalid(runner: CliRunner, tmp_path: Path) -> None:
+    plist = tmp_path / 'test.plist'
+    plist.write_bytes(b'not a plist')
+    result = runner.invoke(plist_textconv, [str(plist)])
+    assert result.exit_code == 0
+    assert result.stdout_bytes == b'not a plist'
+
+
+def test_main_check(runner: CliRunner, mock_setup_logging: MagicMock, mock_config: MagicMock,
+                    mocker: MockerFixture) -> None:
+    mock_locked_export = mocker.patch('macprefs.lock.locked_export')
+    mock_check_export = mocker.patch('macprefs.utils.check_export',
+                                     new_callable=mocker.AsyncMock,
+                                     return_value={
+                                         'domain1': 'byte-wise',
+                                         'domain2': 'semantic'
+                                     })
+    result = runner.invoke(main, ['--check', '--canonical'])
+    assert result.exit_code == 1
+    assert result.output == 'byte-wise: domain1\nsemantic: domain2\n'
+    assert mock_check_export.call_args.kwargs == {'binary': False, 'canonical': True}
+    mock_locked_export.assert_not_called()
+
+
+def test_main_check_byte_wise_only(runner: CliRunner, mock_setup_logging: MagicMock,
+                                   mock_config: MagicMock, mocker: MockerFixture) -> None:
+    mocker.patch('macprefs.utils.check_export',
+                 new_callable=mocker.AsyncMock,
+                 return_value={'domain1': 'byte-wise'})
+    result = runner.invoke(main, ['--check'])
+    assert result.exit_code == 0
+
+
+def test_main_clear_negative_cache(runner: CliRunner, mock_setup_logging: MagicMock,
+                                   mock_config: MagicMock, mocker: MockerFixture) -> None:
+    mock_locked_export = mocker.patch('macprefs.lock.locked_export', new_callable=mocker.Mock)
+    mocker.patch('asyncio.run')
+    result = runner.invoke(main, ['--clear-negative-cache'])
+    assert result.exit_code == 0
+    assert mock_locked_export.call_args.kwargs['clear_negative_cache'] is True
+
+
+def test_main_plan(runner: CliRunner, mock_setup_logging: MagicMock, mock_config: MagicMock,
+                   mocker: MockerFixture) -> None:
+    from macprefs.plan import DomainPlan
+    mock_locked_export = mocker.patch('macprefs.lock.locked_export')
+    mock_plan_export = mocker.patch('macprefs.plan.plan_export',
+                                    new_callable=mocker.AsyncMock,
+                                    return_value=[DomainPlan('domain1', added=['a'], lines=(0, 1))])
+    result = runner.invoke(main, ['--plan', '--skip-rejected'])
+    assert result.exit_code == 0
+    assert result.output == ('domain1: 1 added, 0 removed, 0 changed; exec-defaults.sh 0 -> 1 '
+                             'lines, rejected-defaults.sh 0 -> 0 lines\n  + a\n'
+                             '1 domain(s) would change.\n')
+    assert mock_plan_export.call_args.kwargs['skip_rejected'] is True
+    mock_locked_export.assert_not_called()
+
+
+def test_main_find_volatile_keys(runner: CliRunner, mock_setup_logging: MagicMock,
+                                 mock_config: MagicMock, mocker: MockerFixture,
+                                 tmp_path: Path) -> None:
+    mock_locked_export = mocker.patch('macprefs.lock.locked_export')
+    mock_load_key_stats = mocker.patch('macprefs.stats.load_key_stats')
+    mock_find_volatile_keys = mocker.patch('macprefs.stats.find_volatile_keys')
+    mocker.patch('macprefs.stats.volatile_keys_toml', return_value='# toml\n')
+    result = runner.invoke(main, ['--find-volatile-keys', '-o', str(tmp_path)])
+    assert result.exit_code == 0
+    assert result.output == '# toml\n'
+    mock_load_key_stats.assert_called_once_with(tmp_path / '.macprefs' / 'key-stats.json')
+    mock_find_volatile_keys.assert_called_once_with(mock_load_key_stats.return_value, mocker.ANY)
+    mock_locked_export.assert_not_called()
+
+
+def test_import_lazy_modules() -> None:
+    modules = sp.run(
+        (sys.executable, '-c', 'import sys, macprefs.filters, macprefs.main; print(*sys.modules)'),
+        capture_output=True,
+        check=True,
+        text=True).stdout.split()
+    assert 'macprefs.main' in modules
+    assert not LAZY_MODULES & set(modules)
+
+
+@pytest.mark.skipif(not os.getenv('MACPREFS_IMPORT_TIME_BUDGET_US'),
+                    reason='MACPREFS_IMPORT_TIME_BUDGET_US is not set.')
+def test_import_time() -> None:
+    stderr = sp.run(
+        (sys.executable, '-X', 'importtime', '-c', 'import macprefs.filters, macprefs.main'),
+        capture_output=True,
+        check=True,
+        text=True).stderr
+    self_times: dict[str, int] = {}
+    for line in stderr.splitlines():
+        self_us, _, name = line.removeprefix('import time:').split('|')
+        if self_us.strip().isdigit():
+            self_times[name.strip()] = int(self_us)
+    assert sum(us for name, us in self_times.items() if name.startswith('macprefs')) < int(
+        os.environ['MACPREFS_IMPORT_TIME_BUDGET_US'])
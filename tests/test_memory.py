@@ -0,0 +1,179 @@
+"""
+Peak memory and allocation budgets.
+
+The property lists are generated in three size classes. Each step of the pipeline runs under
+:py:mod:`tracemalloc` and must stay within a budget of peak traced memory and of memory blocks still
+allocated afterwards, both scaled by the number of keys. When a budget is exceeded, the assertion
+message lists the allocation sites that grew the most.
+"""
+from __future__ import annotations
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import TYPE_CHECKING, Any
+import gc
+import plistlib
+import subprocess as sp
+import tracemalloc
+
+from anyio import Path as AnyioPath
+from macprefs.config import make_configured_key_filter
+from macprefs.plist2defaults import plist_to_defaults_commands
+from macprefs.processing import rejected_fields, remove_data_fields
+from macprefs.utils import prefs_export
+import pytest
+
+if TYPE_CHECKING:
+    from collections.abc import Generator
+    from pathlib import Path
+
+    from pytest_mock import MockerFixture
+
+SIZE_CLASSES = {'small': 50, 'medium': 1000, 'large': 10000}
+"""Number of top-level keys of a generated property list in each size class."""
+PEAK_BYTES_PER_KEY = {'clean': 640, 'render': 512}
+"""Budget of peak traced memory per top-level key for each step."""
+BLOCKS_PER_KEY = {'clean': 4, 'render': 1}
+"""Budget of memory blocks still allocated after each step per top-level key."""
+BASE_PEAK_BYTES = 256 * 1024
+"""Peak traced memory allowed for any step regardless of size."""
+BASE_BLOCKS = 1000
+"""Memory blocks allowed to remain allocated after any step regardless of size."""
+EXPORT_PEAK_BYTES_PER_KEY = 1536
+"""Budget of peak traced memory per top-level key for a whole export."""
+EXPORT_BASE_PEAK_BYTES = 4 * 1024 * 1024
+"""Peak traced memory allowed for a whole export regardless of size."""
+EXPORT_BLOCKS = 10000
+"""Memory blocks allowed to remain allocated after a whole export. Nothing should scale with the
+number of keys."""
+
+
+@dataclass
+class Trace:
+    peak: int = 0
+    """Peak traced memory in bytes."""
+    blocks: int = 0
+    """Number of memory blocks allocated during the block and still allocated after it."""
+    top: list[tracemalloc.StatisticDiff] = field(default_factory=list)
+    """Allocation sites that grew the most."""
+    def check(self, name: str, peak_budget: int, block_budget: int) -> None:
+        sites = '\n'.join(f'  {x}' for x in self.top)
+        assert self.peak <= peak_budget, (f'{name}: peak {self.peak} B exceeds {peak_budget} B. '
+                                          f'Top allocation sites:\n{sites}')
+        assert self.blocks <= block_budget, (f'{name}: {self.blocks} blocks retained, more than '
+                                             f'{block_budget}. Top allocation sites:\n{sites}')
+
+
+@contextmanager
+def traced() -> Generator[Trace, None, None]:
+    trace = Trace()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        yield trace
+        trace.peak = tracemalloc.get_traced_memory()[1]
+        gc.collect()
+        stats = tracemalloc.take_snapshot().compare_to(before, 'lineno')
+        trace.blocks = sum(max(0, x.count_diff) for x in stats)
+        trace.top = stats[:10]
+    finally:
+        tracemalloc.stop()
+
+
+def make_root(keys: int) -> dict[str, Any]:
+    root: dict[str, Any] = {}
+    for i in range(keys):
+        match i % 8:
+            case 0:
+                root[f'String{i}'] = f'value {i} with some text'
+            case 1:
+                root[f'Integer{i}'] = i
+            case 2:
+                root[f'Bool{i}'] = bool(i % 3)
+            case 3:
+                root[f'Array{i}'] = [f'item {j}' for j in range(5)]
+            case 4:
+                root[f'Dict{i}'] = {'Nested': {'Name': f'name {i}', 'Value': i}, 'List': [i, 1.5]}
+            case 5:
+                root[f'Data{i}'] = bytes(64)
+            case 6:
+                root[f'NSWindow Frame Window{i}'] = f'{i} 0 800 600 0 0 1920 1080'
+            case _:
+                root[f'Date{i}'] = datetime(2024, 1, 1)  # ruff:ignore[call-datetime-without-tzinfo]
+    return root
+
+
+def generate_home(home: Path, domains: dict[str, int]) -> None:
+    prefs = home / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    for domain, keys in domains.items():
+        (prefs / f'{domain}.plist').write_bytes(
+            plistlib.dumps(make_root(keys), fmt=plistlib.FMT_BINARY))
+
+
+@pytest.mark.parametrize('size', SIZE_CLASSES)
+def test_remove_data_fields_budget(size: str) -> None:
+    keys = SIZE_CLASSES[size]
+    parsed = plistlib.loads(plistlib.dumps(make_root(keys)))
+    key_filter = make_configured_key_filter({})
+    with traced() as trace:
+        root = remove_data_fields(parsed, key_filter, 'com.example.generated')
+    assert root
+    trace.check(f'remove_data_fields ({size})',
+                BASE_PEAK_BYTES + keys * PEAK_BYTES_PER_KEY['clean'],
+                BASE_BLOCKS + keys * BLOCKS_PER_KEY['clean'])
+
+
+@pytest.mark.parametrize('size', SIZE_CLASSES)
+def test_plist_to_defaults_commands_budget(size: str) -> None:
+    keys = SIZE_CLASSES[size]
+    key_filter = make_configured_key_filter({})
+    root = remove_data_fields(plistlib.loads(plistlib.dumps(make_root(keys))), key_filter,
+                              'com.example.generated')
+    with traced() as trace:
+        written = 0
+        for line in plist_to_defaults_commands('com.example.generated', root, key_filter):
+            written += len(line)
+        for line in plist_to_defaults_commands('com.example.generated',
+                                               rejected_fields(root, key_filter,
+                                                               'com.example.generated'),
+                                               key_filter,
+                                               invert_filters=True):
+            written += len(line)
+    assert written
+    trace.check(f'plist_to_defaults_commands ({size})',
+                BASE_PEAK_BYTES + keys * PEAK_BYTES_PER_KEY['render'],
+                BASE_BLOCKS + keys * BLOCKS_PER_KEY['render'])
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_budget(mocker: MockerFixture, tmp_path: Path) -> None:
+    domains = {
+        **{
+            f'com.example.small{i}': SIZE_CLASSES['small']
+            for i in range(20)
+        },
+        **{
+            f'com.example.medium{i}': SIZE_CLASSES['medium']
+            for i in range(4)
+        },
+        'com.example.large': SIZE_CLASSES['large'],
+    }
+    generate_home(tmp_path, domains)
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    mocker.patch('macprefs.utils.is_git_installed', return_value=False)
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 return_value=sp.CompletedProcess((), 0, b'', b''))
+    mock_generate_domains = mocker.AsyncMock()
+    mock_generate_domains.__aiter__.return_value = list(domains)
+    mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+    keys = sum(domains.values())
+    with traced() as trace:
+        report = await prefs_export(AnyioPath(tmp_path / 'out'), jobs=4)
+    assert report.domains_exported == len(domains)
+    trace.check('prefs_export', EXPORT_BASE_PEAK_BYTES + keys * EXPORT_PEAK_BYTES_PER_KEY,
+                EXPORT_BLOCKS)
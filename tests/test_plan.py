@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+import plistlib
+
+from anyio import Path as AnyioPath
+from macprefs.plan import DomainPlan, diff_scripts, plan_export, script_commands
+from macprefs.plist2defaults import plist_to_defaults_commands
+import pytest
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from pytest_mock import MockerFixture
+
+
+def test_script_commands() -> None:
+    lines = list(
+        plist_to_defaults_commands('domain', {
+            'array': ['a', 'b', 'c'],
+            'int': 1,
+            'multiline': 'a\nb',
+            'dict': {
+                'a': 'b',
+                'c': 'd'
+            }
+        }))
+    commands = script_commands('\n'.join(('#!/usr/bin/env bash', '', *lines, 'echo')))
+    assert list(commands) == ['domain']
+    assert sorted(commands['domain']) == ['array', 'dict', 'int', 'multiline']
+    assert commands['domain']['int'] == 'defaults write domain int -int 1'
+    assert commands['domain']['array'].count('\n') == 2
+    assert commands['domain']['multiline'].count('\n') == 1
+
+
+def test_script_commands_incomplete() -> None:
+    assert script_commands("defaults write domain\ndefaults write domain key 'unterminated") == {}
+
+
+def test_diff_scripts() -> None:
+    plans = diff_scripts(
+        {
+            'same': {
+                'a': 'x'
+            },
+            'domain': {
+                'kept': 'x',
+                'changed': 'x',
+                'removed': 'x\ny'
+            }
+        }, {
+            'same': {
+                'a': 'x'
+            },
+            'domain': {
+                'kept': 'x',
+                'changed': 'y',
+                'added': 'x'
+            }
+        }, {}, {'rejected-only': {
+            'a': 'x'
+        }})
+    assert plans == [
+        DomainPlan('domain',
+                   added=['added'],
+                   removed=['removed'],
+                   changed=['changed'],
+                   lines=(4, 3),
+                   rejected_lines=(0, 0)),
+        DomainPlan('rejected-only', rejected_lines=(0, 1))
+    ]
+    assert plans[0].report() == ('domain: 1 added, 1 removed, 1 changed; exec-defaults.sh 4 -> 3 '
+                                 'lines, rejected-defaults.sh 0 -> 0 lines\n'
+                                 '  + added\n'
+                                 '  - removed\n'
+                                 '  ~ changed\n')
+
+
+@pytest.mark.asyncio
+async def test_plan_export(tmp_path: Path, mocker: MockerFixture) -> None:
+    home = tmp_path / 'home'
+    (home / 'Library/Preferences').mkdir(parents=True)
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(home))
+    (home / 'Library/Preferences/same.plist').write_bytes(plistlib.dumps({'a': 1}))
+    (home / 'Library/Preferences/domain.plist').write_bytes(
+        plistlib.dumps({
+            'a': 2,
+            'b': 'new',
+            'ignored': True
+        }))
+    (home / 'Library/Preferences/broken.plist').write_bytes(b'invalid')
+    (out_dir / 'exec-defaults.sh').write_text('#!/usr/bin/env bash\n\n# same\n'
+                                              'defaults write same a -int 1\n\n# domain\n'
+                                              'defaults write domain a -int 1\n'
+                                              'defaults write domain old -int 1\n\n')
+    mock_generate_domains = mocker.AsyncMock()
+    mock_generate_domains.__aiter__.return_value = ['same', 'domain', 'broken', 'missing']
+    mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+    mock_run_process = mocker.patch('macprefs.utils.run_process')
+    config = {'ignore-keys': {'domain': ['ignored']}, 'ignore-key-regexes': []}
+    plans = await plan_export(AnyioPath(out_dir), config)
+    assert [plan.domain for plan in plans] == ['domain']
+    assert plans[0].added == ['b']
+    assert plans[0].removed == ['old']
+    assert plans[0].changed == ['a']
+    assert plans[0].lines == (2, 2)
+    assert plans[0].rejected_lines == (0, 1)
+    skipped = await plan_export(AnyioPath(out_dir), config, skip_rejected=True)
+    assert skipped[0].rejected_lines == (0, 0)
+    assert sorted(x.name for x in out_dir.iterdir()) == ['exec-defaults.sh']
+    mock_run_process.assert_not_called()
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+from pathlib import Path
+from time import perf_counter
+import asyncio
+import os
+import subprocess as sp
+import sys
+
+from macprefs.process import ProcessRunner, default_runner, run_process
+import pytest
+
+LARGE_OUTPUT_BYTES = 4 * 1024 * 1024
+
+
+@pytest.mark.asyncio
+async def test_run_drains_large_output() -> None:
+    runner = ProcessRunner()
+    p = await runner.run(sys.executable,
+                         '-c', f'import sys; sys.stderr.write("e" * {LARGE_OUTPUT_BYTES}); '
+                         f'sys.stdout.write("o" * {LARGE_OUTPUT_BYTES})',
+                         timeout=30)
+    assert p.returncode == 0
+    assert len(p.stdout) == len(p.stderr) == LARGE_OUTPUT_BYTES
+    assert runner.stats.exit_codes == {(Path(sys.executable).name, 0): 1}
+
+
+@pytest.mark.asyncio
+async def test_run_stdin() -> None:
+    p = await ProcessRunner().run(sys.executable,
+                                  '-c',
+                                  'import sys; sys.stdout.write(sys.stdin.read().upper())',
+                                  stdin=b'abc')
+    assert p.stdout == b'ABC'
+
+
+@pytest.mark.asyncio
+async def test_run_check() -> None:
+    runner = ProcessRunner()
+    p = await runner.run(sys.executable, '-c', 'import sys; sys.exit(3)')
+    assert p.returncode == 3
+    with pytest.raises(sp.CalledProcessError) as exc_info:
+        await runner.run(sys.executable, '-c', 'import sys; sys.exit(3)', check=True)
+    assert exc_info.value.returncode == 3
+    assert sum(runner.stats.exit_codes.values()) == 2
+
+
+@pytest.mark.asyncio
+async def test_run_timeout() -> None:
+    runner = ProcessRunner()
+    start = perf_counter()
+    with pytest.raises(sp.TimeoutExpired):
+        await runner.run(sys.executable, '-c', 'import time; time.sleep(30)', timeout=0.2)
+    assert perf_counter() - start < 10
+    assert sum(runner.stats.timeouts.values()) == 1
+    assert not runner.stats.exit_codes
+
+
+@pytest.mark.asyncio
+async def test_run_cancelled_kills_process(tmp_path: Path) -> None:
+    pid_file = tmp_path / 'pid'
+    task = asyncio.create_task(ProcessRunner().run(
+        sys.executable, '-c',
+        f'import os, time; open({str(pid_file)!r}, "w").write(str(os.getpid()))'
+        '; time.sleep(30)'))
+    while not pid_file.exists() or not pid_file.read_text():  # ruff:ignore[async-busy-wait]
+        await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
+
+
+@pytest.mark.asyncio
+async def test_run_limits_concurrency() -> None:
+    runner = ProcessRunner(1)
+    start = perf_counter()
+    await asyncio.gather(*(runner.run(sys.executable, '-c', 'import time; time.sleep(0.2)')
+                           for _ in range(3)))
+    assert perf_counter() - start >= 0.6
+    assert sum(runner.stats.spawns.values()) == 3
+
+
+def test_report() -> None:
+    runner = ProcessRunner()
+    runner.stats.spawns['git'] = 2
+    runner.stats.seconds['git'] = 1.5
+    runner.stats.exit_codes['git', 0] = 1
+    runner.stats.exit_codes['git', 1] = 1
+    runner.stats.spawns['plutil'] = 1
+    runner.stats.timeouts['plutil'] = 1
+    assert runner.stats.report() == (
+        'git: 2 run(s) in 1.50 s, exit codes {0: 1, 1: 1}, 0 timed out\n'
+        'plutil: 1 run(s) in 0.00 s, exit codes {}, 1 timed out\n')
+
+
+@pytest.mark.asyncio
+async def test_run_process_uses_default_runner() -> None:
+    before = sum(default_runner().stats.spawns.values())
+    assert (await run_process(sys.executable, '-c', 'print("x")')).stdout.strip() == b'x'
+    assert sum(default_runner().stats.spawns.values()) == before + 1
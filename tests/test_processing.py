@@ -1,8 +1,16 @@
 from __future__ import annotations
 
 from typing import TYPE_CHECKING, cast
-
-from macprefs.processing import make_key_filter, remove_data_fields, remove_data_fields_list
+import pickle  # ruff:ignore[suspicious-pickle-import]
+
+from macprefs.processing import (
+    FilterStats,
+    make_domain_filter,
+    make_key_filter,
+    rejected_fields,
+    remove_data_fields,
+    remove_data_fields_list,
+)
 import pytest
 
 if TYPE_CHECKING:
@@ -12,12 +20,12 @@ if TYPE_CHECKING:
 
 @pytest.fixture
 def mock_bad_keys(mocker: MockerFixture) -> None:
-    mocker.patch('macprefs.processing.BAD_KEYS', {'test_domain': {'test_key', 're:^test_.*'}})
+    mocker.patch('macprefs.filters.bad_keys.BAD_KEYS', {'test_domain': {'test_key', 're:^test_.*'}})
 
 
 @pytest.fixture
 def mock_bad_keys_re(mocker: MockerFixture) -> None:
-    mocker.patch('macprefs.processing.BAD_KEYS_RE', r'^bad_.*')
+    mocker.patch('macprefs.filters.bad_keys_re.BAD_KEYS_RE_PATTERNS', {r'bad_.*'})
 
 
 def test_make_key_filter_with_reset(mock_bad_keys: None, mock_bad_keys_re: None) -> None:
@@ -51,6 +59,39 @@ def test_make_key_filter_with_regex_match_2() -> None:
     assert filter_func('test_domain', 'bad_key') is False
 
 
+def test_make_key_filter_stats(mock_bad_keys: None, mock_bad_keys_re: None) -> None:
+    stats = FilterStats()
+    filter_func = make_key_filter([r'^custom_'], {'other_domain': {'unused_key'}}, stats=stats)
+    assert filter_func('test_domain', 'test_key') is True
+    assert filter_func('test_domain', 'test_key') is True
+    assert filter_func('test_domain', 'bad_key') is True
+    assert filter_func('test_domain', 'random_key') is False
+    assert stats.keys_checked == 3
+    assert stats.rule_hits == {
+        'test_domain[test_key]': 1,
+        'test_domain[re:^test_.*]': 1,
+        r're:^(?:bad_.*)\b': 1
+    }
+    assert stats.domain_hits == {'test_domain': 2}
+    assert stats.dead_rules() == ['other_domain[unused_key]', 're:^custom_']
+    assert {rule
+            for rule, _ in stats.most_expensive()} == {
+                r're:^(?:bad_.*)\b', 're:^custom_', 'test_domain[re:^test_.*]'
+            }
+    report = stats.report()
+    assert 'Keys checked: 3, ignored: 2.' in report
+    assert '  other_domain[unused_key]' in report
+
+
+def test_key_filter_pickle(mock_bad_keys: None, mock_bad_keys_re: None) -> None:
+    filter_func = make_key_filter(stats=FilterStats())
+    assert filter_func('test_domain', 'bad_key') is True
+    copy = pickle.loads(pickle.dumps(filter_func))  # ruff:ignore[suspicious-pickle-usage]
+    assert copy.stats is None
+    assert copy('test_domain', 'bad_key') is True
+    assert copy('test_domain', 'random_key') is False
+
+
 def test_remove_data_fields_list_with_bytes() -> None:
     input_data = [b'test', b'another']
     result = remove_data_fields_list(input_data)
@@ -86,3 +127,31 @@ def test_remove_data_fields_with_nested_structures() -> None:
     }
     result = remove_data_fields(cast('PlistRoot', input_data))
     assert result == {}
+
+
+def test_remove_data_fields_with_key_filter() -> None:
+    frame = {'a': '0,0', 'b': b'data'}
+    input_data = {'key': {'nested': b'x', 'k': 1}, 'frame': frame, 'cache': [b'data']}
+    result = remove_data_fields(cast('PlistRoot', input_data), lambda _, k: k != 'key', 'domain')
+    assert result == {'key': {'k': 1}, 'frame': frame}
+    assert result['frame'] is frame
+    assert rejected_fields(result, lambda _, k: k != 'key', 'domain') == {'frame': {'a': '0,0'}}
+    assert remove_data_fields(cast('PlistRoot', input_data),
+                              lambda _, k: k != 'key',
+                              'domain',
+                              keep_rejected=False) == {
+                                  'key': {
+                                      'k': 1
+                                  }
+                              }
+
+
+def test_make_domain_filter() -> None:
+    domain_filter = make_domain_filter(['com.example.bad'], ['com.example.prefix.'])
+    assert domain_filter('com.example.bad')
+    assert domain_filter('com.example.prefix.app')
+    assert domain_filter('com.apple.security.KCN')
+    assert not domain_filter('com.example.good')
+    reset = make_domain_filter(['com.example.bad'], reset_domains=True, reset_prefixes=True)
+    assert not reset('com.apple.security.KCN')
+    assert reset('com.example.bad')
@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+from macprefs.report import ExportReport, peak_rss_bytes
+
+
+def test_export_report() -> None:
+    report = ExportReport(failed=['bad'], timed_out=['slow'], domains_scanned=5, domains_exported=2)
+    assert report.report() == 'Failed to convert: bad\nTimed out: slow\n'
+    assert report.domains_skipped == 1
+    with report.stage('export'):
+        pass
+    with report.stage('export'):
+        pass
+    assert list(report.stage_seconds) == ['export']
+
+
+def test_export_report_openmetrics() -> None:
+    report = ExportReport(domains_scanned=3,
+                          domains_exported=3,
+                          bytes_read=123456789,
+                          keys_accepted=10,
+                          keys_rejected=4,
+                          subprocesses=2,
+                          peak_rss_bytes=1024,
+                          success=True)
+    report.stage_seconds['export'] = 1.5
+    report.stage_seconds['commit'] = 0.5
+    metrics = report.openmetrics(1700000000.0)
+    assert metrics.startswith('# TYPE macprefs_last_run_timestamp_seconds gauge\n'
+                              '# UNIT macprefs_last_run_timestamp_seconds seconds\n'
+                              '# HELP macprefs_last_run_timestamp_seconds ')
+    assert 'macprefs_last_run_timestamp_seconds 1700000000.0\n' in metrics
+    assert 'macprefs_run_duration_seconds 2.0\n' in metrics
+    assert ('macprefs_stage_duration_seconds{stage="commit"} 0.5\n'
+            'macprefs_stage_duration_seconds{stage="export"} 1.5\n') in metrics
+    assert 'macprefs_domains{state="skipped"} 0\n' in metrics
+    assert 'macprefs_read_bytes 123456789\n' in metrics
+    assert 'macprefs_keys{state="rejected"} 4\n' in metrics
+    assert 'macprefs_subprocesses 2\n' in metrics
+    assert metrics.endswith('macprefs_peak_rss_bytes 1024\n# EOF\n')
+
+
+def test_peak_rss_bytes() -> None:
+    assert peak_rss_bytes() > 0
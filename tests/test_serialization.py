@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING
+import plistlib
+
+from macprefs.serialization import canonical_plist_bytes, canonicalize, write_canonical_plist
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def test_canonicalize() -> None:
+    assert canonicalize({
+        'b': [-0.0, plistlib.UID(3)],
+        'a': datetime(2024, 1, 2, 3, 4, 5, 678, tzinfo=timezone(timedelta(hours=1)))
+    }) == {
+        'a': datetime(2024, 1, 2, 2, 4, 5),  # ruff:ignore[call-datetime-without-tzinfo]
+        'b': [0.0, {
+            'CF$UID': 3
+        }]
+    }
+
+
+def test_canonicalize_binary_keeps_uid_and_fractional_seconds() -> None:
+    date = datetime(2024, 1, 2, 3, 4, 5, 678)  # ruff:ignore[call-datetime-without-tzinfo]
+    assert canonicalize([plistlib.UID(3), date], binary=True) == [plistlib.UID(3), date]
+
+
+def test_canonical_plist_bytes_is_stable() -> None:
+    a = canonical_plist_bytes({'z': 1, 'a': {'y': 1.5, 'b': 'x'}})
+    b = canonical_plist_bytes({'a': {'b': 'x', 'y': 1.5}, 'z': 1})
+    assert a == b
+    assert plistlib.loads(a) == {'a': {'b': 'x', 'y': 1.5}, 'z': 1}
+
+
+def test_canonical_plist_bytes_binary() -> None:
+    assert canonical_plist_bytes({'a': 1}, binary=True).startswith(b'bplist00')
+
+
+def test_write_canonical_plist(tmp_path: Path) -> None:
+    path = tmp_path / 'test.plist'
+    path.write_bytes(plistlib.dumps({'b': 1, 'a': 2}, fmt=plistlib.PlistFormat.FMT_BINARY))
+    assert write_canonical_plist(path) is True
+    assert path.read_bytes() == canonical_plist_bytes({'a': 2, 'b': 1})
+    mtime = path.stat().st_mtime_ns
+    assert write_canonical_plist(path) is True
+    assert path.stat().st_mtime_ns == mtime
+
+
+def test_write_canonical_plist_invalid(tmp_path: Path) -> None:
+    path = tmp_path / 'test.plist'
+    path.write_bytes(b'invalid')
+    assert write_canonical_plist(path) is False
+    assert path.read_bytes() == b'invalid'
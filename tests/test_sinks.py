@@ -0,0 +1,29 @@
+from __future__ import annotations
+
+from anyio import Path as AnyioPath
+from macprefs.config import make_configured_key_filter
+from macprefs.sinks import Sink
+
+
+def test_sink_from_config() -> None:
+    sink = Sink.from_config({
+        'output-directory': '/backup',
+        'binary': True,
+        'deploy-key': '/key',
+        'ignore-keys': {
+            'com.example': ['Volatile']
+        }
+    })
+    assert sink.out_dir == AnyioPath('/backup')
+    assert sink.deploy_key == AnyioPath('/key')
+    assert sink.binary is True
+    assert sink.canonical is False
+    assert sink.config == {'ignore-keys': {'com.example': ['Volatile']}}
+    assert sink.key_filter is not None
+    assert sink.key_filter('com.example', 'Volatile') is True
+    assert sink.key_filter('com.example', 'Other') is False
+
+
+def test_sink_key_filter_given() -> None:
+    key_filter = make_configured_key_filter({})
+    assert Sink(AnyioPath('/backup'), key_filter=key_filter).key_filter is key_filter
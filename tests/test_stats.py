@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any
+
+from macprefs.stats import (
+    VolatileKey,
+    find_volatile_keys,
+    load_key_stats,
+    record_key_stats,
+    save_key_stats,
+    update_key_stats,
+    volatile_keys_toml,
+)
+import tomlkit
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def test_load_key_stats_missing(tmp_path: Path) -> None:
+    assert load_key_stats(tmp_path / 'stats.json') == {'version': 1, 'runs': 0, 'keys': {}}
+
+
+def test_load_key_stats_incompatible(tmp_path: Path) -> None:
+    path = tmp_path / 'stats.json'
+    path.write_text('{"version": 0}')
+    assert load_key_stats(path) == {'version': 1, 'runs': 0, 'keys': {}}
+
+
+def test_save_and_load_key_stats(tmp_path: Path) -> None:
+    path = tmp_path / 'stats.json'
+    stats = {'version': 1, 'runs': 1, 'keys': {'domain': {'key': ['abc', 1, 0]}}}
+    save_key_stats(path, stats)
+    assert load_key_stats(path) == stats
+
+
+def test_update_key_stats() -> None:
+    stats: dict[str, Any] = {'version': 1, 'runs': 0, 'keys': {}}
+    for i in range(3):
+        update_key_stats(stats, [('domain', {
+            'counter': i,
+            'fixed': 'a',
+            'ignored': i
+        }), ('empty', {})], lambda _, k: k == 'ignored')
+    assert stats['runs'] == 3
+    assert list(stats['keys']) == ['domain']
+    assert stats['keys']['domain']['counter'][1:] == [3, 2]
+    assert stats['keys']['domain']['fixed'][1:] == [3, 0]
+    assert 'ignored' not in stats['keys']['domain']
+
+
+def test_record_key_stats(tmp_path: Path) -> None:
+    path = tmp_path / 'stats.json'
+    record_key_stats(path, [('domain', {'key': 1})])
+    record_key_stats(path, [('domain', {'key': 2})])
+    assert load_key_stats(path)['keys']['domain']['key'][1:] == [2, 1]
+
+
+def test_find_volatile_keys() -> None:
+    stats = {
+        'version': 1,
+        'runs': 10,
+        'keys': {
+            'domain': {
+                'always': ['', 10, 9],
+                'mostly': ['', 10, 8],
+                'rarely': ['', 10, 1],
+                'new': ['', 2, 1],
+                'filtered': ['', 10, 9]
+            }
+        }
+    }
+    assert find_volatile_keys(stats, lambda _, k: k == 'filtered', threshold=0.8) == [
+        VolatileKey('domain', 'always', 9, 10),
+        VolatileKey('domain', 'mostly', 8, 10)
+    ]
+
+
+def test_volatile_key_churn_single_run() -> None:
+    assert VolatileKey('domain', 'key', 0, 1).churn == 0
+
+
+def test_volatile_keys_toml() -> None:
+    text = volatile_keys_toml(
+        [VolatileKey('domain.b', 'b', 4, 5),
+         VolatileKey('domain.a', 're:x', 3, 5)])
+    assert text.startswith('# Volatile keys ranked by churn')
+    assert '# 100.0% (4/4) domain.b b\n' in text
+    assert tomlkit.loads(text) == {
+        'tool': {
+            'macprefs': {
+                'extend-ignore-keys': {
+                    'domain.b': ['b'],
+                    'domain.a': [r're:^re:x$']
+                }
+            }
+        }
+    }
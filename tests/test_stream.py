@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+import asyncio
+import plistlib
+import sys
+
+from anyio import Path as AnyioPath
+from macprefs.config import make_configured_key_filter
+from macprefs.processing import DomainFilter
+from macprefs.stream import DomainResult, stream_domains
+import macprefs
+import pytest
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from pytest_mock import MockerFixture
+
+
+def test_domain_result_from_root() -> None:
+    key_filter = make_configured_key_filter({'ignore-keys': {'domain': ['b']}})
+    result = DomainResult.from_root('domain', {'a': 1, 'b': {'c': 2}}, key_filter)
+    assert result.domain == 'domain'
+    assert result.root == {'a': 1, 'b': {'c': 2}}
+    assert result.accepted == {'a': 1}
+    assert result.rejected == {'b': {'c': 2}}
+    with pytest.raises(AttributeError):
+        result.domain = 'other'  # type: ignore[misc]
+
+
+def test_package_exports() -> None:
+    assert macprefs.DomainResult is DomainResult
+    assert macprefs.stream_domains is stream_domains
+    with pytest.raises(AttributeError):
+        _ = macprefs.missing
+
+
+@pytest.mark.asyncio
+async def test_stream_domains(tmp_path: Path, mocker: MockerFixture) -> None:
+    prefs = tmp_path / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    (prefs / 'domain.plist').write_bytes(plistlib.dumps({'a': 1, 'ignored': True, 'd': b'data'}))
+    (prefs / 'other.plist').write_bytes(plistlib.dumps({'b': 'x'}))
+    (prefs / 'empty.plist').write_bytes(plistlib.dumps({'d': b'data'}))
+    (prefs / 'skipped.plist').write_bytes(plistlib.dumps({'c': 1}))
+    (prefs / 'broken.plist').write_bytes(b'invalid')
+    (prefs / '.GlobalPreferences.plist').write_bytes(plistlib.dumps({'g': 1}))
+    before = sorted([x async for x in AnyioPath(tmp_path).rglob('*')])
+    mock_run_process = mocker.patch('macprefs.utils.run_process')
+    config = {'extend-ignore-domains': ['skipped'], 'ignore-keys': {'domain': ['ignored']}}
+    results = {x.domain: x async for x in stream_domains(config, jobs=2)}
+    assert sorted(results) == ['-globalDomain', 'domain', 'other']
+    assert results['domain'].accepted == {'a': 1}
+    assert results['domain'].rejected == {'ignored': True}
+    assert results['other'].root == {'b': 'x'}
+    assert results['-globalDomain'].accepted == {'g': 1}
+    selected = [x.domain async for x in stream_domains(config, domains=['other'])]
+    assert selected == ['other']
+    assert sorted([x async for x in AnyioPath(tmp_path).rglob('*')]) == before
+    mock_run_process.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_stream_domains_domain_filter(tmp_path: Path, mocker: MockerFixture) -> None:
+    prefs = tmp_path / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    (prefs / 'kept.plist').write_bytes(plistlib.dumps({'a': 1}))
+    (prefs / 'ignored.plist').write_bytes(plistlib.dumps({'a': 1}))
+    spy_generate_domains = mocker.spy(sys.modules['macprefs.utils'], 'generate_domains')
+    domain_filter = DomainFilter({'ignored'}, ())
+    results = [x.domain async for x in stream_domains(domain_filter=domain_filter)]
+    assert results == ['kept']
+    assert spy_generate_domains.call_args.kwargs['domain_filter'] is domain_filter
+
+
+@pytest.mark.asyncio
+async def test_stream_domains_stop_early(tmp_path: Path, mocker: MockerFixture) -> None:
+    prefs = tmp_path / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    for i in range(5):
+        (prefs / f'domain{i}.plist').write_bytes(plistlib.dumps({'a': i}))
+    stream = stream_domains({}, jobs=1)
+    first = await anext(stream)
+    await stream.aclose()
+    assert first.domain.startswith(('domain', '-globalDomain'))
+    assert not [x for x in asyncio.all_tasks() if x is not asyncio.current_task()]
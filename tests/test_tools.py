@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from macprefs.tools import find_tool, set_tool_paths, tool_path
+import pytest
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+    from pytest_mock import MockerFixture
+
+
+@pytest.fixture
+def reset_tool_paths() -> Iterator[None]:
+    set_tool_paths({})
+    yield
+    set_tool_paths({})
+
+
+def test_find_tool_caches(mocker: MockerFixture, reset_tool_paths: None) -> None:
+    mock_which = mocker.patch('macprefs.tools.shutil.which', return_value='/usr/bin/git')
+    assert find_tool('git') == '/usr/bin/git'
+    assert find_tool('git') == '/usr/bin/git'
+    mock_which.assert_called_once_with('git')
+
+
+def test_set_tool_paths_overrides(mocker: MockerFixture, reset_tool_paths: None) -> None:
+    mock_which = mocker.patch('macprefs.tools.shutil.which', return_value='/usr/bin/git')
+    assert find_tool('git') == '/usr/bin/git'
+    set_tool_paths({'git': '~/bin/git'})
+    assert find_tool('git') == str(Path.home() / 'bin/git')
+    assert find_tool('plutil') == '/usr/bin/git'
+    assert mock_which.call_count == 2
+
+
+def test_tool_path_not_found(mocker: MockerFixture, reset_tool_paths: None) -> None:
+    mocker.patch('macprefs.tools.shutil.which', return_value=None)
+    assert find_tool('plutil') is None
+    assert tool_path('plutil') == 'plutil'
@@ -1,39 +1,69 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING
+from datetime import datetime
+from typing import TYPE_CHECKING, Any
+import asyncio
+import errno
 import plistlib
 import subprocess as sp
 import sys
 
 from anyio import Path as AnyioPath
+from macprefs.cache import NegativeCache, SnapshotCache
+from macprefs.concurrency import RateLimiter
 from macprefs.exceptions import PropertyListConversionError
+from macprefs.processing import DomainFilter, FilterStats
+from macprefs.serialization import canonical_plist_bytes
+from macprefs.sinks import Sink
+from macprefs.tools import TOOL_NAMES, set_tool_paths
 from macprefs.utils import (
     chdir,
+    check_export,
+    convert_plist,
     defaults_export,
     generate_domains,
     git,
     install_job,
     is_git_installed,
+    load_snapshot,
     prefs_export,
     setup_output_directory,
+    setup_plist_diff_driver,
+    setup_state_directory,
     try_parse_plist,
 )
 import pytest
 
 if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Iterator
+    from pathlib import Path
+    import os
+
     from pytest_mock import MockerFixture
 
 
+@pytest.fixture
+def tool_paths() -> Iterator[None]:
+    set_tool_paths({name: name for name in TOOL_NAMES})
+    yield
+    set_tool_paths({})
+
+
+@pytest.fixture
+def mock_state_directory(mocker: MockerFixture, tmp_path: Path) -> AnyioPath:
+    state_dir = AnyioPath(tmp_path)
+    mocker.patch('macprefs.utils.setup_state_directory', return_value=state_dir)
+    return state_dir
+
+
 @pytest.mark.asyncio
-async def test_is_git_installed(mocker: MockerFixture) -> None:
-    mock_subprocess = mocker.patch('macprefs.utils.sp.create_subprocess_exec',
-                                   new_callable=mocker.AsyncMock)
-    mock_process = mocker.AsyncMock()
-    mock_process.wait.return_value = 0
-    mock_subprocess.return_value = mock_process
-    result = await is_git_installed()
-    assert result is True
-    mock_subprocess.assert_called_once_with('bash', '-c', 'command -v git', stdout=mocker.ANY)
+async def test_is_git_installed(mocker: MockerFixture, tool_paths: None) -> None:
+    mock_subprocess = mocker.patch('macprefs.utils.run_process', new_callable=mocker.AsyncMock)
+    assert await is_git_installed() is True
+    set_tool_paths({})
+    mocker.patch('macprefs.tools.shutil.which', return_value=None)
+    assert await is_git_installed() is False
+    mock_subprocess.assert_not_called()
 
 
 @pytest.mark.asyncio
@@ -46,13 +76,47 @@ async def test_generate_domains(mocker: MockerFixture) -> None:
         AnyioPath('.hidden.plist')
     ]
     mocker.patch('macprefs.utils.Path.glob', return_value=mock_glob)
-    mocker.patch('macprefs.utils.BAD_DOMAINS', {'test2'})
-    mocker.patch('macprefs.utils.BAD_DOMAIN_PREFIXES', {'bad'})
+    mocker.patch('macprefs.filters.BAD_DOMAINS', {'test2'})
+    mocker.patch('macprefs.filters.BAD_DOMAIN_PREFIXES', {'bad'})
     result = [x async for x in generate_domains(['additional_bad_domain'], [])]
     assert result == ['test1', '-globalDomain']
     mock_glob.__aiter__.assert_called_once()
 
 
+@pytest.mark.asyncio
+async def test_generate_domains_stats(mocker: MockerFixture) -> None:
+    mock_glob = mocker.AsyncMock()
+    mock_glob.__aiter__.return_value = [
+        AnyioPath('bad_.plist'),
+        AnyioPath('test1.plist'),
+        AnyioPath('test2.plist')
+    ]
+    mocker.patch('macprefs.utils.Path.glob', return_value=mock_glob)
+    mocker.patch('macprefs.filters.BAD_DOMAINS', {'test2'})
+    mocker.patch('macprefs.filters.BAD_DOMAIN_PREFIXES', {'bad'})
+    stats = FilterStats()
+    result = [x async for x in generate_domains(['unused'], [], stats=stats)]
+    assert result == ['test1', '-globalDomain']
+    assert stats.rule_hits == {'domain:test2': 1, 'prefix:bad': 1}
+    assert stats.dead_rules() == ['domain:unused']
+
+
+@pytest.mark.asyncio
+async def test_generate_domains_domain_filter(mocker: MockerFixture) -> None:
+    mock_glob = mocker.AsyncMock()
+    mock_glob.__aiter__.return_value = [
+        AnyioPath('com.apple.a.plist'),
+        AnyioPath('b.plist'),
+        AnyioPath('c.plist')
+    ]
+    mocker.patch('macprefs.utils.Path.glob', return_value=mock_glob)
+    stats = FilterStats()
+    domain_filter = DomainFilter({'c'}, {'com.apple.'})
+    result = [x async for x in generate_domains(domain_filter=domain_filter, stats=stats)]
+    assert result == ['b', '-globalDomain']
+    assert stats.rule_hits == {'domain:c': 1, 'prefix:com.apple.': 1}
+
+
 @pytest.mark.asyncio
 async def test_try_parse_plist_valid(mocker: MockerFixture) -> None:
     mock_open = mocker.patch('macprefs.utils.Path.open')
@@ -78,6 +142,16 @@ async def test_try_parse_plist_invalid(mocker: MockerFixture) -> None:
     mock_load.assert_called_once()
 
 
+@pytest.mark.asyncio
+async def test_try_parse_plist_invalid_callback(tmp_path: Path, mocker: MockerFixture) -> None:
+    plist = tmp_path / 'test.plist'
+    plist.write_bytes(b'invalid')
+    on_invalid = mocker.MagicMock()
+    assert await try_parse_plist('domain', AnyioPath(plist),
+                                 on_invalid=on_invalid) == ('domain', {})
+    on_invalid.assert_called_once_with()
+
+
 @pytest.mark.asyncio
 async def test_chdir(mocker: MockerFixture) -> None:
     mock_chdir = mocker.patch('os.chdir')
@@ -90,7 +164,7 @@ async def test_chdir(mocker: MockerFixture) -> None:
 
 
 @pytest.mark.asyncio
-async def test_git(mocker: MockerFixture) -> None:
+async def test_git(mocker: MockerFixture, tool_paths: None) -> None:
     work_tree_path = mocker.AsyncMock(spec=AnyioPath)
     truediv_mock = mocker.AsyncMock()
     truediv_mock.__str__.return_value = '/work_tree/.git'
@@ -101,33 +175,31 @@ async def test_git(mocker: MockerFixture) -> None:
     mock_path = mocker.patch('macprefs.utils.Path')
     mock_resolved = mocker.AsyncMock()
     mock_path.return_value.resolve.return_value = mock_resolved
-    mock_subprocess = mocker.patch('macprefs.utils.sp.create_subprocess_exec',
-                                   new_callable=mocker.AsyncMock)
-    mock_process = mocker.AsyncMock()
-    mock_process.wait.return_value = 0
-    mock_subprocess.return_value = mock_process
+    mock_subprocess = mocker.patch('macprefs.utils.run_process',
+                                   new_callable=mocker.AsyncMock,
+                                   return_value=sp.CompletedProcess((), 0, b'', b''))
+    mock_process = mock_subprocess.return_value
     result = await git(['status'], work_tree_path)
     assert result == mock_process
     mock_subprocess.assert_called_with('git',
                                        '--git-dir=/work_tree/.git',
                                        '--work-tree=/work_tree',
                                        'status',
-                                       stderr=mocker.ANY)
+                                       timeout=mocker.ANY)
 
 
 @pytest.mark.asyncio
-async def test_git_with_git_dir_and_ssh_key(mocker: MockerFixture) -> None:
+async def test_git_with_git_dir_and_ssh_key(mocker: MockerFixture, tool_paths: None) -> None:
     work_tree = mocker.AsyncMock()
     work_tree.__str__.return_value = '/work_tree'
     git_dir = mocker.AsyncMock()
     git_dir.__str__.return_value = '/work_tree/.git'
     git_dir.resolve.return_value.__truediv__.return_value.__str__.return_value = '/work_tree/.git'
     mocker.patch('macprefs.utils.os.chdir')
-    mock_subprocess = mocker.patch('macprefs.utils.sp.create_subprocess_exec',
-                                   new_callable=mocker.AsyncMock)
-    mock_process = mocker.AsyncMock()
-    mock_process.wait.return_value = 0
-    mock_subprocess.return_value = mock_process
+    mock_subprocess = mocker.patch('macprefs.utils.run_process',
+                                   new_callable=mocker.AsyncMock,
+                                   return_value=sp.CompletedProcess((), 0, b'', b''))
+    mock_process = mock_subprocess.return_value
     result = await git(['status'], work_tree, git_dir, '/path/to/ssh_key')
     assert result == mock_process
     mock_subprocess.assert_any_call(
@@ -137,94 +209,49 @@ async def test_git_with_git_dir_and_ssh_key(mocker: MockerFixture) -> None:
         'config',
         'core.sshCommand',
         'ssh -i /path/to/ssh_key -F /dev/null -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no',  # ruff:ignore[line-too-long]
-        stderr=mocker.ANY)
+        timeout=mocker.ANY)
     mock_subprocess.assert_any_call('git',
                                     '--git-dir=/work_tree/.git',
                                     '--work-tree=/work_tree',
                                     'status',
-                                    stderr=mocker.ANY)
+                                    timeout=mocker.ANY)
     assert mock_subprocess.call_count == 2
 
 
 @pytest.mark.asyncio
-async def test_git_no_git_dir(mocker: MockerFixture) -> None:
+async def test_git_no_git_dir(mocker: MockerFixture, tool_paths: None) -> None:
     work_tree = mocker.AsyncMock(spec=AnyioPath)
     work_tree.__str__.return_value = '/work_tree'
     truediv_mock = mocker.AsyncMock()
     truediv_mock.__str__.return_value = '/work_tree/.git'
     truediv_mock.exists = mocker.AsyncMock(return_value=False)
     work_tree.resolve.return_value.__truediv__.return_value = truediv_mock
-    mock_chdir = mocker.MagicMock()
-    mock_chdir.__aenter__.return_value = None
-    mock_chdir.__aexit__.return_value = None
-    mocker.patch('macprefs.utils.chdir', mock_chdir)
-    mock_subprocess = mocker.patch('macprefs.utils.sp.create_subprocess_exec',
-                                   new_callable=mocker.AsyncMock)
-    mock_process = mocker.AsyncMock()
-    mock_process.wait.return_value = 0
-    mock_subprocess.return_value = mock_process
+    mock_subprocess = mocker.patch('macprefs.utils.run_process',
+                                   new_callable=mocker.AsyncMock,
+                                   return_value=sp.CompletedProcess((), 0, b'', b''))
+    mock_process = mock_subprocess.return_value
     result = await git(['status'], work_tree)
     assert result == mock_process
-    mock_subprocess.assert_any_call('git', 'init', stdout=mocker.ANY, stderr=mocker.ANY)
-
-
-@pytest.mark.asyncio
-async def test_git_error(mocker: MockerFixture) -> None:
-    work_tree = mocker.AsyncMock(spec=AnyioPath)
-    work_tree.__str__.return_value = '/work_tree'
-    git_dir = mocker.AsyncMock(spec=AnyioPath)
-    git_dir.__str__.return_value = '/work_tree/.git'
-    git_dir.resolve.return_value.__truediv__.return_value.__str__.return_value = '/work_tree/.git'
-    mocker.patch('macprefs.utils.os.chdir')
-    mock_subprocess = mocker.patch('macprefs.utils.sp.create_subprocess_exec',
-                                   new_callable=mocker.AsyncMock)
-    mock_config_ok = mocker.AsyncMock()
-    mock_config_ok.wait = mocker.AsyncMock(return_value=0)
-    mock_status_fail = mocker.AsyncMock()
-    mock_status_fail.wait = mocker.AsyncMock(return_value=1)
-    mock_status_fail.returncode = 1
-    mock_status_fail.stderr = mocker.AsyncMock()
-    mock_status_fail.stderr.read = mocker.AsyncMock(return_value=b'fatal: bad')
-    mock_subprocess.side_effect = [mock_config_ok, mock_status_fail]
-    with pytest.raises(sp.CalledProcessError):
-        await git(['status'], work_tree, git_dir, '/path/to/ssh_key')
+    mock_subprocess.assert_any_call('git', 'init', cwd=work_tree, timeout=mocker.ANY)
 
 
 @pytest.mark.asyncio
-async def test_git_unexpected_subprocess_state_missing_stderr(mocker: MockerFixture) -> None:
+async def test_git_error(mocker: MockerFixture, tool_paths: None) -> None:
     work_tree = mocker.AsyncMock(spec=AnyioPath)
     work_tree.__str__.return_value = '/work_tree'
     git_dir = mocker.AsyncMock(spec=AnyioPath)
     git_dir.__str__.return_value = '/work_tree/.git'
     git_dir.resolve.return_value.__truediv__.return_value.__str__.return_value = '/work_tree/.git'
     mocker.patch('macprefs.utils.os.chdir')
-    mock_subprocess = mocker.patch('macprefs.utils.sp.create_subprocess_exec',
-                                   new_callable=mocker.AsyncMock)
-    mock_process = mocker.AsyncMock()
-    mock_process.wait.return_value = 1
-    mock_process.stderr = None
-    mock_subprocess.return_value = mock_process
-    with pytest.raises(RuntimeError, match='unexpected state'):
-        await git(['status'], work_tree, git_dir, '/path/to/ssh_key')
-
-
-@pytest.mark.asyncio
-async def test_git_unexpected_subprocess_state_missing_returncode(mocker: MockerFixture) -> None:
-    work_tree = mocker.AsyncMock(spec=AnyioPath)
-    work_tree.__str__.return_value = '/work_tree'
-    git_dir = mocker.AsyncMock(spec=AnyioPath)
-    git_dir.__str__.return_value = '/work_tree/.git'
-    git_dir.resolve.return_value.__truediv__.return_value.__str__.return_value = '/work_tree/.git'
-    mocker.patch('macprefs.utils.os.chdir')
-    mock_subprocess = mocker.patch('macprefs.utils.sp.create_subprocess_exec',
-                                   new_callable=mocker.AsyncMock)
-    mock_process = mocker.AsyncMock()
-    mock_process.wait.return_value = 1
-    mock_process.returncode = None
-    mock_process.stderr = mocker.AsyncMock()
-    mock_subprocess.return_value = mock_process
-    with pytest.raises(RuntimeError, match='unexpected state'):
+    mock_subprocess = mocker.patch('macprefs.utils.run_process', new_callable=mocker.AsyncMock)
+    mock_subprocess.side_effect = [
+        sp.CompletedProcess((), 0, b'', b''),
+        sp.CompletedProcess((), 1, b'', b'fatal: bad')
+    ]
+    with pytest.raises(sp.CalledProcessError) as exc_info:
         await git(['status'], work_tree, git_dir, '/path/to/ssh_key')
+    assert exc_info.value.stderr == 'fatal: bad'
+    assert exc_info.value.cmd == 'git --git-dir=/work_tree/.git --work-tree=/work_tree status'
 
 
 @pytest.mark.asyncio
@@ -265,6 +292,22 @@ async def test_defaults_export(mocker: MockerFixture) -> None:
     mock_try_parse.assert_called_once()
 
 
+@pytest.mark.asyncio
+async def test_defaults_export_read_limiter(mocker: MockerFixture, tmp_path: Path) -> None:
+    prefs = tmp_path / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    data = plistlib.dumps({'key': 'value'})
+    (prefs / 'domain.plist').write_bytes(data)
+    (tmp_path / 'out').mkdir()
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    read_limiter = mocker.AsyncMock(spec=RateLimiter)
+    assert await defaults_export('domain', AnyioPath(tmp_path / 'out'),
+                                 read_limiter=read_limiter) == ('domain', {
+                                     'key': 'value'
+                                 })
+    read_limiter.acquire.assert_awaited_once_with(len(data))
+
+
 @pytest.mark.asyncio
 async def test_defaults_export_permission_error(mocker: MockerFixture) -> None:
     mock_copy = mocker.patch('shutil.copy', side_effect=PermissionError)
@@ -293,7 +336,7 @@ async def test_defaults_export_permission_error(mocker: MockerFixture) -> None:
 
 
 @pytest.mark.asyncio
-async def test_install_job(mocker: MockerFixture) -> None:
+async def test_install_job(mocker: MockerFixture, tool_paths: None) -> None:
     mock_plistlib_dump = mocker.patch('macprefs.utils.plistlib.dump')
     mock_plist_path = mocker.AsyncMock()
     mock_plist_path.__str__.return_value = '/a/path/to/com.sh.tat.macprefs.plist'
@@ -301,15 +344,12 @@ async def test_install_job(mocker: MockerFixture) -> None:
     mock_user_log_path.return_value.__truediv__.return_value.__str__.return_value = '/a/log-path/macprefs.log'  # ruff:ignore[line-too-long]
     mock_path_home = mocker.patch('macprefs.utils.Path.home')
     mock_path_home.return_value.__truediv__.return_value = mock_plist_path
-    mock_subprocess = mocker.patch('macprefs.utils.sp.create_subprocess_exec',
-                                   new_callable=mocker.AsyncMock)
-    mock_process = mocker.AsyncMock()
-    mock_process.returncode = 0
-    mock_process.stdout.read.return_value = b'output'
-    mock_process.wait.return_value = 0
-    mock_subprocess.return_value = mock_process
-    mock_path = mocker.MagicMock(name='/output_dir')
-    mock_path.resolve.return_value.__str__.return_value = '/output_dir'
+    mock_subprocess = mocker.patch('macprefs.utils.run_process',
+                                   new_callable=mocker.AsyncMock,
+                                   return_value=sp.CompletedProcess((), 0, b'', b''))
+    set_tool_paths({'launchctl': 'launchctl', 'prefs-export': '/bin/prefs-export'})
+    mock_path = mocker.AsyncMock(spec=AnyioPath)
+    mock_path.resolve.return_value = AnyioPath('/output_dir')
     result = await install_job(mock_path)
     mock_plistlib_dump.assert_called_once_with(
         {
@@ -317,7 +357,11 @@ async def test_install_job(mocker: MockerFixture) -> None:
                 'NO_COLOR': '1'
             },
             'Label': 'sh.tat.macprefs',
-            'ProgramArguments': ['output', '--output-directory', '/output_dir', '--commit'],
+            'LowPriorityIO': True,
+            'ProcessType': 'Background',
+            'ProgramArguments': [
+                '/bin/prefs-export', '--output-directory', '/output_dir', '--commit', '--background'
+            ],
             'RunAtLoad': True,
             'StandardErrorPath': '/a/log-path/macprefs.log',
             'StandardOutPath': '/a/log-path/macprefs.log',
@@ -329,53 +373,75 @@ async def test_install_job(mocker: MockerFixture) -> None:
         mock_plist_path.open.return_value.__aenter__.return_value.wrapped,
         fmt=plistlib.PlistFormat.FMT_XML)
     assert result == 0
-    assert mock_subprocess.call_count == 5
-    assert mock_subprocess.await_count == 5
+    assert mock_subprocess.call_count == 4
+    assert mock_subprocess.await_count == 4
     mock_subprocess.assert_has_awaits([
-        mocker.call('bash', '-c', 'command -v prefs-export', stdout=-1),
-        mocker.call('launchctl',
-                    'stop',
-                    '/a/path/to/com.sh.tat.macprefs.plist',
-                    stderr=-1,
-                    stdout=-1),
-        mocker.call('launchctl',
-                    'unload',
-                    '-w',
-                    '/a/path/to/com.sh.tat.macprefs.plist',
-                    stderr=-1,
-                    stdout=-1),
-        mocker.call('launchctl', 'load', '-w', '/a/path/to/com.sh.tat.macprefs.plist'),
-        mocker.call('launchctl', 'start', '/a/path/to/com.sh.tat.macprefs.plist')
+        mocker.call('launchctl', 'stop', '/a/path/to/com.sh.tat.macprefs.plist', timeout=30),
+        mocker.call('launchctl', 'unload', '-w', '/a/path/to/com.sh.tat.macprefs.plist',
+                    timeout=30),
+        mocker.call('launchctl', 'load', '-w', '/a/path/to/com.sh.tat.macprefs.plist', timeout=30),
+        mocker.call('launchctl', 'start', '/a/path/to/com.sh.tat.macprefs.plist', timeout=30)
     ])
 
 
 @pytest.mark.asyncio
-async def test_install_job_prefs_export_stdout_missing(mocker: MockerFixture) -> None:
-    mock_subprocess = mocker.patch('macprefs.utils.sp.create_subprocess_exec',
-                                   new_callable=mocker.AsyncMock)
-    mock_probe = mocker.AsyncMock()
-    mock_probe.stdout = None
-    mock_subprocess.return_value = mock_probe
-    mock_path = mocker.MagicMock(name='/output_dir')
-    mock_path.resolve.return_value.__str__.return_value = '/output_dir'
-    with pytest.raises(RuntimeError, match='prefs-export stdout'):
-        await install_job(mock_path)
-    mock_subprocess.assert_awaited_once_with('bash',
-                                             '-c',
-                                             'command -v prefs-export',
-                                             stdout=sp.PIPE)
+async def test_install_job_watch(mocker: MockerFixture, tool_paths: None) -> None:
+    mock_plistlib_dump = mocker.patch('macprefs.utils.plistlib.dump')
+    mocker.patch('macprefs.utils.user_log_path')
+    mock_path_home = mocker.patch('macprefs.utils.Path.home')
+    mock_path_home.return_value.__truediv__.return_value = mocker.AsyncMock()
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 return_value=sp.CompletedProcess((), 0, b'', b''))
+    mock_path = mocker.AsyncMock(spec=AnyioPath)
+    mock_path.resolve.return_value = AnyioPath('/output_dir')
+    mock_key = mocker.AsyncMock(spec=AnyioPath)
+    mock_key.resolve.return_value = AnyioPath('/key')
+    assert await install_job(mock_path, mock_key, watch=True) == 0
+    job = mock_plistlib_dump.call_args.args[0]
+    assert job['ProgramArguments'] == [
+        'prefs-export', '--output-directory', '/output_dir', '--commit', '--background',
+        '--deploy-key', '/key', '--watch'
+    ]
+    assert job['KeepAlive'] is True
+    assert 'StartCalendarInterval' not in job
 
 
 @pytest.mark.asyncio
-async def test_prefs_export_error(mocker: MockerFixture) -> None:
-    mocker.patch('macprefs.utils.MAX_CONCURRENT_EXPORT_TASKS', 2)
-    mocker.patch('macprefs.utils.sp.create_subprocess_exec', new_callable=mocker.AsyncMock)
-    mocker.patch('macprefs.utils.Path')
+async def test_install_job_launchctl_failure(mocker: MockerFixture, tool_paths: None) -> None:
+    mocker.patch('macprefs.utils.plistlib.dump')
+    mocker.patch('macprefs.utils.user_log_path')
+    mock_path_home = mocker.patch('macprefs.utils.Path.home')
+    mock_path_home.return_value.__truediv__.return_value = mocker.AsyncMock()
+    mock_log_error = mocker.patch('macprefs.utils.log.error')
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 side_effect=[
+                     sp.CompletedProcess((), 0, b'', b''),
+                     sp.CompletedProcess((), 0, b'', b''),
+                     sp.CompletedProcess((), 0, b'', b''),
+                     sp.CompletedProcess((), 3, b'', b'Could not find service')
+                 ])
+    assert await install_job(mocker.AsyncMock(spec=AnyioPath)) == 1
+    mock_log_error.assert_called_once_with('`launchctl %s` failed: %s', 'start',
+                                           'Could not find service')
+
+
+@pytest.mark.asyncio
+async def test_install_job_prefs_export_not_found(mocker: MockerFixture, tool_paths: None) -> None:
+    set_tool_paths({})
+    mocker.patch('macprefs.tools.shutil.which', return_value=None)
+    mock_subprocess = mocker.patch('macprefs.utils.run_process', new_callable=mocker.AsyncMock)
+    assert await install_job(mocker.MagicMock()) == 1
+    mock_subprocess.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_error(mocker: MockerFixture, tmp_path: Path) -> None:
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 return_value=sp.CompletedProcess((), 1, b'', b'invalid'))
     mock_is_git_installed = mocker.patch('macprefs.utils.is_git_installed', return_value=True)
-    mock_out_dir = mocker.AsyncMock()
-    mock_repo_prefs_dir = mocker.AsyncMock()
-    mock_setup_output_directory = mocker.patch('macprefs.utils.setup_output_directory',
-                                               return_value=(mock_out_dir, mock_repo_prefs_dir))
     mock_generate_domains = mocker.AsyncMock()
     mock_generate_domains.__aiter__.return_value = ['domain1', 'domain2', 'domain3']
     mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
@@ -386,31 +452,26 @@ async def test_prefs_export_error(mocker: MockerFixture) -> None:
                                         }), ('domain2', {
                                             'key': 'value'
                                         }), ('domain3', {})])
-    mocker.patch('macprefs.utils.git', new_callable=mocker.AsyncMock)
-    mock_out_dir.__truediv__.return_value = mocker.AsyncMock()
-    mock_out_dir.__truediv__.return_value.__aenter__.return_value.open.return_value = mocker.AsyncMock(  # ruff:ignore[line-too-long]
-    )
-    mock_repo_prefs_dir.__truediv__.return_value.name = 'out.plist'
+    mock_git = mocker.patch('macprefs.utils.git', new_callable=mocker.AsyncMock)
     with pytest.raises(PropertyListConversionError):
-        await prefs_export(mock_out_dir, commit=True)
+        await prefs_export(AnyioPath(tmp_path),
+                           commit=True,
+                           jobs=2,
+                           metrics_file=AnyioPath(tmp_path / 'macprefs.prom'))
+    metrics = (tmp_path / 'macprefs.prom').read_text()
+    assert 'macprefs_last_run_success 0\n' in metrics
+    assert 'macprefs_domains{state="failed"} 2\n' in metrics
     mock_is_git_installed.assert_called_once()
-    mock_setup_output_directory.assert_called_once()
     mock_generate_domains.__aiter__.assert_called_once()
     mock_defaults_export.assert_called()
+    mock_git.assert_not_called()
 
 
 @pytest.mark.asyncio
-async def test_prefs_export(mocker: MockerFixture) -> None:
-    mock_subprocess = mocker.patch('macprefs.utils.sp.create_subprocess_exec',
-                                   new_callable=mocker.AsyncMock)
-    mock_process = mocker.AsyncMock()
-    mock_process.wait.return_value = 0
-    mock_subprocess.return_value = mock_process
-    mocker.patch('macprefs.utils.Path')
-    mock_out_dir = mocker.AsyncMock()
-    mock_repo_prefs_dir = mocker.AsyncMock()
-    mock_setup_output_directory = mocker.patch('macprefs.utils.setup_output_directory',
-                                               return_value=(mock_out_dir, mock_repo_prefs_dir))
+async def test_prefs_export(mocker: MockerFixture, tmp_path: Path) -> None:
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 return_value=sp.CompletedProcess((), 0, b'', b''))
     mock_generate_domains = mocker.AsyncMock()
     mock_generate_domains.__aiter__.return_value = ['domain1', 'domain2', 'domain3', 'rejected1']
     mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
@@ -423,182 +484,934 @@ async def test_prefs_export(mocker: MockerFixture) -> None:
                                         }), ('domain3', {}), ('rejected1', {
                                             'key': 'value'
                                         })])
-    mocker.patch('macprefs.utils.git', new_callable=mocker.AsyncMock)
+    mock_git = mocker.patch('macprefs.utils.git', new_callable=mocker.AsyncMock)
     mock_is_git_installed = mocker.patch('macprefs.utils.is_git_installed', return_value=False)
-    mock_exec_defaults_io = mocker.AsyncMock()
-    mock_out_dir.__truediv__.return_value = mocker.AsyncMock()
-    mock_out_dir.__truediv__.return_value.open.return_value.__aenter__.return_value = mock_exec_defaults_io  # ruff:ignore[line-too-long]
-    mock_repo_prefs_dir.__truediv__.return_value.name = 'out.plist'
-    mocker.patch('macprefs.utils.make_key_filter', return_value=lambda d, _: d == 'rejected1')
-    await prefs_export(mock_out_dir, commit=True)
-    mock_exec_defaults_io.write.assert_has_calls([
-        mocker.call('#!/usr/bin/env bash\n'),
-        mocker.call('# shellcheck disable=SC1003,SC1010,SC1112,SC2016,SC2088\n'),
-        mocker.call('# This file is generated, but is versioned.\n\n'),
-        mocker.call('# domain1\n'),
-        mocker.call('defaults write domain1 key -string value\n'),
-        mocker.call('\n'),
-        mocker.call('# domain2\n'),
-        mocker.call('defaults write domain2 key -string value\n'),
-        mocker.call('\n'),
-        mocker.call('# Rejected defaults values.\n'),
-        mocker.call('# shellcheck disable=SC1003,SC1010,SC1112,SC2016,SC2088\n'),
-        mocker.call('# This file is generated, but is versioned.\n\n'),
-        mocker.call('# rejected1\n'),
-        mocker.call('defaults write rejected1 key -string value\n'),
-        mocker.call('\n')
-    ])
+    mocker.patch('macprefs.config.make_key_filter', return_value=lambda d, _: d == 'rejected1')
+    (tmp_path / 'scripts').mkdir()
+    (tmp_path / 'scripts/stale.sh').write_text('# stale\n')
+    await prefs_export(AnyioPath(tmp_path), commit=True)
+    assert (tmp_path / 'exec-defaults.sh').read_text() == (
+        '#!/usr/bin/env bash\n'
+        '# shellcheck disable=SC1003,SC1010,SC1112,SC2016,SC2088\n'
+        '# This file is generated, but is versioned.\n\n'
+        '# domain1\n'
+        'defaults write domain1 key -string value\n'
+        '\n'
+        '# domain2\n'
+        'defaults write domain2 key -string value\n'
+        '\n')
+    assert (tmp_path / 'rejected-defaults.sh').read_text() == (
+        '# Rejected defaults values.\n'
+        '# shellcheck disable=SC1003,SC1010,SC1112,SC2016,SC2088\n'
+        '# This file is generated, but is versioned.\n\n'
+        '# rejected1\n'
+        'defaults write rejected1 key -string value\n'
+        '\n')
+    assert sorted(x.name for x in (tmp_path / 'scripts').iterdir()) == [
+        'domain1.sh', 'domain2.sh', 'rejected'
+    ]
+    assert sorted(x.name for x in (tmp_path / 'scripts/rejected').iterdir()) == ['rejected1.sh']
     mock_is_git_installed.assert_called_once()
-    mock_setup_output_directory.assert_called_once()
     mock_generate_domains.__aiter__.assert_called_once()
     mock_defaults_export.assert_called()
+    mock_git.assert_not_called()
 
 
-@pytest.mark.asyncio
-async def test_prefs_export_git_error(mocker: MockerFixture) -> None:
-    mock_logger = mocker.patch('macprefs.utils.log.info')
-    mock_subprocess = mocker.patch('macprefs.utils.sp.create_subprocess_exec',
-                                   new_callable=mocker.AsyncMock)
-    mock_process = mocker.AsyncMock()
-    mock_process.wait.return_value = 0
-    mock_subprocess.return_value = mock_process
-    mocker.patch('macprefs.utils.Path')
-    mock_out_dir = mocker.AsyncMock(spec=AnyioPath)
-    mock_repo_prefs_dir = mocker.AsyncMock(spec=AnyioPath)
-    mock_setup_output_directory = mocker.patch('macprefs.utils.setup_output_directory',
-                                               return_value=(mock_out_dir, mock_repo_prefs_dir))
+def _prefs_export_git_mocks(mocker: MockerFixture, tmp_path: Path) -> Any:
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 return_value=sp.CompletedProcess((), 0, b'', b''))
     mock_generate_domains = mocker.AsyncMock()
     mock_generate_domains.__aiter__.return_value = ['domain1', 'domain2', 'domain3', 'rejected1']
     mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
-    mock_defaults_export = mocker.patch('macprefs.utils.defaults_export',
-                                        new_callable=mocker.AsyncMock,
-                                        side_effect=[('domain1', {
-                                            'key': 'value'
-                                        }), ('domain2', {
-                                            'key': 'value'
-                                        }), ('domain3', {}), ('rejected1', {
-                                            'key': 'value'
-                                        })])
-    mock_git = mocker.patch('macprefs.utils.git', new_callable=mocker.AsyncMock)
-    mock_git_branch_process = mocker.AsyncMock()
-    mock_git_branch_process.stdout.read = mocker.AsyncMock(return_value=b'branch')
+    mocker.patch('macprefs.utils.defaults_export',
+                 new_callable=mocker.AsyncMock,
+                 side_effect=[('domain1', {
+                     'key': 'value'
+                 }), ('domain2', {
+                     'key': 'value'
+                 }), ('domain3', {}), ('rejected1', {
+                     'key': 'value'
+                 })])
+    mocker.patch('macprefs.utils.is_git_installed', return_value=True)
+    mocker.patch('macprefs.config.make_key_filter', return_value=lambda d, _: d == 'rejected1')
+    (tmp_path / 'Preferences').mkdir()
+    (tmp_path / 'Preferences/test1.plist').write_bytes(b'')
+    return mocker.patch('macprefs.utils.git', new_callable=mocker.AsyncMock)
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_git_error(mocker: MockerFixture, tmp_path: Path) -> None:
+    mock_logger = mocker.patch('macprefs.utils.log.info')
+    mock_git = _prefs_export_git_mocks(mocker, tmp_path)
+    mock_process = sp.CompletedProcess((), 0, b'', b'')
+    mock_git_branch_process = sp.CompletedProcess((), 0, b'branch\n', b'')
     mock_git.side_effect = [
         mock_process, mock_process, mock_process, mock_git_branch_process,
         sp.CalledProcessError(1, 'git')
     ]
-    mock_is_git_installed = mocker.patch('macprefs.utils.is_git_installed', return_value=True)
-    mock_out_dir.__truediv__.return_value = mocker.AsyncMock()
-    mock_out_dir.__truediv__.return_value.open = mocker.AsyncMock()
-    mock_repo_prefs_dir.__truediv__.return_value.name = 'out.plist'
-    mocker.patch('macprefs.utils.make_key_filter', return_value=lambda d, _: d == 'rejected1')
-    test1_plist = mocker.AsyncMock(spec=AnyioPath)
-    test1_plist.name = 'test1.plist'
-    test1_plist.exists.return_value = True
-    test1_plist.is_dir.return_value = False
-    iterdir_iterator = mocker.AsyncMock()
-    mock_repo_prefs_dir.iterdir.return_value = iterdir_iterator
-    iterdir_iterator.__aiter__.return_value = [test1_plist]
     mock_deploy_key = mocker.AsyncMock(spec=AnyioPath)
-    await prefs_export(mock_out_dir, deploy_key=mock_deploy_key, commit=True)
-    mock_is_git_installed.assert_called_once()
-    mock_setup_output_directory.assert_called_once()
-    mock_generate_domains.__aiter__.assert_called_once()
-    mock_defaults_export.assert_called()
+    await prefs_export(AnyioPath(tmp_path), deploy_key=mock_deploy_key, commit=True)
     assert mock_git.call_count == 5
+    mock_git.assert_any_await(
+        ('rm', '-f', '--ignore-unmatch', '--', str(tmp_path / 'Preferences/test1.plist')),
+        AnyioPath(tmp_path))
     mock_logger.assert_called_once_with('Likely no changes to commit.')
 
 
+@pytest.mark.parametrize('failing_call', [2, 4])
 @pytest.mark.asyncio
-async def test_prefs_export_git_branch_stdout_missing(mocker: MockerFixture) -> None:
-    mock_subprocess = mocker.patch('macprefs.utils.sp.create_subprocess_exec',
-                                   new_callable=mocker.AsyncMock)
-    mock_process = mocker.AsyncMock()
-    mock_process.wait.return_value = 0
-    mock_subprocess.return_value = mock_process
-    mocker.patch('macprefs.utils.Path')
-    mock_out_dir = mocker.AsyncMock(spec=AnyioPath)
-    mock_repo_prefs_dir = mocker.AsyncMock(spec=AnyioPath)
-    mock_setup_output_directory = mocker.patch('macprefs.utils.setup_output_directory',
-                                               return_value=(mock_out_dir, mock_repo_prefs_dir))
+async def test_prefs_export_git_timeout(mocker: MockerFixture, tmp_path: Path,
+                                        failing_call: int) -> None:
+    mock_log_warning = mocker.patch('macprefs.utils.log.warning')
+    mock_git = _prefs_export_git_mocks(mocker, tmp_path)
+    mock_process = sp.CompletedProcess((), 0, b'branch\n', b'')
+    mock_git.side_effect = [mock_process] * failing_call + [sp.TimeoutExpired('git', 60)]
+    report = await prefs_export(AnyioPath(tmp_path),
+                                deploy_key=mocker.AsyncMock(spec=AnyioPath),
+                                commit=True)
+    assert report.success is True
+    mock_log_warning.assert_called_once()
+    assert mock_log_warning.call_args.args[0].startswith('Timed out committing' if failing_call ==
+                                                         2 else 'Timed out pushing')
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_git_no_deploy_key(mocker: MockerFixture, tmp_path: Path) -> None:
+    mock_git = _prefs_export_git_mocks(mocker, tmp_path)
+    mock_git.return_value = sp.CompletedProcess((), 0, b'', b'')
+    await prefs_export(AnyioPath(tmp_path), commit=True)
+    assert mock_git.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_setup_plist_diff_driver(tmp_path: Path, mocker: MockerFixture) -> None:
+    mock_git = mocker.patch('macprefs.utils.git', new_callable=mocker.AsyncMock)
+    out_dir = AnyioPath(tmp_path)
+    await (out_dir / '.gitattributes').write_text('*.sh text\n')
+    await setup_plist_diff_driver(out_dir)
+    await setup_plist_diff_driver(out_dir)
+    assert (await (out_dir /
+                   '.gitattributes').read_text()) == '*.sh text\nPreferences/*.plist diff=plist\n'
+    mock_git.assert_any_await(('config', 'diff.plist.textconv', 'macprefs-plist-textconv'), out_dir)
+    mock_git.assert_any_await(('config', 'diff.plist.cachetextconv', 'true'), out_dir)
+
+
+@pytest.mark.asyncio
+async def test_setup_plist_diff_driver_no_git(tmp_path: Path, mocker: MockerFixture) -> None:
+    mock_git = mocker.patch('macprefs.utils.git', new_callable=mocker.AsyncMock)
+    out_dir = AnyioPath(tmp_path)
+    await setup_plist_diff_driver(out_dir, has_git=False)
+    assert (await (out_dir / '.gitattributes').read_text()) == 'Preferences/*.plist diff=plist\n'
+    mock_git.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_binary(mocker: MockerFixture, tmp_path: Path, tool_paths: None) -> None:
+    mock_subprocess = mocker.patch('macprefs.utils.run_process',
+                                   new_callable=mocker.AsyncMock,
+                                   return_value=sp.CompletedProcess((), 0, b'', b''))
     mock_generate_domains = mocker.AsyncMock()
-    mock_generate_domains.__aiter__.return_value = ['domain1', 'domain2', 'domain3', 'rejected1']
+    mock_generate_domains.__aiter__.return_value = ['domain1']
+    mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+    mocker.patch('macprefs.utils.defaults_export',
+                 new_callable=mocker.AsyncMock,
+                 return_value=('domain1', {
+                     'key': 'value'
+                 }))
+    mocker.patch('macprefs.utils.is_git_installed', return_value=False)
+    mock_setup_plist_diff_driver = mocker.patch('macprefs.utils.setup_plist_diff_driver',
+                                                new_callable=mocker.AsyncMock)
+    out_dir = AnyioPath(tmp_path)
+    await prefs_export(out_dir, binary=True)
+    mock_setup_plist_diff_driver.assert_awaited_once_with(out_dir, has_git=False)
+    mock_subprocess.assert_any_await('plutil',
+                                     '-convert',
+                                     'binary1',
+                                     out_dir / 'Preferences/domain1.plist',
+                                     timeout=60)
+
+
+@pytest.mark.asyncio
+async def test_convert_plist_canonical(tmp_path: Path, mocker: MockerFixture) -> None:
+    mock_subprocess = mocker.patch('macprefs.utils.run_process', new_callable=mocker.AsyncMock)
+    plist = tmp_path / 'test.plist'
+    plist.write_bytes(plistlib.dumps({'b': 1, 'a': 2}, fmt=plistlib.PlistFormat.FMT_BINARY))
+    assert await convert_plist(AnyioPath(plist), canonical=True) == 0
+    assert plist.read_bytes() == canonical_plist_bytes({'a': 2, 'b': 1})
+    mock_subprocess.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_convert_plist_canonical_fallback(tmp_path: Path, mocker: MockerFixture,
+                                                tool_paths: None) -> None:
+    mock_subprocess = mocker.patch('macprefs.utils.run_process',
+                                   new_callable=mocker.AsyncMock,
+                                   return_value=sp.CompletedProcess((), 0, b'', b''))
+    plist = AnyioPath(tmp_path / 'test.plist')
+    await plist.write_bytes(b'invalid')
+    assert await convert_plist(plist, binary=True, canonical=True) == 0
+    mock_subprocess.assert_awaited_once_with('plutil', '-convert', 'binary1', plist, timeout=60)
+
+
+@pytest.mark.asyncio
+async def test_convert_plist_timeout(tmp_path: Path, mocker: MockerFixture,
+                                     tool_paths: None) -> None:
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 side_effect=sp.TimeoutExpired(['plutil'], 60))
+    mock_log_warning = mocker.patch('macprefs.utils.log.warning')
+    assert await convert_plist(AnyioPath(tmp_path / 'test.plist')) == 1
+    mock_log_warning.assert_called_once_with('Timed out converting `%s`.', 'test.plist')
+
+
+@pytest.mark.asyncio
+async def test_check_export(tmp_path: Path, mocker: MockerFixture) -> None:
+    home = tmp_path / 'home'
+    (home / 'Library/Preferences').mkdir(parents=True)
+    out_dir = tmp_path / 'out'
+    (out_dir / 'Preferences').mkdir(parents=True)
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(home))
+    domains: dict[str, dict[str, Any]] = {
+        'same': {
+            'a': 1
+        },
+        'reordered': {
+            'a': 1,
+            'b': 2
+        },
+        'changed': {
+            'a': 1
+        },
+        'new': {
+            'a': 1
+        },
+        'data-only': {
+            'a': b'data'
+        }
+    }
+    for domain, root in domains.items():
+        (home / f'Library/Preferences/{domain}.plist').write_bytes(
+            plistlib.dumps(root, fmt=plistlib.PlistFormat.FMT_BINARY))
+    (home / 'Library/Preferences/broken.plist').write_bytes(b'invalid')
+    (out_dir / 'Preferences/same.plist').write_bytes(canonical_plist_bytes({'a': 1}))
+    (out_dir / 'Preferences/reordered.plist').write_bytes(
+        plistlib.dumps({
+            'b': 2,
+            'a': 1
+        }, sort_keys=False))
+    (out_dir / 'Preferences/changed.plist').write_bytes(canonical_plist_bytes({'a': 2}))
+    (out_dir / 'Preferences/old.plist').write_bytes(canonical_plist_bytes({'a': 2}))
+    mock_generate_domains = mocker.AsyncMock()
+    mock_generate_domains.__aiter__.return_value = [*domains, 'broken', 'missing']
+    mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+    assert await check_export(AnyioPath(out_dir), canonical=True) == {
+        'changed': 'semantic',
+        'new': 'added',
+        'old': 'removed',
+        'reordered': 'byte-wise'
+    }
+    assert await check_export(AnyioPath(out_dir)) == {
+        'changed': 'semantic',
+        'new': 'added',
+        'old': 'removed'
+    }
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(('binary', 'expected'), [(True, {'domain': 'semantic'}), (False, {})])
+async def test_check_export_sub_second_dates(tmp_path: Path, mocker: MockerFixture, *, binary: bool,
+                                             expected: dict[str, str]) -> None:
+    home = tmp_path / 'home'
+    (home / 'Library/Preferences').mkdir(parents=True)
+    out_dir = tmp_path / 'out'
+    (out_dir / 'Preferences').mkdir(parents=True)
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(home))
+    source_date = datetime.fromisoformat('2024-01-02T03:04:05.500')
+    export_date = datetime.fromisoformat('2024-01-02T03:04:05.250')
+    (home / 'Library/Preferences/domain.plist').write_bytes(
+        plistlib.dumps({'a': source_date}, fmt=plistlib.PlistFormat.FMT_BINARY))
+    (out_dir / 'Preferences/domain.plist').write_bytes(
+        canonical_plist_bytes({'a': export_date}, binary=binary))
+    mock_generate_domains = mocker.AsyncMock()
+    mock_generate_domains.__aiter__.return_value = ['domain']
+    mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+    assert await check_export(AnyioPath(out_dir), binary=binary, canonical=True) == expected
+
+
+@pytest.mark.asyncio
+async def test_setup_state_directory(tmp_path: Path) -> None:
+    state_dir = await setup_state_directory(AnyioPath(tmp_path))
+    assert state_dir == AnyioPath(tmp_path / '.macprefs')
+    assert (tmp_path / '.macprefs/.gitignore').read_text() == '*\n'
+    assert await setup_state_directory(AnyioPath(tmp_path)) == state_dir
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_record_stats(tmp_path: Path, mocker: MockerFixture) -> None:
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 return_value=sp.CompletedProcess((), 0, b'', b''))
+    mock_generate_domains = mocker.AsyncMock()
+    mock_generate_domains.__aiter__.return_value = ['domain1']
+    mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+    mocker.patch('macprefs.utils.defaults_export',
+                 new_callable=mocker.AsyncMock,
+                 return_value=('domain1', {
+                     'key': 'value'
+                 }))
+    mocker.patch('macprefs.utils.is_git_installed', return_value=False)
+    mock_record_key_stats = mocker.patch('macprefs.utils.record_key_stats')
+    await prefs_export(AnyioPath(tmp_path), record_stats=True)
+    mock_record_key_stats.assert_called_once_with(tmp_path / '.macprefs/key-stats.json',
+                                                  [('domain1', {
+                                                      'key': 'value'
+                                                  })], mocker.ANY)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(('skip_rejected', 'expected_rejected'), [
+    (False, ('# domain1\ndefaults write domain1 frame -dict a 0,0\n\n'
+             '# domain2\ndefaults write domain2 frame -string x\n\n')),
+    (True, None),
+])
+async def test_prefs_export_filter_pushdown(tmp_path: Path, mocker: MockerFixture, *,
+                                            skip_rejected: bool,
+                                            expected_rejected: str | None) -> None:
+    prefs = tmp_path / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    (prefs / 'domain1.plist').write_bytes(
+        plistlib.dumps({
+            'key': 'value',
+            'frame': {
+                'a': '0,0',
+                'b': b'data'
+            },
+            'cache': b'data'
+        }))
+    (prefs / 'domain2.plist').write_bytes(plistlib.dumps({'frame': 'x'}))
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 return_value=sp.CompletedProcess((), 0, b'', b''))
+    mock_generate_domains = mocker.AsyncMock()
+    mock_generate_domains.__aiter__.return_value = ['domain1', 'domain2']
     mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+    mocker.patch('macprefs.utils.is_git_installed', return_value=False)
+    out_dir = tmp_path / 'out'
+    (out_dir / 'rejected-defaults.sh').parent.mkdir()
+    (out_dir / 'rejected-defaults.sh').write_text('old')
+    await prefs_export(AnyioPath(out_dir), {
+        'ignore-key-regexes': ['^frame$', '^cache$'],
+        'ignore-keys': {}
+    },
+                       skip_rejected=skip_rejected)
+    assert (out_dir / 'exec-defaults.sh'
+            ).read_text().endswith('# domain1\ndefaults write domain1 key -string value\n\n')
+    rejected = out_dir / 'rejected-defaults.sh'
+    if expected_rejected is None:
+        assert not rejected.exists()
+    else:
+        assert rejected.read_text().endswith(f'versioned.\n\n{expected_rejected}')
+
+
+@pytest.mark.asyncio
+async def test_defaults_export_negative_cache(tmp_path: Path, mocker: MockerFixture) -> None:
+    prefs = tmp_path / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    repo_prefs_dir = tmp_path / 'out'
+    repo_prefs_dir.mkdir()
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    (prefs / 'invalid.plist').write_bytes(b'invalid')
+    (prefs / 'valid.plist').write_bytes(plistlib.dumps({'key': 'value'}))
+    cache = NegativeCache()
+    assert await defaults_export('invalid', AnyioPath(repo_prefs_dir), cache) == ('invalid', {})
+    assert list(cache.entries) == [str(prefs / 'invalid.plist')]
+    (repo_prefs_dir / 'invalid.plist').unlink()
+    assert await defaults_export('invalid', AnyioPath(repo_prefs_dir), cache) == ('invalid', {})
+    assert not (repo_prefs_dir / 'invalid.plist').exists()
+    assert await defaults_export('valid', AnyioPath(repo_prefs_dir), cache) == ('valid', {
+        'key': 'value'
+    })
+    assert list(cache.entries) == [str(prefs / 'invalid.plist')]
+
+
+@pytest.mark.asyncio
+async def test_defaults_export_negative_cache_permission_error(tmp_path: Path,
+                                                               mocker: MockerFixture) -> None:
+    prefs = tmp_path / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    (prefs / 'domain.plist').write_bytes(plistlib.dumps({'key': 'value'}))
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    mocker.patch('macprefs.utils.shutil.copy', side_effect=PermissionError)
+    if sys.version_info >= (3, 14):
+        mocker.patch('macprefs.utils.Path.copy', side_effect=PermissionError, create=True)
+    cache = NegativeCache()
+    assert await defaults_export('domain', AnyioPath(tmp_path), cache) == ('domain', {})
+    assert list(cache.entries) == [str(prefs / 'domain.plist')]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('error', [PermissionError, FileNotFoundError])
+async def test_defaults_export_stat_error(tmp_path: Path, mocker: MockerFixture,
+                                          error: type[OSError]) -> None:
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    mocker.patch('macprefs.utils.Path.stat', side_effect=error)
+    cache = NegativeCache()
+    assert await defaults_export('domain', AnyioPath(tmp_path), cache) == ('domain', {})
+    assert not cache.entries
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_stat_permission_error(mocker: MockerFixture, tmp_path: Path) -> None:
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 return_value=sp.CompletedProcess((), 0, b'', b''))
+    mocker.patch('macprefs.utils.is_git_installed', return_value=False)
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    prefs = tmp_path / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    (prefs / 'first.plist').write_bytes(plistlib.dumps({'key': 'first'}))
+    (prefs / 'second.plist').write_bytes(plistlib.dumps({'key': 'second'}))
+    mock_generate_domains = mocker.AsyncMock()
+    mock_generate_domains.__aiter__.return_value = ['first', 'second']
+    mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+    stat = AnyioPath.stat
+
+    async def fake_stat(self: AnyioPath, **kwargs: Any) -> os.stat_result:
+        if self.name == 'first.plist' and self.parent == AnyioPath(prefs):
+            raise PermissionError
+        return await stat(self, **kwargs)
+
+    mocker.patch('macprefs.utils.Path.stat', fake_stat)
+    spy_defaults_export = mocker.spy(sys.modules['macprefs.utils'], 'defaults_export')
+    report = await prefs_export(AnyioPath(tmp_path / 'out'), jobs=1)
+    assert report.success
+    assert report.domains_exported == 1
+    assert not (tmp_path / 'out/Preferences/first.plist').exists()
+    assert (tmp_path / 'out/Preferences/second.plist').exists()
+    assert {
+        x.args[0]: x.kwargs['stat'] is not None
+        for x in spy_defaults_export.call_args_list
+    } == {
+        'first': False,
+        'second': True
+    }
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_clear_negative_cache(mocker: MockerFixture,
+                                                 mock_state_directory: AnyioPath) -> None:
+    await (mock_state_directory / 'negative-cache.json').write_text('{"a": [1, 2]}')
+    mock_generate_domains = mocker.AsyncMock()
+    mock_generate_domains.__aiter__.return_value = []
+    mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+    mocker.patch('macprefs.utils.is_git_installed', return_value=False)
+    out_dir = mock_state_directory / 'out'
+    await prefs_export(out_dir, clear_negative_cache=True)
+    assert (await (mock_state_directory / 'negative-cache.json').read_text()) == '{}'
+
+
+@pytest.mark.asyncio
+async def test_defaults_export_snapshot(tmp_path: Path, mocker: MockerFixture) -> None:
+    prefs = tmp_path / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    repo_prefs_dir = tmp_path / 'out'
+    repo_prefs_dir.mkdir()
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    (prefs / 'domain.plist').write_bytes(plistlib.dumps({'key': 'value'}))
+    snapshot = SnapshotCache()
+    assert await defaults_export('domain', AnyioPath(repo_prefs_dir),
+                                 snapshot=snapshot) == ('domain', {
+                                     'key': 'value'
+                                 })
+    assert snapshot.hits == set()
+    mock_try_parse_plist = mocker.patch('macprefs.utils.try_parse_plist')
+    assert await defaults_export('domain', AnyioPath(repo_prefs_dir),
+                                 snapshot=snapshot) == ('domain', {
+                                     'key': 'value'
+                                 })
+    assert snapshot.hits == {'domain'}
+    mock_try_parse_plist.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_snapshot_skips_conversion(mocker: MockerFixture,
+                                                      mock_state_directory: AnyioPath,
+                                                      tool_paths: None) -> None:
+    mock_subprocess = mocker.patch('macprefs.utils.run_process',
+                                   new_callable=mocker.AsyncMock,
+                                   return_value=sp.CompletedProcess((), 0, b'', b''))
+    mock_generate_domains = mocker.AsyncMock()
+    mock_generate_domains.__aiter__.return_value = ['domain1', 'domain2']
+
+    async def fake_defaults_export(  # ruff:ignore[unused-async]
+            domain: str, repo_prefs_dir: AnyioPath, negative_cache: NegativeCache,
+            snapshot: SnapshotCache, **kwargs: Any) -> tuple[str, dict[str, str]]:
+        snapshot.put(domain, {'key': 'value'})
+        if domain == 'domain1':
+            snapshot.hits.add(domain)
+        return domain, {'key': 'value'}
+
+    mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+    mocker.patch('macprefs.utils.defaults_export', side_effect=fake_defaults_export)
+    mocker.patch('macprefs.utils.is_git_installed', return_value=False)
+    out_dir = mock_state_directory / 'out'
+    await prefs_export(out_dir)
+    mock_subprocess.assert_awaited_once_with('plutil',
+                                             '-convert',
+                                             'xml1',
+                                             out_dir / 'Preferences/domain2.plist',
+                                             timeout=60)
+    snapshot = await load_snapshot(out_dir)
+    assert snapshot.domains() == ['domain1', 'domain2']
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_snapshot_stale_hits(mocker: MockerFixture,
+                                                mock_state_directory: AnyioPath,
+                                                tool_paths: None) -> None:
+    mock_subprocess = mocker.patch('macprefs.utils.run_process',
+                                   new_callable=mocker.AsyncMock,
+                                   return_value=sp.CompletedProcess((), 0, b'', b''))
+    mock_generate_domains = mocker.AsyncMock()
+    mock_generate_domains.__aiter__.return_value = ['domain1']
+
+    async def fake_defaults_export(  # ruff:ignore[unused-async]
+            domain: str, repo_prefs_dir: AnyioPath, negative_cache: NegativeCache,
+            snapshot: SnapshotCache, **kwargs: Any) -> tuple[str, dict[str, str]]:
+        snapshot.put(domain, {'key': 'changed'})
+        return domain, {'key': 'changed'}
+
+    mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+    mocker.patch('macprefs.utils.defaults_export', side_effect=fake_defaults_export)
+    mocker.patch('macprefs.utils.is_git_installed', return_value=False)
+    snapshot = SnapshotCache()
+    snapshot.hits.add('domain1')
+    await prefs_export(mock_state_directory / 'out', snapshot=snapshot)
+    mock_subprocess.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_selected_domains(mocker: MockerFixture, tmp_path: Path) -> None:
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 return_value=sp.CompletedProcess((), 0, b'', b''))
+    mocker.patch('macprefs.utils.is_git_installed', return_value=False)
+    mocker.patch('macprefs.config.make_key_filter', return_value=lambda _d, k: k == 'ignored')
+    roots: dict[str, dict[str, Any]] = {
+        '-globalDomain': {
+            'key': 'global'
+        },
+        'com.apple.a': {
+            'key': 'a',
+            'ignored': 1
+        },
+        'com.apple.b': {
+            'key': 'b'
+        },
+        'org.c': {
+            'key': 'c'
+        }
+    }
+
+    def fake_generate_domains(*_args: Any, **_kwargs: Any) -> Any:
+        mock = mocker.AsyncMock()
+        mock.__aiter__.return_value = list(roots)
+        return mock
+
+    async def fake_defaults_export(  # ruff:ignore[unused-async]
+            domain: str, *_args: Any, **_kwargs: Any) -> tuple[str, dict[str, Any]]:
+        return domain, roots[domain]
+
+    mocker.patch('macprefs.utils.generate_domains', side_effect=fake_generate_domains)
     mock_defaults_export = mocker.patch('macprefs.utils.defaults_export',
-                                        new_callable=mocker.AsyncMock,
-                                        side_effect=[('domain1', {
-                                            'key': 'value'
-                                        }), ('domain2', {
-                                            'key': 'value'
-                                        }), ('domain3', {}), ('rejected1', {
-                                            'key': 'value'
-                                        })])
-    mock_git = mocker.patch('macprefs.utils.git', new_callable=mocker.AsyncMock)
-    mock_branch_process = mocker.AsyncMock()
-    mock_branch_process.stdout = None
-    mock_git.side_effect = [mock_process, mock_process, mock_process, mock_branch_process]
-    mock_is_git_installed = mocker.patch('macprefs.utils.is_git_installed', return_value=True)
-    mock_out_dir.__truediv__.return_value = mocker.AsyncMock()
-    mock_out_dir.__truediv__.return_value.open = mocker.AsyncMock()
-    mock_repo_prefs_dir.__truediv__.return_value.name = 'out.plist'
-    mocker.patch('macprefs.utils.make_key_filter', return_value=lambda d, _: d == 'rejected1')
-    test1_plist = mocker.AsyncMock(spec=AnyioPath)
-    test1_plist.name = 'test1.plist'
-    test1_plist.exists.return_value = True
-    test1_plist.is_dir.return_value = False
-    iterdir_iterator = mocker.AsyncMock()
-    mock_repo_prefs_dir.iterdir.return_value = iterdir_iterator
-    iterdir_iterator.__aiter__.return_value = [test1_plist]
-    mock_deploy_key = mocker.AsyncMock(spec=AnyioPath)
-    with pytest.raises(RuntimeError, match='git branch stdout'):
-        await prefs_export(mock_out_dir, deploy_key=mock_deploy_key, commit=True)
-    assert mock_git.call_count == 4
-    mock_is_git_installed.assert_called_once()
-    mock_setup_output_directory.assert_called_once()
-    mock_generate_domains.__aiter__.assert_called_once()
-    mock_defaults_export.assert_called()
+                                        side_effect=fake_defaults_export)
+    mock_record_key_stats = mocker.patch('macprefs.utils.record_key_stats')
+    out_dir = AnyioPath(tmp_path)
+    await prefs_export(out_dir, domains=['org.c'], record_stats=True)
+    assert mock_defaults_export.call_count == 4
+    assert mock_record_key_stats.call_count == 1
+    exec_defaults = (tmp_path / 'exec-defaults.sh').read_text()
+    assert exec_defaults.index('-globalDomain') < exec_defaults.index('com.apple.a')
+    mock_defaults_export.reset_mock()
+    roots['com.apple.a'] = {'key': 'changed'}
+    roots['com.apple.b'] = {}
+    roots['org.c'] = {'key': 'not exported'}
+    await prefs_export(out_dir, domain_globs=['com.apple.*'], record_stats=True)
+    assert sorted(
+        x.args[0] for x in mock_defaults_export.call_args_list) == ['com.apple.a', 'com.apple.b']
+    assert mock_record_key_stats.call_count == 1
+    assert (tmp_path / 'exec-defaults.sh').read_text() == exec_defaults.replace(
+        'key -string a', 'key -string changed').replace(
+            '# com.apple.b\ndefaults write com.apple.b key -string b\n\n', '')
+    assert not (tmp_path / 'scripts/rejected/com.apple.a.sh').exists()
+    mock_defaults_export.reset_mock()
+    roots['-globalDomain'] = {'key': 'new global'}
+    await prefs_export(out_dir, domains=['globalDomain'])
+    assert [x.args[0] for x in mock_defaults_export.call_args_list] == ['-globalDomain']
+    assert (tmp_path / 'scripts/globalDomain.sh').read_text() == (
+        "# -globalDomain\ndefaults write -globalDomain key -string 'new global'\n\n")
 
 
 @pytest.mark.asyncio
-async def test_prefs_export_git_no_deploy_key(mocker: MockerFixture) -> None:
-    mock_subprocess = mocker.patch('macprefs.utils.sp.create_subprocess_exec',
-                                   new_callable=mocker.AsyncMock)
-    mock_process = mocker.AsyncMock()
-    mock_process.wait.return_value = 0
-    mock_subprocess.return_value = mock_process
-    mocker.patch('macprefs.utils.Path')
-    mock_out_dir = mocker.AsyncMock(spec=AnyioPath)
-    mock_repo_prefs_dir = mocker.AsyncMock(spec=AnyioPath)
-    mock_setup_output_directory = mocker.patch('macprefs.utils.setup_output_directory',
-                                               return_value=(mock_out_dir, mock_repo_prefs_dir))
+async def test_prefs_export_os_timeout_error(mocker: MockerFixture, tmp_path: Path) -> None:
+    mocker.patch('macprefs.utils.is_git_installed', return_value=False)
     mock_generate_domains = mocker.AsyncMock()
-    mock_generate_domains.__aiter__.return_value = ['domain1', 'domain2', 'domain3', 'rejected1']
+    mock_generate_domains.__aiter__.return_value = ['domain']
+    mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+    mocker.patch('macprefs.utils.defaults_export',
+                 new_callable=mocker.AsyncMock,
+                 side_effect=TimeoutError(errno.ETIMEDOUT, 'Operation timed out'))
+    mock_log_warning = mocker.patch('macprefs.utils.log.warning')
+    with pytest.raises(TimeoutError):
+        await prefs_export(AnyioPath(tmp_path / 'out'), domain_timeout=10)
+    mock_log_warning.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_timeouts(mocker: MockerFixture, tmp_path: Path) -> None:
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 return_value=sp.CompletedProcess((), 0, b'', b''))
+    mocker.patch('macprefs.utils.is_git_installed', return_value=False)
+    mock_generate_domains = mocker.AsyncMock()
+    mock_generate_domains.__aiter__.return_value = ['fast', 'slow']
     mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+    delays = {'fast': 0.0, 'slow': 10.0}
+
+    async def fake_defaults_export(domain: str, *_args: Any,
+                                   **_kwargs: Any) -> tuple[str, dict[str, Any]]:
+        await asyncio.sleep(delays[domain])
+        return domain, {'key': domain}
+
+    mocker.patch('macprefs.utils.defaults_export', side_effect=fake_defaults_export)
+    mock_log_warning = mocker.patch('macprefs.utils.log.warning')
+    out_dir = tmp_path / 'out'
+    (out_dir / 'scripts').mkdir(parents=True)
+    (out_dir / 'scripts/slow.sh').write_text('# slow\ndefaults write slow key -string old\n\n')
+    (out_dir / 'Preferences').mkdir()
+    (out_dir / 'Preferences/slow.plist').write_bytes(b'old')
+    report = await prefs_export(AnyioPath(out_dir), domain_timeout=0.1, record_stats=True)
+    assert report.timed_out == ['slow']
+    assert report.report() == 'Timed out: slow\n'
+    mock_log_warning.assert_any_call(
+        'Timed out exporting %d domain(s). Their previous export was kept: %s', 1, 'slow')
+    assert (out_dir / 'exec-defaults.sh').read_text().endswith(
+        '# fast\ndefaults write fast key -string fast\n\n'
+        '# slow\ndefaults write slow key -string old\n\n')
+    assert (out_dir / 'Preferences/slow.plist').read_bytes() == b'old'
+    delays['fast'] = 10.0
+    report = await prefs_export(AnyioPath(out_dir), run_timeout=0.1)
+    assert report.timed_out == ['fast', 'slow']
+    assert (out_dir / 'scripts/fast.sh').exists()
+
+
+@pytest.mark.asyncio
+async def test_defaults_export_cancelled(tmp_path: Path, mocker: MockerFixture) -> None:
+    prefs = tmp_path / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    repo_prefs_dir = tmp_path / 'out'
+    repo_prefs_dir.mkdir()
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    (prefs / 'domain.plist').write_bytes(plistlib.dumps({'key': 'new'}))
+    (repo_prefs_dir / 'domain.plist').write_bytes(b'old')
+    mocker.patch('macprefs.utils.try_parse_plist', side_effect=asyncio.CancelledError)
+    with pytest.raises(asyncio.CancelledError):
+        await defaults_export('domain', AnyioPath(repo_prefs_dir))
+    assert [x.name for x in repo_prefs_dir.iterdir()] == ['domain.plist']
+    assert (repo_prefs_dir / 'domain.plist').read_bytes() == b'old'
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_largest_first(mocker: MockerFixture, tmp_path: Path) -> None:
+    prefs = tmp_path / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    sizes = {'a': 10, 'b': 1000, 'c': 100, '.GlobalPreferences': 500}
+    for name, size in sizes.items():
+        (prefs / f'{name}.plist').write_bytes(b'x' * size)
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 return_value=sp.CompletedProcess((), 0, b'', b''))
+    mocker.patch('macprefs.utils.is_git_installed', return_value=False)
+    mock_generate_domains = mocker.AsyncMock()
+    mock_generate_domains.__aiter__.return_value = ['a', 'b', 'c', 'missing', '-globalDomain']
+    mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+
+    async def fake_defaults_export(  # ruff:ignore[unused-async]
+            domain: str, *_args: Any, **_kwargs: Any) -> tuple[str, dict[str, Any]]:
+        return domain, {'key': domain}
+
     mock_defaults_export = mocker.patch('macprefs.utils.defaults_export',
-                                        new_callable=mocker.AsyncMock,
-                                        side_effect=[('domain1', {
-                                            'key': 'value'
-                                        }), ('domain2', {
-                                            'key': 'value'
-                                        }), ('domain3', {}), ('rejected1', {
-                                            'key': 'value'
-                                        })])
-    mock_git = mocker.patch('macprefs.utils.git', new_callable=mocker.AsyncMock)
-    mock_git.return_value = mock_process
-    mock_is_git_installed = mocker.patch('macprefs.utils.is_git_installed', return_value=True)
-    mock_out_dir.__truediv__.return_value = mocker.AsyncMock()
-    mock_out_dir.__truediv__.return_value.open = mocker.AsyncMock()
-    mock_repo_prefs_dir.__truediv__.return_value.name = 'out.plist'
-    mocker.patch('macprefs.utils.make_key_filter', return_value=lambda d, _: d == 'rejected1')
-    test1_plist = mocker.AsyncMock(spec=AnyioPath)
-    test1_plist.name = 'test1.plist'
-    test1_plist.exists.return_value = True
-    test1_plist.is_dir.return_value = False
-    iterdir_iterator = mocker.AsyncMock()
-    mock_repo_prefs_dir.iterdir.return_value = iterdir_iterator
-    iterdir_iterator.__aiter__.return_value = [test1_plist]
-    await prefs_export(mock_out_dir, commit=True)
-    mock_is_git_installed.assert_called_once()
-    mock_setup_output_directory.assert_called_once()
-    mock_generate_domains.__aiter__.assert_called_once()
-    mock_defaults_export.assert_called()
-    assert mock_git.call_count == 3
+                                        side_effect=fake_defaults_export)
+    out_dir = tmp_path / 'out'
+    await prefs_export(AnyioPath(out_dir), jobs=1)
+    assert [x.args[0] for x in mock_defaults_export.call_args_list] == [
+        'b', '-globalDomain', 'c', 'a', 'missing'
+    ]
+    assert sorted(x.name for x in (out_dir / 'scripts').glob('*.sh')) == [
+        'a.sh', 'b.sh', 'c.sh', 'globalDomain.sh', 'missing.sh'
+    ]
+    exec_defaults = (out_dir / 'exec-defaults.sh').read_text()
+    assert [
+        exec_defaults.index(f'# {x}\n') for x in ('-globalDomain', 'a', 'b', 'c', 'missing')
+    ] == sorted(
+        exec_defaults.index(f'# {x}\n') for x in ('-globalDomain', 'a', 'b', 'c', 'missing'))
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_largest_first_slow_stat(mocker: MockerFixture, tmp_path: Path) -> None:
+    prefs = tmp_path / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    for name, size in {'a': 10, 'b': 1000, 'c': 100}.items():
+        (prefs / f'{name}.plist').write_bytes(b'x' * size)
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 return_value=sp.CompletedProcess((), 0, b'', b''))
+    mocker.patch('macprefs.utils.is_git_installed', return_value=False)
+    mock_generate_domains = mocker.AsyncMock()
+    mock_generate_domains.__aiter__.return_value = ['a', 'b', 'c']
+    mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+
+    async def slow_source_plist(domain: str) -> AnyioPath:
+        if domain == 'b':
+            await asyncio.sleep(0.01)
+        return AnyioPath(prefs / f'{domain}.plist')
+
+    async def fake_defaults_export(  # ruff:ignore[unused-async]
+            domain: str, *_args: Any, **_kwargs: Any) -> tuple[str, dict[str, Any]]:
+        return domain, {'key': domain}
+
+    mocker.patch('macprefs.utils._source_plist', side_effect=slow_source_plist)
+    mock_defaults_export = mocker.patch('macprefs.utils.defaults_export',
+                                        side_effect=fake_defaults_export)
+    await prefs_export(AnyioPath(tmp_path / 'out'), jobs=1)
+    assert [x.args[0] for x in mock_defaults_export.call_args_list] == ['b', 'c', 'a']
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_resume(mocker: MockerFixture, tmp_path: Path) -> None:
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 return_value=sp.CompletedProcess((), 0, b'', b''))
+    mocker.patch('macprefs.utils.is_git_installed', return_value=False)
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    prefs = tmp_path / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    for domain in ('first', 'second'):
+        (prefs / f'{domain}.plist').write_bytes(plistlib.dumps({'key': domain}))
+    mock_generate_domains = mocker.AsyncMock()
+    mock_generate_domains.__aiter__.return_value = ['first', 'second']
+    mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+    exported = []
+    failing = {'second'}
+
+    async def fake_defaults_export(domain: str, *_args: Any,
+                                   **_kwargs: Any) -> tuple[str, dict[str, Any]]:
+        if domain in failing:
+            await asyncio.sleep(0.1)
+            raise RuntimeError
+        exported.append(domain)
+        return domain, {'key': domain}
+
+    mocker.patch('macprefs.utils.defaults_export', side_effect=fake_defaults_export)
+    out_dir = tmp_path / 'out'
+    with pytest.raises(RuntimeError):
+        await prefs_export(AnyioPath(out_dir), jobs=2)
+    journal = out_dir / '.macprefs/journal.jsonl'
+    assert journal.exists()
+    assert exported == ['first']
+    failing.clear()
+    report = await prefs_export(AnyioPath(out_dir), jobs=1, resume=True)
+    assert report.resumed == ['first']
+    assert exported == ['first', 'second']
+    assert (out_dir / 'scripts/first.sh').exists()
+    assert (out_dir / 'exec-defaults.sh').read_text().endswith(
+        '# first\ndefaults write first key -string first\n\n'
+        '# second\ndefaults write second key -string second\n\n')
+    assert not journal.exists()
+    mock_log_info = mocker.patch('macprefs.utils.log.info')
+    report = await prefs_export(AnyioPath(out_dir), jobs=1, resume=True)
+    assert report.resumed == []
+    mock_log_info.assert_any_call('Nothing to resume. Exporting all domains.')
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_metrics(mocker: MockerFixture, tmp_path: Path) -> None:
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 return_value=sp.CompletedProcess((), 0, b'', b''))
+    mocker.patch('macprefs.utils.is_git_installed', return_value=True)
+    mocker.patch('macprefs.utils.git', new_callable=mocker.AsyncMock)
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    prefs = tmp_path / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    (prefs / 'domain1.plist').write_bytes(plistlib.dumps({'accepted': 1, 'ignored': 2}))
+    (prefs / 'domain2.plist').write_bytes(plistlib.dumps({}))
+    mock_generate_domains = mocker.AsyncMock()
+    mock_generate_domains.__aiter__.return_value = ['domain1', 'domain2']
+    mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+    mocker.patch('macprefs.config.make_key_filter', return_value=lambda _, k: k == 'ignored')
+    out_dir = tmp_path / 'out'
+    report = await prefs_export(AnyioPath(out_dir),
+                                commit=True,
+                                metrics_file=AnyioPath(tmp_path / 'macprefs.prom'))
+    assert report.success is True
+    assert (report.domains_scanned, report.domains_exported, report.domains_skipped) == (2, 1, 1)
+    assert (report.keys_accepted, report.keys_rejected) == (1, 1)
+    assert report.bytes_read == (prefs / 'domain1.plist').stat().st_size
+    assert report.bytes_written > 0
+    assert {'setup', 'export', 'scripts', 'save', 'cleanup', 'commit'} <= set(report.stage_seconds)
+    metrics = (tmp_path / 'macprefs.prom').read_text()
+    assert 'macprefs_last_run_success 1\n' in metrics
+    assert 'macprefs_keys{state="accepted"} 1\n' in metrics
+    assert metrics.endswith('# EOF\n')
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_sinks(mocker: MockerFixture, tmp_path: Path) -> None:
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 return_value=sp.CompletedProcess((), 0, b'', b''))
+    mocker.patch('macprefs.utils.is_git_installed', return_value=False)
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    prefs = tmp_path / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    (prefs / 'first.plist').write_bytes(plistlib.dumps({'key': 'first', 'Secret': 'value'}))
+    (prefs / 'second.plist').write_bytes(plistlib.dumps({'key': 'second'}))
+
+    async def fake_generate_domains(  # ruff:ignore[unused-async]
+            *, domain_filter: DomainFilter, **_kwargs: Any) -> AsyncIterator[str]:
+        for domain in ('first', 'second'):
+            if not domain_filter(domain):
+                yield domain
+
+    mocker.patch('macprefs.utils.generate_domains', side_effect=fake_generate_domains)
+    spy_try_parse_plist = mocker.spy(sys.modules['macprefs.utils'], 'try_parse_plist')
+    filtered = {
+        'output-directory': str(tmp_path / 'filtered'),
+        'extend-ignore-domains': ['second'],
+        'extend-ignore-keys': {
+            'first': ['Secret']
+        },
+        'skip-rejected': True
+    }
+    config: dict[str, Any] = {
+        'sinks': [filtered,
+                  Sink(AnyioPath(tmp_path / 'binary'), binary=True, canonical=True)]
+    }
+    report = await prefs_export(AnyioPath(tmp_path / 'out'), config, jobs=1)
+    assert report.success
+    assert spy_try_parse_plist.call_count == 2
+    script = (tmp_path / 'out/exec-defaults.sh').read_text()
+    assert 'defaults write first Secret -string value' in script
+    assert 'defaults write second key -string second' in script
+    script = (tmp_path / 'filtered/exec-defaults.sh').read_text()
+    assert script.endswith('# first\ndefaults write first key -string first\n\n')
+    assert not (tmp_path / 'filtered/rejected-defaults.sh').exists()
+    assert (tmp_path / 'filtered/Preferences/first.plist').read_bytes() == (
+        tmp_path / 'out/Preferences/first.plist').read_bytes()
+    assert not (tmp_path / 'filtered/Preferences/second.plist').exists()
+    assert (tmp_path / 'binary/Preferences/second.plist').read_bytes().startswith(b'bplist00')
+    assert (tmp_path /
+            'binary/exec-defaults.sh').read_text() == (tmp_path /
+                                                       'out/exec-defaults.sh').read_text()
+    filtered['extend-ignore-domains'] = ['first', 'second']
+    await prefs_export(AnyioPath(tmp_path / 'out'), config, jobs=1)
+    assert not (tmp_path / 'filtered/scripts/first.sh').exists()
+    assert (tmp_path / 'binary/scripts/first.sh').exists()
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_sink_conversion_error(mocker: MockerFixture, tmp_path: Path) -> None:
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 side_effect=[
+                     sp.CompletedProcess((), 0, b'', b''),
+                     sp.CompletedProcess((), 1, b'', b'error')
+                 ])
+    mocker.patch('macprefs.utils.is_git_installed', return_value=False)
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    prefs = tmp_path / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    (prefs / 'first.plist').write_bytes(plistlib.dumps({'key': 'first'}))
+    mock_generate_domains = mocker.AsyncMock()
+    mock_generate_domains.__aiter__.return_value = ['first']
+    mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+    with pytest.raises(PropertyListConversionError):
+        await prefs_export(AnyioPath(tmp_path / 'out'),
+                           {'sinks': [Sink(AnyioPath(tmp_path / 'binary'), binary=True)]})
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_sinks_snapshot(mocker: MockerFixture, tmp_path: Path) -> None:
+    mock_run_process = mocker.patch('macprefs.utils.run_process',
+                                    new_callable=mocker.AsyncMock,
+                                    return_value=sp.CompletedProcess((), 0, b'', b''))
+    mocker.patch('macprefs.utils.is_git_installed', return_value=False)
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    prefs = tmp_path / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    (prefs / 'first.plist').write_bytes(plistlib.dumps({'key': 'first'}))
+    (prefs / 'second.plist').write_bytes(plistlib.dumps({'key': 'second'}))
+    mock_generate_domains = mocker.AsyncMock()
+    mock_generate_domains.__aiter__.return_value = ['first', 'second']
+    mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+    spy_atomic_write = mocker.spy(sys.modules['macprefs.sinks'], 'atomic_write')
+    config: dict[str, Any] = {
+        'sinks': [{
+            'output-directory': str(tmp_path / 'sink'),
+            'binary': True
+        }]
+    }
+    await prefs_export(AnyioPath(tmp_path / 'out'), config, jobs=1)
+    sink_plists = AnyioPath(tmp_path / 'sink/Preferences')
+    assert [x.args[0].parent for x in spy_atomic_write.call_args_list].count(sink_plists) == 2
+    spy_atomic_write.reset_mock()
+    mock_run_process.reset_mock()
+    (tmp_path / 'sink/Preferences/second.plist').unlink()
+    (tmp_path / 'sink/scripts/first.sh').write_text('# first\n')
+    report = await prefs_export(AnyioPath(tmp_path / 'out'), config, jobs=1)
+    assert report.success
+    assert [x.args[0] for x in spy_atomic_write.call_args_list
+            if x.args[0].parent == sink_plists] == [sink_plists / 'second.plist']
+    mock_run_process.assert_called_once()
+    assert (tmp_path / 'sink/scripts/first.sh').read_text() == '# first\n'
+    assert (tmp_path / 'sink/Preferences/second.plist').exists()
+    config['sinks'][0]['binary'] = False
+    assert not (await load_snapshot(AnyioPath(tmp_path / 'out'), config)).get_fresh(
+        'first', (prefs / 'first.plist').stat())
+
+
+@pytest.mark.asyncio
+async def test_prefs_export_sinks_skip_rejected(mocker: MockerFixture, tmp_path: Path) -> None:
+    mocker.patch('macprefs.utils.run_process',
+                 new_callable=mocker.AsyncMock,
+                 return_value=sp.CompletedProcess((), 0, b'', b''))
+    mocker.patch('macprefs.utils.is_git_installed', return_value=False)
+    mocker.patch('macprefs.utils.Path.home', return_value=AnyioPath(tmp_path))
+    prefs = tmp_path / 'Library/Preferences'
+    prefs.mkdir(parents=True)
+    (prefs / 'first.plist').write_bytes(plistlib.dumps({'Secret': 'value'}))
+    (prefs / 'second.plist').write_bytes(plistlib.dumps({'key': 'second', 'Secret': 'value'}))
+    mock_generate_domains = mocker.AsyncMock()
+    mock_generate_domains.__aiter__.return_value = ['first', 'second']
+    mocker.patch('macprefs.utils.generate_domains', return_value=mock_generate_domains)
+    config: dict[str, Any] = {
+        'extend-ignore-key-regexes': ['^Secret$'],
+        'sinks': [{
+            'extend-ignore-key-regexes': ['^Secret$'],
+            'output-directory': str(tmp_path / 'sink')
+        }]
+    }
+    report = await prefs_export(AnyioPath(tmp_path / 'out'), config, jobs=1, skip_rejected=True)
+    assert report.success
+    assert report.domains_exported == 1
+    assert report.keys_rejected == 0
+    assert not (tmp_path / 'out/scripts/first.sh').exists()
+    assert 'Secret' not in (tmp_path / 'out/exec-defaults.sh').read_text()
+    assert not (tmp_path / 'sink/scripts/first.sh').exists()
+    assert 'defaults write second Secret -string value' in (
+        tmp_path / 'sink/rejected-defaults.sh').read_text()
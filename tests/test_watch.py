@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any
+import asyncio
+
+from anyio import Path as AnyioPath
+from macprefs.exceptions import PropertyListConversionError
+from macprefs.watch import changed_files, scan_directory, watch_directory, watch_export
+import pytest
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+    from pathlib import Path
+
+    from pytest_mock import MockerFixture
+
+
+def test_scan_directory(tmp_path: Path) -> None:
+    (tmp_path / 'a.plist').write_bytes(b'abc')
+    (tmp_path / 'b.txt').write_bytes(b'')
+    state = scan_directory(tmp_path)
+    assert list(state) == ['a.plist']
+    assert state['a.plist'][1] == 3
+
+
+def test_changed_files() -> None:
+    assert changed_files({
+        'a.plist': (1, 1),
+        'b.plist': (1, 1),
+        'c.plist': (1, 1)
+    }, {
+        'a.plist': (1, 1),
+        'b.plist': (2, 1),
+        'd.plist': (1, 1)
+    }) == {'b.plist', 'c.plist', 'd.plist'}
+
+
+@pytest.mark.asyncio
+async def test_watch_directory_debounces(tmp_path: Path) -> None:
+    (tmp_path / 'a.plist').write_bytes(b'1')
+
+    async def write() -> None:
+        for i in range(3):
+            await asyncio.sleep(0.05)
+            (tmp_path / 'a.plist').write_bytes(b'x' * (i + 2))
+        (tmp_path / 'b.plist').write_bytes(b'')
+        (tmp_path / 'ignored.txt').write_bytes(b'')
+
+    changes = watch_directory(tmp_path, debounce=0.3, poll_interval=0.02)
+    task = asyncio.create_task(write())
+    assert await asyncio.wait_for(anext(changes), 10) == {'a', 'b'}
+    await task
+    await changes.aclose()
+
+
+@pytest.mark.asyncio
+async def test_watch_directory_max_delay(tmp_path: Path) -> None:
+    async def write() -> None:
+        for i in range(40):
+            (tmp_path / 'a.plist').write_bytes(b'x' * i)
+            await asyncio.sleep(0.03)
+
+    changes = watch_directory(tmp_path, debounce=1, max_delay=0.2, poll_interval=0.02)
+    task = asyncio.create_task(write())
+    assert await asyncio.wait_for(anext(changes), 10) == {'a'}
+    assert not task.done()
+    task.cancel()
+    await changes.aclose()
+
+
+@pytest.mark.asyncio
+async def test_watch_export(tmp_path: Path, mocker: MockerFixture) -> None:
+    mock_prefs_export = mocker.patch('macprefs.lock.prefs_export',
+                                     new_callable=mocker.AsyncMock,
+                                     side_effect=[None, None, PropertyListConversionError])
+    mock_load_snapshot = mocker.patch('macprefs.watch.load_snapshot', new_callable=mocker.AsyncMock)
+    mocker.patch('macprefs.watch.Path.home', return_value=AnyioPath(tmp_path))
+
+    async def fake_generate_domains(  # ruff:ignore[unused-async]
+            *_args: Any, **_kwargs: Any) -> AsyncIterator[str]:
+        for domain in ('domain1', '-globalDomain'):
+            yield domain
+
+    async def fake_watch_directory(  # ruff:ignore[unused-async]
+            *_args: Any, **_kwargs: Any) -> AsyncIterator[set[str]]:
+        yield {'ignored'}
+        yield {'.GlobalPreferences'}
+        yield {'domain1', 'ignored'}
+
+    mocker.patch('macprefs.utils.generate_domains', side_effect=fake_generate_domains)
+    mocker.patch('macprefs.watch.watch_directory', side_effect=fake_watch_directory)
+    mock_log_exception = mocker.patch('macprefs.watch.log.exception')
+    await watch_export(AnyioPath(tmp_path), clear_negative_cache=True, commit=True, resume=True)
+    assert mock_prefs_export.await_count == 3
+    first, second, third = mock_prefs_export.await_args_list
+    assert first.kwargs['clear_negative_cache'] is True
+    assert first.kwargs['resume'] is True
+    assert first.kwargs['domains'] == []
+    assert 'clear_negative_cache' not in second.kwargs
+    assert 'resume' not in second.kwargs
+    assert second.kwargs['domains'] == ['-globalDomain']
+    assert third.kwargs['domains'] == ['domain1']
+    assert second.kwargs['commit'] is True
+    assert second.kwargs['snapshot'] is mock_load_snapshot.return_value
+    assert first.kwargs['key_filter'] is second.kwargs['key_filter']
+    mock_log_exception.assert_called_once_with('Export failed.')
+
+
+@pytest.mark.asyncio
+async def test_watch_export_selected_domains(tmp_path: Path, mocker: MockerFixture) -> None:
+    mock_prefs_export = mocker.patch('macprefs.lock.prefs_export', new_callable=mocker.AsyncMock)
+    mocker.patch('macprefs.watch.load_snapshot', new_callable=mocker.AsyncMock)
+    mocker.patch('macprefs.watch.Path.home', return_value=AnyioPath(tmp_path))
+
+    async def fake_generate_domains(  # ruff:ignore[unused-async]
+            *_args: Any, **_kwargs: Any) -> AsyncIterator[str]:
+        for domain in ('domain1', 'domain2', '-globalDomain'):
+            yield domain
+
+    async def fake_watch_directory(  # ruff:ignore[unused-async]
+            *_args: Any, **_kwargs: Any) -> AsyncIterator[set[str]]:
+        yield {'.GlobalPreferences'}
+        yield {'domain1', 'domain2'}
+
+    mocker.patch('macprefs.utils.generate_domains', side_effect=fake_generate_domains)
+    mocker.patch('macprefs.watch.watch_directory', side_effect=fake_watch_directory)
+    await watch_export(AnyioPath(tmp_path), domain_globs=['domain*'], domains=['other'])
+    first, second = mock_prefs_export.await_args_list
+    assert first.kwargs['domain_globs'] == ['domain*']
+    assert first.kwargs['domains'] == ['other']
+    assert second.kwargs['domains'] == ['domain1', 'domain2']